@@ -19,6 +19,7 @@ import base64
 import importlib
 import marshal
 import math
+import re
 import sys
 import time
 import traceback
@@ -208,18 +209,168 @@ class DependencyGraph(object):
 
         return loops
 
+    @staticmethod
+    def averageSize(query, plateauSize):
+        # items per entry at a plateau, from the dataset's metadata (None if it can't be known)
+        dataset = query.dataset
+        if dataset is None or len(dataset.groups) == 0:
+            return None
+        for column in dataset.columns.values():
+            if column.size == plateauSize:
+                try:
+                    numEntries = sum(group.numEntries for group in dataset.groups)
+                    numItems = sum(group.segments[column.data].dataLength for group in dataset.groups)
+                except (KeyError, AttributeError):
+                    return None
+                if numEntries == 0:
+                    return None
+                return float(numItems) / numEntries
+        return None
+
+    @staticmethod
+    def fuse(loops, query, maxStatements=4, roundTripCost=2.0):
+        # a flat loop whose results are only exploded into one other loop can be recomputed inside that loop,
+        # rather than written to an array and read back; but recomputing runs the producer once per item, not once
+        # per entry, so it's only done if that costs less than writing and reading each column (roundTripCost,
+        # in statements per entry), which requires small collections (known from the dataset's metadata)
+        schemas = dict(query.inputs)
+        refnumber = [0]
+        for statement in query.statements:
+            if not isinstance(statement, statementlist.ExplodeSize):   # sizes have no schema
+                schemas[statement.column] = statement.schema
+            m = re.match(r"^#([0-9]+)$", str(statement.column))
+            if m is not None:
+                refnumber[0] = max(refnumber[0], int(m.group(1)) + 1)
+
+        def newname():
+            refnumber[0] += 1
+            return ColumnName(refnumber[0] - 1)
+
+        actionColumns = set(sum([list(action.columns()) for action in query.actions], []))
+
+        changed = True
+        while changed:
+            changed = False
+            allloops = sum(loops.values(), [])
+            for producer in allloops:
+                if producer.plateauSize is not None or len(producer.statements) > maxStatements:
+                    continue
+                if any(isinstance(arg, ColumnName) and arg.issize() for statement in producer.statements for arg in statement.args):
+                    continue
+
+                defined = producer.defines()
+                if len(defined.intersection(actionColumns)) > 0:
+                    continue
+
+                users = [loop for loop in allloops if loop is not producer and len(loop.needs().intersection(defined)) > 0]
+                if len(users) != 1 or users[0].plateauSize is None:
+                    continue
+                consumer = users[0]
+
+                # the consumer must see the producer's results only through one Explode each
+                if any(arg in defined for statement in consumer.explodedatas + consumer.statements for arg in statement.args):
+                    continue
+                if any(len([x for x in consumer.explodes if x.data == column]) > 1 for column in defined):
+                    continue
+
+                averageSize = DependencyGraph.averageSize(query, consumer.plateauSize)
+                if averageSize is None or len(producer.statements) * averageSize >= len(producer.statements) + roundTripCost * len(defined):
+                    continue
+
+                DependencyGraph._inline(producer, consumer, schemas, newname)
+
+                for key in list(loops.keys()):
+                    if producer in loops[key]:
+                        loops[key].remove(producer)
+                        if len(loops[key]) == 0:
+                            del loops[key]
+
+                changed = True
+                break
+
+    @staticmethod
+    def _inline(producer, consumer, schemas, newname):
+        tosize = consumer.plateauSize
+        defined = producer.defines()
+
+        # producer's results take the names that the consumer's Explodes gave them
+        rename = {}
+        for explode in list(consumer.explodes):
+            if explode.data in defined:
+                rename[explode.data] = explode.column
+                consumer.explodes.remove(explode)
+
+        # producer's inputs are exploded into the consumer instead
+        for statement in producer.statements:
+            for arg in statement.args:
+                if isinstance(arg, ColumnName) and arg not in defined and arg not in rename:
+                    existing = [x for x in consumer.explodes if x.data == arg]
+                    if len(existing) > 0:
+                        rename[arg] = existing[0].column
+                    else:
+                        explode = statementlist.Explode(newname(), schemas[arg], arg, tosize)
+                        consumer.explodes.append(explode)
+                        rename[arg] = explode.column
+
+        fused = []
+        for statement in producer.statements:
+            if statement.column not in rename:
+                rename[statement.column] = newname()
+            args = [rename.get(x, x) if isinstance(x, ColumnName) else x for x in statement.args]
+
+            if isinstance(statement, statementlist.IsType):
+                fused.append(statementlist.IsType(rename[statement.column], tosize, args[0], statement.fromtype, statement.totype, statement.negate))
+            else:
+                fused.append(statementlist.Call(rename[statement.column], statement.schema, tosize, statement.fcnname, args))
+
+        consumer.statements[:0] = fused
+
+    @staticmethod
+    def cost(loop):
+        # rough work per entry: statements times nesting depth
+        return (len(loop.statements) + len(loop.explodes) + len(loop.explodedatas)) * (1 + len(loop.explosions))
+
+    @staticmethod
+    def feeding(columns, loops, provided):
+        # loops that must run before these columns exist
+        out = []
+        tofind = set(columns).difference(provided)
+        while len(tofind) > 0:
+            column = tofind.pop()
+            for loop in loops:
+                if column in loop.defines() and loop not in out:
+                    out.append(loop)
+                    tofind.update(loop.needs().difference(provided))
+        return out
+
     @staticmethod
     def order(loops, actions, required):
         toadd = sum(loops.values(), [])
         provided = set(required)
 
+        # non-aggregation actions (e.g. filters) go in as soon as their columns exist, and the loops
+        # they depend on are preferred, so that they can cut down the work of everything after them
+        early = [x for x in actions if not isinstance(x, statementlist.Aggregation)]
+
         order = []
-        while len(toadd) > 0:
+        while len(toadd) > 0 or len(early) > 0:
+            for action in list(early):
+                if set(action.columns()).issubset(provided):
+                    order.append(action)
+                    early.remove(action)
+
+            if len(toadd) == 0:
+                assert len(early) == 0, "actions need columns that no loop defines: {0}".format(early)
+                break
+
             canadd = [loop for loop in toadd if loop.needs().issubset(provided)]
             assert len(canadd) > 0
 
-            # FIXME: put logic here to allow "Filter" actions to run as early as possible
-            choice = canadd[0]
+            urgent = []
+            for action in early:
+                urgent.extend(DependencyGraph.feeding(action.columns(), toadd, provided))
+
+            choice = min(canadd, key=lambda loop: (loop not in urgent, DependencyGraph.cost(loop), toadd.index(loop)))
             provided.update(choice.defines())
             order.append(choice)
             toadd.remove(choice)
@@ -287,6 +438,8 @@ class DataArray(NamedTypedParamNode): pass
 class OutDataArray(NamedTypedParamNode): pass
 
 class Loop(Serializable):
+    analyticLengths = True   # skip the prerun when output lengths follow from the size arrays alone
+
     def __init__(self, plateauSize):
         self.plateauSize = plateauSize
 
@@ -378,6 +531,16 @@ class Loop(Serializable):
         out.extend(self.statements)
         return out
 
+    def lengthSizes(self):
+        # if every explosion is a distinct, top-level collection, the output is a cartesian product of
+        # their sizes in each entry: return those size columns (otherwise None: lengths need a prerun)
+        if self.explodesize is None or len(set(self.deepiToUnique)) != len(self.explosions):
+            return None
+        for deepi, explosion in enumerate(self.explosions):
+            if explosion.depth() != 1 or self.uniques[self.deepiToUnique[deepi]] != explosion.size():
+                return None
+        return [explosion.size() for explosion in self.explosions]
+
     def setExplosions(self, explosions):
         self.explosions = explosions
         self.deepiToUnique = []
@@ -757,6 +920,9 @@ def {fcnname}({params}):
                     needPrerun = True
                     break
 
+        if needPrerun and self.analyticLengths and self.lengthSizes() is not None:
+            needPrerun = False
+
         if needPrerun:
             prevalidNames = {}
             def prevalid(n):
@@ -905,11 +1071,16 @@ class LoopFunction(Serializable):
             return getattr(importlib.import_module(mod), cls).fromJson(obj)
 
 class Executor(Serializable):
+    fuseLoops = False     # see DependencyGraph.fuse
+    priority = 0          # for fetching this query's data: lower numbers are fetched sooner
+
     def __init__(self, query, debug):
         self.query = query
         targetsToEndpoints, lookup, self.required = DependencyGraph.wholedag(self.query)
 
         loops = DependencyGraph.loops(targetsToEndpoints.values())
+        if self.fuseLoops:
+            DependencyGraph.fuse(loops, self.query)
         self.order = DependencyGraph.order(loops, self.query.actions, self.required)
         self.compileLoops(debug)
 
@@ -985,6 +1156,21 @@ class Executor(Serializable):
         else:
             return [None] * length   # more useful error messages
 
+    def runLoop(self, loop, arguments):
+        loop.run(*arguments)
+
+    def explodedLengths(self, sizearrays, numEntries):
+        # same counting as the generated loop: one size per level reached, one datum per full combination
+        dataLength = 0
+        sizeLength = 0
+        for entry in range(numEntries):
+            product = 1
+            for sizearray in sizearrays:
+                sizeLength += product
+                product *= sizearray[entry]
+            dataLength += product
+        return int(dataLength), int(sizeLength)
+
     def printArrays(self, message, inarrays):
         print("\n" + message)
         for key in sorted(inarrays):
@@ -1041,11 +1227,19 @@ class Executor(Serializable):
                     if self.debug:
                         print("Computed dataLength: {0} sizeLength: {1}".format(dataLength, sizeLength))
 
-                else:
+                elif loop.plateauSize in columnLengths:
                     dataLength, sizeLength = columnLengths[loop.plateauSize]
                     if self.debug:
                         print("Already knew dataLength: {0} sizeLength: {1}".format(dataLength, sizeLength))
 
+                else:
+                    sizes = loop.lengthSizes()
+                    assert sizes is not None, "no prerun and no known lengths for {0}".format(loop.plateauSize)
+                    dataLength, sizeLength = self.explodedLengths([inarrays[x] for x in sizes], group.numEntries)
+                    columnLengths[loop.plateauSize] = dataLength, sizeLength
+                    if self.debug:
+                        print("Derived dataLength: {0} sizeLength: {1}".format(dataLength, sizeLength))
+
                 countdown[0] = group.numEntries
                 for i in range(1, len(countdown)):
                     countdown[i] = 0
@@ -1073,7 +1267,7 @@ class Executor(Serializable):
                 if self.debug:
                     print("Calling run with {0}".format(loop.run.parameters))
                 startTime = time.time()
-                loop.run(*arguments)
+                self.runLoop(loop, arguments)
                 totalTime += time.time() - startTime
 
                 if loop.explodesize is not None:
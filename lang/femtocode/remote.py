@@ -221,10 +221,13 @@ class RemoteSession(object):
     def source(self, name):
         return Source(self, self.metadata.dataset(name))
 
-    def submit(self, query, ondone=None, onupdate=None, debug=False, minpolldelay=0.5, maxpolldelay=60.0):
+    def submit(self, query, ondone=None, onupdate=None, debug=False, minpolldelay=0.5, maxpolldelay=60.0, priority=0):
         if debug:
             raise NotImplementedError
-        return FutureQueryResult(query, ondone, onupdate, self.submit_url, minpolldelay, maxpolldelay)
+        url = self.submit_url
+        if priority != 0:
+            url += "?priority={0}".format(int(priority))    # the query's JSON is also its identity, so not in there
+        return FutureQueryResult(query, ondone, onupdate, url, minpolldelay, maxpolldelay)
 
 ###############################################################
 
@@ -361,8 +361,8 @@ class TestSession(object):
     def _processArray(self, array, dataType):
         return array
 
-    def submit(self, query, ondone=None, onupdate=None, debug=False):
-        executor = self._makeExecutor(query, debug)
+    def submit(self, query, ondone=None, onupdate=None, debug=False, priority=0):
+        executor = self._makeExecutor(query, debug)   # (runs immediately: priority doesn't matter)
         action = query.actions[-1]
         assert isinstance(action, statementlist.Aggregation), "last action must always be an aggregation"
 
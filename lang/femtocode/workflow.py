@@ -237,8 +237,8 @@ class Goal(NotFirst, Workflow):
 
         return Query(source.dataset, libs, inputs, statements, actions, False, self)
 
-    def submit(self, ondone=None, onupdate=None, libs=(), debug=False):
-        return self.source().session.submit(self.compile(libs), ondone, onupdate, debug)
+    def submit(self, ondone=None, onupdate=None, libs=(), debug=False, priority=0):
+        return self.source().session.submit(self.compile(libs), ondone, onupdate, debug, priority=priority)
 
 ############### Intermediates
 
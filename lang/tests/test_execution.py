@@ -122,6 +122,39 @@ class TestExecution(unittest.TestCase):
         for old, new in zip(oldexample.dataset, session.submit(query)):
             self.assertEqual(mapp(old.xss, lambda xs: mapp(old.ys, lambda y: mapp(xs, lambda x: x + y))), new.a)
 
+    def test_analytic_lengths(self):
+        query = oldexample.toPython(a = "ys.map(y1 => ys2.map(y2 => y1 + y2))").compile()
+
+        def makeLoop():
+            loop = Loop(ColumnName.parse("#0@size"))
+            for statement in query.statements:
+                loop.newStatement(statement)
+            loop.newTarget(ColumnName.parse("#2"))
+            return loop
+
+        loop = makeLoop()
+        self.assertEqual(loop.lengthSizes(), [ColumnName.parse("ys[]@size"), ColumnName.parse("ys2[]@size")])
+        loop.compileToPython("fcnname", {}, StandardLibrary.table, False, False)
+        self.assertEqual(loop.prerun, None)
+
+        class PrerunLoop(Loop):
+            analyticLengths = False
+        loop = makeLoop()
+        loop.__class__ = PrerunLoop
+        loop.compileToPython("fcnname", {}, StandardLibrary.table, False, False)
+
+        countdown = [oldexample.dataset.numEntries, 0, 0, 0, 0]
+        sarray_v0 = oldexample.dataset.groups[0].segments["ys[]"].size
+        sarray_v1 = oldexample.dataset.groups[0].segments["ys2[]"].size
+        loop.prerun.fcn(countdown, sarray_v0, sarray_v1)
+
+        executor = Executor.__new__(Executor)
+        self.assertEqual(executor.explodedLengths([sarray_v0, sarray_v1], oldexample.dataset.numEntries), (countdown[1], countdown[2]))
+        self.assertEqual(countdown[1:3], [32, 10])
+
+        for old, new in zip(oldexample.dataset, session.submit(query)):
+            self.assertEqual(mapp(old.ys, lambda y1: mapp(old.ys2, lambda y2: y1 + y2)), new.a)
+
     def test_minimal(self):
         query = oldexample.toPython(a = "c + d").compile()
         statements = query.statements
@@ -352,6 +385,75 @@ class TestExecution(unittest.TestCase):
             self.assertEqual(mapp(old.ys, lambda y: y + old.c), new.a)
             self.assertEqual(mapp(old.ys, lambda y: y + old.c), new.b)
 
+    def test_order(self):
+        query = oldexample.define(z = "c - d").toPython(a = "xss.map(xs => xs.map(x => x + z))", b = "ys.map(y => y + z)").compile()
+        targetsToEndpoints, lookup, required = DependencyGraph.wholedag(query)
+        order = DependencyGraph.order(DependencyGraph.loops(targetsToEndpoints.values()), query.actions, required)
+        self.assertEqual(len(order), 4)
+        self.assertEqual(order[0].plateauSize, None)
+        self.assertTrue(DependencyGraph.cost(order[1]) <= DependencyGraph.cost(order[2]))
+        self.assertTrue(isinstance(order[-1], statementlist.Aggregation))
+
+    def test_order_early(self):
+        query = oldexample.define(z = "c - d").toPython(a = "xss.map(xs => xs.map(x => x + z))", b = "ys.map(y => y + z)").compile()
+        targetsToEndpoints, lookup, required = DependencyGraph.wholedag(query)
+        loops = DependencyGraph.loops(targetsToEndpoints.values())
+        costly = max(sum(loops.values(), []), key=DependencyGraph.cost)
+
+        class Filter(object):
+            # stands in for a non-aggregation action on the costly loop's output
+            def columns(self):
+                return list(costly.defines())
+
+        early = Filter()
+        order = DependencyGraph.order(loops, [early] + query.actions, required)
+        self.assertEqual(len(order), 5)
+        self.assertEqual(order[0].plateauSize, None)
+        self.assertTrue(order[1] is costly)                  # ahead of the cheaper loop, because the filter needs it
+        self.assertTrue(order[2] is early)                   # as soon as its columns exist
+        self.assertTrue(DependencyGraph.cost(order[3]) < DependencyGraph.cost(costly))
+        self.assertTrue(isinstance(order[-1], statementlist.Aggregation))
+
+    def test_fusion(self):
+        self.assertFalse(Executor.fuseLoops)
+
+        # ys has 4 items per entry: recomputing z for each of them costs more than materializing it
+        query = oldexample.define(z = "c - d").toPython(b = "ys.map(y => y + z)").compile()
+        self.assertEqual(DependencyGraph.averageSize(query, ColumnName.parse("ys[]").size()), 4.0)
+        targetsToEndpoints, lookup, required = DependencyGraph.wholedag(query)
+        loops = DependencyGraph.loops(targetsToEndpoints.values())
+        self.assertEqual(len(sum(loops.values(), [])), 2)
+        DependencyGraph.fuse(loops, query)
+        self.assertEqual(len(sum(loops.values(), [])), 2)
+
+        # with small collections, it's cheaper to recompute
+        small = TestSession().source("Small", ys=collection(integer), c=integer, d=integer)
+        for i in range(10):
+            small.dataset.fill({"ys": [i] if i % 2 == 0 else [], "c": i, "d": 2*i})
+
+        query = small.define(z = "c - d").toPython(b = "ys.map(y => y + z)").compile()
+        targetsToEndpoints, lookup, required = DependencyGraph.wholedag(query)
+        loops = DependencyGraph.loops(targetsToEndpoints.values())
+        DependencyGraph.fuse(loops, query)
+        self.assertEqual(len(sum(loops.values(), [])), 1)
+
+        class FusingExecutor(Executor):
+            fuseLoops = True
+
+        class FusingSession(TestSession):
+            def _makeExecutor(self, query, debug):
+                return FusingExecutor(query, debug)
+
+        for old, new in zip(small.dataset, FusingSession().submit(query)):
+            self.assertEqual(mapp(old.ys, lambda y: y + (old.c - old.d)), new.b)
+
+        # z is exploded into two loops, so it has to be materialized
+        query = oldexample.define(z = "c - d").toPython(a = "xss.map(xs => xs.map(x => x + z))", b = "ys.map(y => y + z)").compile()
+        targetsToEndpoints, lookup, required = DependencyGraph.wholedag(query)
+        loops = DependencyGraph.loops(targetsToEndpoints.values())
+        DependencyGraph.fuse(loops, query, roundTripCost=100.0)
+        self.assertEqual(len(sum(loops.values(), [])), 3)
+
     def test_submit(self):
         session = TestSession()
 
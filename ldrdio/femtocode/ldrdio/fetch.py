@@ -21,6 +21,9 @@ import numpy
 from femtocode.run.cache import CacheOccupant
 
 class LDRDFetcher(threading.Thread):
+    refetchCost = 10.0            # relative to other fetchers, for cost-aware eviction: goes over HTTP
+    concurrency = 4               # threads in a FetcherPool
+
     def __init__(self, occupants, workItem):
         super(LDRDFetcher, self).__init__()
 
@@ -15,9 +15,11 @@
 # limitations under the License.
 
 import ast
+import sys
 import struct
 import threading
 import zipfile
+from functools import reduce
 try:
     from urllib2 import urlparse
     urlparse = urlparse.urlparse
@@ -31,9 +33,18 @@ from femtocode.dataset import ColumnName
 from femtocode.dataset import sizeType
 from femtocode.execution import ExecutionFailure
 from femtocode.numpyio.xrootd import XRootDReader
+from femtocode.run.cache import CacheOccupant
 
 class NumpyFetcher(threading.Thread):
-    chunksize = 1024
+    # Uncompressed members of local files are mapped, not copied (mmap), so the cache holds maps of the user's files.
+    # Rewriting or truncating a file under such a map would crash the process (SIGBUS) if it were read, so the
+    # occupant records the file's stamp and NeedWantCache fetches it again if the stamp has changed when it's reused.
+    # A file changed while a query is running on it can still do this; set mmap = False to always copy.
+    chunksize = 16*1024**2        # members that have to be read (compressed or remote) are read in large pieces
+    mmap = True                   # members stored uncompressed in local files are mapped, not read
+    refetchCost = 1.0             # relative to other fetchers, for cost-aware eviction (see run.cache)
+    remoteRefetchCost = 10.0      # if any of the files are read through XRootD
+    concurrency = 8               # threads in a FetcherPool
 
     def __init__(self, occupants, workItem):
         super(NumpyFetcher, self).__init__()
@@ -41,6 +52,12 @@ class NumpyFetcher(threading.Thread):
         self.workItem = workItem
         self.daemon = True
 
+        try:
+            if any(urlparse(fileName).scheme == "root" for occupant in self.occupants for fileName in self.files(occupant.address.column)):
+                self.refetchCost = self.remoteRefetchCost
+        except Exception:
+            pass     # run reports it as a fetch failure
+
     def files(self, column):
         out = None
         if column.issize():
@@ -55,6 +72,38 @@ class NumpyFetcher(threading.Thread):
             out = self.workItem.group.files
         return out
 
+    @staticmethod
+    def _readHeader(stream):
+        # returns dtype, number of data bytes, and number of header bytes before the data
+        assert stream.read(6) == b"\x93NUMPY"
+
+        version = struct.unpack("bb", stream.read(2))
+        if version[0] == 1:
+            headerlen, = struct.unpack("<H", stream.read(2))
+            headerBytes = 10 + headerlen
+        else:
+            headerlen, = struct.unpack("<I", stream.read(4))
+            headerBytes = 12 + headerlen
+
+        header = stream.read(headerlen)
+        if not isinstance(header, str):
+            header = header.decode("latin-1")
+        headerdata = ast.literal_eval(header)
+
+        dtype = numpy.dtype(headerdata["descr"])
+        numBytes = reduce(lambda a, b: a * b, (dtype.itemsize,) + headerdata["shape"])
+        return dtype, numBytes, headerBytes
+
+    @staticmethod
+    def _memberOffset(fileName, info):
+        # the local file header has its own (variable) lengths, which may differ from the central directory's
+        with open(fileName, "rb") as file:
+            file.seek(info.header_offset)
+            local = file.read(30)
+        assert local[:4] == b"PK\x03\x04"
+        nameLength, extraLength = struct.unpack("<HH", local[26:30])
+        return info.header_offset + 30 + nameLength + extraLength
+
     def run(self):
         try:
             filesToOccupants = {}
@@ -68,30 +117,30 @@ class NumpyFetcher(threading.Thread):
             for fileName, occupants in filesToOccupants.items():
                 protocol = urlparse(fileName).scheme
                 if protocol == "":
-                    zf = zipfile.ZipFile(open(fileName, "rb"))
+                    zf = zipfile.ZipFile(fileName)     # closes the file when zf is closed
                 elif protocol == "root":
                     zf = zipfile.ZipFile(XRootDReader(fileName))
                 else:
                     raise NotImplementedError
 
                 for occupant in occupants:
-                    stream = zf.open(str(occupant.address.column) + ".npy")
-                    assert stream.read(6) == "\x93NUMPY"
-
-                    version = struct.unpack("bb", stream.read(2))
-                    if version[0] == 1:
-                        headerlen, = struct.unpack("<H", stream.read(2))
-                    else:
-                        headerlen, = struct.unpack("<I", stream.read(4))
-
-                    header = stream.read(headerlen)
-                    headerdata = ast.literal_eval(header)
-
-                    dtype = numpy.dtype(headerdata["descr"])
-                    numBytes = reduce(lambda a, b: a * b, (dtype.itemsize,) + headerdata["shape"])
+                    info = zf.getinfo(str(occupant.address.column) + ".npy")
+                    stream = zf.open(info)
+                    dtype, numBytes, headerBytes = self._readHeader(stream)
 
                     assert occupant.totalBytes == numBytes
 
+                    if self.mmap and protocol == "" and info.compress_type == zipfile.ZIP_STORED and numBytes > 0:
+                        offset = self._memberOffset(fileName, info) + headerBytes
+                        if offset % dtype.alignment == 0:
+                            # copy-on-write: writable, as Numba signatures require, but never written back
+                            occupant.adopt(numpy.memmap(fileName, dtype=CacheOccupant.untyped, mode="c", offset=offset, shape=(numBytes,)), fileName)
+                        else:
+                            # compiled code requires aligned arrays (numpy.savez doesn't align): one copy, no Python loop
+                            occupant.rawarray[:] = numpy.memmap(fileName, dtype=CacheOccupant.untyped, mode="r", offset=offset, shape=(numBytes,))
+                            occupant.setfilled(numBytes)
+                        continue
+
                     readBytes = 0
                     while readBytes < numBytes:
                         size = min(self.chunksize, numBytes - readBytes)
@@ -102,5 +151,4 @@ class NumpyFetcher(threading.Thread):
 
         except Exception as exception:
             for occupant in self.occupants:
-                with occupant.lock:
-                    occupant.fetchfailure = ExecutionFailure(exception, sys.exc_info()[2])
+                occupant.setfailure(ExecutionFailure(exception, sys.exc_info()[2]))
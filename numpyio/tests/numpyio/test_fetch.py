@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Copyright 2016 DIANA-HEP
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import numpy
+
+from femtocode.dataset import ColumnName
+from femtocode.numpyio.dataset import NumpyColumn
+from femtocode.numpyio.dataset import NumpyDataset
+from femtocode.numpyio.dataset import NumpyGroup
+from femtocode.numpyio.dataset import NumpySegment
+from femtocode.numpyio.fetch import NumpyFetcher
+from femtocode.run.cache import CacheOccupant
+from femtocode.run.cache import Prefetch
+from femtocode.run.compute import DataAddress
+from femtocode.run.compute import WorkItem
+
+class TestFetch(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.arrays = {"x": numpy.arange(1000, dtype=numpy.float64) * 1.1,
+                       "y": (numpy.arange(1000) % 7).astype(numpy.int32),
+                       "b": numpy.arange(1000) % 3 == 0,
+                       "empty": numpy.array([], dtype=numpy.float64)}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, fileName, columns):
+        expected = numpy.load(fileName)
+
+        # one group: every column is in the group's file
+        names = dict((column, ColumnName.parse(column)) for column in columns)
+        group = NumpyGroup(0, dict((names[column], NumpySegment(len(expected[column]), len(expected[column]), 0, None)) for column in columns), 1000, [fileName])
+        dataset = NumpyDataset("dataset", None, dict((names[column], NumpyColumn(names[column], None, str(expected[column].dtype))) for column in columns), [group], 1000, 1)
+        workItem = WorkItem(Prefetch(dataset, columns), group)
+
+        occupants = [CacheOccupant(DataAddress("dataset", names[column], 0), expected[column].nbytes, expected[column].dtype, CacheOccupant.allocate) for column in columns]
+        NumpyFetcher(occupants, workItem).run()
+
+        for column, occupant in zip(columns, occupants):
+            self.assertEqual(occupant.fetchfailure, None)
+            self.assertTrue(occupant.ready())
+            self.assertEqual(occupant.array().dtype, expected[column].dtype)
+            self.assertEqual(occupant.array().tolist(), expected[column].tolist())
+            self.assertEqual(occupant.array().ctypes.data % occupant.dtype.alignment, 0)
+        expected.close()
+        return dict(zip(columns, occupants))
+
+    def dataOffset(self, fileName, column):
+        zf = zipfile.ZipFile(fileName)
+        info = zf.getinfo(column + ".npy")
+        dtype, numBytes, headerBytes = NumpyFetcher._readHeader(zf.open(info))
+        zf.close()
+        return NumpyFetcher._memberOffset(fileName, info) + headerBytes
+
+    def test_stored(self):
+        fileName = os.path.join(self.directory, "stored.npz")
+        numpy.savez(fileName, **self.arrays)
+        occupants = self.fetch(fileName, sorted(self.arrays))
+
+        # single-byte types are always aligned: mapped, not copied
+        self.assertTrue(isinstance(occupants["b"].rawarray, numpy.memmap))
+
+        for column in "x", "y":
+            aligned = self.dataOffset(fileName, column) % self.arrays[column].dtype.alignment == 0
+            self.assertEqual(isinstance(occupants[column].rawarray, numpy.memmap), aligned)
+
+        # maps know their file, so that the cache won't reuse them once it's been rewritten
+        self.assertEqual(occupants["b"].sourceFile, fileName)
+        self.assertFalse(occupants["b"].stale())
+        numpy.savez(fileName, b=self.arrays["b"][:10])
+        self.assertTrue(occupants["b"].stale())
+        self.assertFalse(occupants["empty"].stale())
+
+    def test_unaligned(self):
+        # numpy.savez doesn't align members; write one that is certainly misaligned for float64
+        fileName = os.path.join(self.directory, "unaligned.npz")
+        npy = io.BytesIO()
+        numpy.lib.format.write_array(npy, self.arrays["x"])
+        zf = zipfile.ZipFile(fileName, "w", zipfile.ZIP_STORED)
+        zf.writestr("x.npy", npy.getvalue())
+        zf.close()
+        self.assertNotEqual(self.dataOffset(fileName, "x") % 8, 0)
+
+        occupants = self.fetch(fileName, ["x"])
+        self.assertFalse(isinstance(occupants["x"].rawarray, numpy.memmap))
+
+    def test_compressed(self):
+        fileName = os.path.join(self.directory, "compressed.npz")
+        numpy.savez_compressed(fileName, **self.arrays)
+
+        chunksize = NumpyFetcher.chunksize
+        NumpyFetcher.chunksize = 1000    # several chunks per member
+        try:
+            occupants = self.fetch(fileName, sorted(self.arrays))
+        finally:
+            NumpyFetcher.chunksize = chunksize
+
+        for occupant in occupants.values():
+            self.assertFalse(isinstance(occupant.rawarray, numpy.memmap))
+
+    def test_nommap(self):
+        fileName = os.path.join(self.directory, "stored.npz")
+        numpy.savez(fileName, **self.arrays)
+
+        NumpyFetcher.mmap = False
+        try:
+            occupants = self.fetch(fileName, sorted(self.arrays))
+        finally:
+            NumpyFetcher.mmap = True
+
+        for occupant in occupants.values():
+            self.assertFalse(isinstance(occupant.rawarray, numpy.memmap))
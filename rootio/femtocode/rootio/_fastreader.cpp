@@ -14,16 +14,33 @@
 
 #include <vector>
 #include <string>
+#include <cstring>
+#include <memory>
 
 #include <Python.h>
 #include <numpy/arrayobject.h>
 
+#include <TROOT.h>
 #include <TFile.h>
 #include <TError.h>
 #include <TTree.h>
 #include <TLeaf.h>
 #include <TBranch.h>
 #include <TBranchElement.h>
+#include <TBufferFile.h>
+#include <RVersion.h>
+
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,14,0)
+#define FASTREADER_BULK      // TBranch::GetBulkRead
+#endif
+
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,6,0)
+#define FASTREADER_THREADSAFE    // ROOT::EnableThreadSafety
+#else
+#include <TThread.h>
+#endif
+
+static const Long64_t cacheBytes = 30*1024*1024;    // TTreeCache for the requested branches only
 
 static char module_docstring[] = "Simple, streamlined Numpy array-filling from ROOT.";
 static char fillarrays_docstring[] = "Fills N arrays at once from a ROOT file's TTree.\n\nparams:\n    fileName: string, can include root:// protocol\n    ttreeName: string, can include directory slashes\n    arrays: list of (string, array) or (string, string, array, array) tuples: (data name, data array) or (data name, size name, data array, size array). Arrays must be preallocated or pass None just to get the allocation size.\n\nreturns:\n    tuple of N+1 ints: total number of entries followed by the total number of each object.\n\nraises:\n    IndexError if more values are found in the ROOT file than are allocated in the array.";
@@ -53,15 +70,29 @@ static struct PyModuleDef moduledef = {
 
 PyMODINIT_FUNC PyInit__fastreader(void) {
   PyObject* module = PyModule_Create(&moduledef);
-  if (module != NULL)
+  if (module != NULL) {
     import_array();
+    // fillarrays is called from several threads at once (see ROOTFetcher)
+#ifdef FASTREADER_THREADSAFE
+    ROOT::EnableThreadSafety();
+#else
+    TThread::Initialize();
+#endif
+  }
   return module;
 }
 #else
 PyMODINIT_FUNC init_fastreader(void) {
   PyObject* module = Py_InitModule3("_fastreader", module_methods, module_docstring);
-  if (module != NULL)
+  if (module != NULL) {
     import_array();
+    // fillarrays is called from several threads at once (see ROOTFetcher)
+#ifdef FASTREADER_THREADSAFE
+    ROOT::EnableThreadSafety();
+#else
+    TThread::Initialize();
+#endif
+  }
 }
 #endif
 
@@ -82,6 +113,7 @@ public:
   int whichSize;
   char dataType;
   bool flat;
+  bool skip;
 
   BranchArrayInfo(void* dataPointer, void* sizePointer, char* dataName, char* sizeName, uint64_t dataLength, int64_t sizeLength, char dataType, bool flat, int whichSize):
     dataIndex(0),
@@ -97,13 +129,246 @@ public:
     sizeLength(sizeLength),
     whichSize(whichSize),
     dataType(dataType),
-    flat(flat) { }
+    flat(flat),
+    skip(false) { }
 
   ~BranchArrayInfo() {
-    if (bufferForEntry != NULL) delete bufferForEntry;
+    if (bufferForEntry != NULL) delete[] bufferForEntry;
   }
 };
 
+static int itemBytes(char dataType) {
+  switch (dataType) {
+  case 'B':  // numpy.uint8
+    return 1;
+  case 'f':  // numpy.float32
+  case 'i':  // numpy.int32
+  case 'I':  // numpy.uint32
+    return 4;
+  default:   // numpy.float64, numpy.int64, numpy.uint64
+    return 8;
+  }
+}
+
+class OpenTree {
+public:
+  TFile* tfile;
+  TTree* ttree;
+
+  OpenTree(const char* fileName, const char* treeName): tfile(NULL), ttree(NULL) {
+    Int_t oldLevel = gErrorIgnoreLevel;   // error message suppression is not thread safe
+    gErrorIgnoreLevel = kError;           // but oh well...
+    tfile = TFile::Open(fileName);
+    gErrorIgnoreLevel = oldLevel;         // FIXME: turn off more selectively?
+
+    if (tfile != NULL  &&  tfile->IsOpen())
+      tfile->GetObject(treeName, ttree);
+  }
+
+  ~OpenTree() {
+    if (tfile != NULL) {
+      tfile->Close();                     // also deletes the TTree
+      delete tfile;
+    }
+  }
+};
+
+#ifdef FASTREADER_BULK
+// ROOT serializes big-endian; NumPy arrays are in native order
+static void byteswap(char* data, Long64_t count, int size) {
+#ifdef R__BYTESWAP
+  Long64_t j;
+  switch (size) {
+  case 4:
+    for (j = 0;  j < count;  j++)
+      ((uint32_t*)data)[j] = __builtin_bswap32(((uint32_t*)data)[j]);
+    break;
+  case 8:
+    for (j = 0;  j < count;  j++)
+      ((uint64_t*)data)[j] = __builtin_bswap64(((uint64_t*)data)[j]);
+    break;
+  }
+#endif
+}
+
+// a whole basket at a time, copied straight into the array (only for branches of one fixed-size leaf)
+static const char* bulkread(BranchArrayInfo& info, Long64_t numEntries) {
+  int size = itemBytes(info.dataType);
+  TBufferFile buffer(TBuffer::kWrite, 32*1024);
+
+  Long64_t entry = 0;
+  while (entry < numEntries) {
+    Int_t count = info.dataBranch->GetBulkRead().GetEntriesSerialized(entry, buffer);
+    if (count <= 0)
+      return "could not read TBasket";
+    if (info.dataIndex + count > info.dataLength)
+      return "ROOT file data is bigger than data array";
+
+    char* destination = (char*)(info.dataPointer) + info.dataIndex * size;
+    memcpy(destination, buffer.GetCurrent(), count * size);
+    byteswap(destination, count, size);
+
+    info.dataIndex += count;
+    entry += count;
+  }
+  return NULL;
+}
+#endif
+
+// called without the GIL: touches only ROOT and the arrays' memory, returns an error message or NULL
+static const char* readarrays(const char* fileName, const char* treeName, std::vector<BranchArrayInfo>& branchArrayInfos, int numArraysToLoad, Long64_t& numEntries) {
+  int numArrays = branchArrayInfos.size();
+
+  OpenTree opened(fileName, treeName);
+  if (opened.tfile == NULL  ||  !opened.tfile->IsOpen())
+    return "could not open file";
+  TTree* ttree = opened.ttree;
+  if (ttree == NULL)
+    return "bad or missing TTree";
+
+  for (int i = 0;  i < numArrays;  i++) {
+    TBranch* dataBranch = ttree->GetBranch(branchArrayInfos[i].dataName);
+    if (dataBranch == NULL)
+      return "bad or missing TBranch";
+    branchArrayInfos[i].dataBranch = dataBranch;
+  }
+
+  numEntries = ttree->GetEntries();
+  if (numArraysToLoad == 0)
+    return NULL;
+
+  // read ahead only the requested branches, in large, sequential requests
+  ttree->SetCacheSize(cacheBytes);
+  for (int i = 0;  i < numArrays;  i++) {
+    ttree->AddBranchToCache(branchArrayInfos[i].dataBranch, kTRUE);
+    if (!branchArrayInfos[i].flat)
+      ttree->AddBranchToCache(branchArrayInfos[i].sizeName, kTRUE);
+  }
+  ttree->StopCacheLearningPhase();
+
+  bool anyByEntry = false;
+  for (int i = 0;  i < numArrays;  i++) {
+    if (branchArrayInfos[i].flat  &&  branchArrayInfos[i].dataPointer == NULL)
+      branchArrayInfos[i].skip = true;    // nothing to fill and no length to count
+
+#ifdef FASTREADER_BULK
+    else if (branchArrayInfos[i].flat  &&
+             branchArrayInfos[i].dataBranch->SupportsBulkRead()  &&
+             ((TLeaf*)(branchArrayInfos[i].dataBranch->GetListOfLeaves()->First()))->GetLenType() == itemBytes(branchArrayInfos[i].dataType)) {
+      const char* error = bulkread(branchArrayInfos[i], numEntries);
+      if (error != NULL)
+        return error;
+      branchArrayInfos[i].skip = true;
+    }
+#endif
+
+    else
+      anyByEntry = true;
+  }
+  if (!anyByEntry)
+    return NULL;
+
+  // fragile: the placement of this function call matters
+  ttree->SetMakeClass(1);
+
+  for (int i = 0;  i < numArrays;  i++) {
+    if (branchArrayInfos[i].skip)
+      continue;
+
+    int dataItemBytes = ((TLeaf*)(branchArrayInfos[i].dataBranch->GetListOfLeaves()->First()))->GetLenType();
+
+    if (branchArrayInfos[i].flat) {
+      branchArrayInfos[i].bufferForEntry = new char[2 * dataItemBytes];
+
+      ttree->SetBranchAddress(branchArrayInfos[i].dataName, branchArrayInfos[i].bufferForEntry);
+    }
+
+    else {
+      if (!branchArrayInfos[i].dataBranch->IsA()->InheritsFrom("TBranchElement"))
+        return "non-flat data should be a TBranchElement";
+      TBranchElement *branchElement = (TBranchElement*)branchArrayInfos[i].dataBranch;
+
+      int bufferSize = ((TLeaf*)(branchElement->GetListOfLeaves()->First()))->GetLeafCount()->GetMaximum();
+      branchArrayInfos[i].bufferForEntry = new char[bufferSize * 2 * dataItemBytes];
+
+      ttree->SetBranchAddress(branchArrayInfos[i].dataName, branchArrayInfos[i].bufferForEntry);
+      if (branchArrayInfos[i].whichSize == i)
+        ttree->SetBranchAddress(branchArrayInfos[i].sizeName, &(branchArrayInfos[i].sizeForEntry));
+    }
+  }
+
+  Long64_t entry;
+  int i;
+  uint64_t sizeForEntry = 0;
+
+  for (entry = 0;  entry < numEntries;  entry++) {
+    for (i = 0;  i < numArrays;  i++) {
+      if (branchArrayInfos[i].skip)
+        continue;
+
+      branchArrayInfos[i].dataBranch->GetEntry(entry);
+
+      if (branchArrayInfos[i].dataPointer == NULL) {
+        branchArrayInfos[i].dataLength += branchArrayInfos[branchArrayInfos[i].whichSize].sizeForEntry;
+      }
+      else {
+        if (branchArrayInfos[i].flat) {
+          if (branchArrayInfos[i].dataIndex < branchArrayInfos[i].dataLength) {
+            switch (branchArrayInfos[i].dataType) {
+            case 'B':  // numpy.uint8
+              ((uint8_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((uint8_t*)branchArrayInfos[i].bufferForEntry)[0];
+              break;
+            case 'd':  // numpy.float64
+              ((double*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((double*)branchArrayInfos[i].bufferForEntry)[0];
+              break;
+            case 'l':  // numpy.int64
+              ((int64_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((int64_t*)branchArrayInfos[i].bufferForEntry)[0];
+              break;
+            case 'L':  // numpy.uint64
+              ((uint64_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((uint64_t*)branchArrayInfos[i].bufferForEntry)[0];
+              break;
+            case 'f':  // numpy.float32
+              ((float*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((float*)branchArrayInfos[i].bufferForEntry)[0];
+              break;
+            case 'i':  // numpy.int32
+              ((int32_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((int32_t*)branchArrayInfos[i].bufferForEntry)[0];
+              break;
+            case 'I':  // numpy.uint32
+              ((uint32_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((uint32_t*)branchArrayInfos[i].bufferForEntry)[0];
+              break;
+            }
+          }
+          else
+            return "ROOT file data is bigger than data array";
+        }
+
+        else {
+          sizeForEntry = branchArrayInfos[branchArrayInfos[i].whichSize].sizeForEntry;
+
+          if (branchArrayInfos[i].whichSize == i) {
+            if (branchArrayInfos[i].sizePointer != NULL) {
+              if (branchArrayInfos[i].sizeIndex < branchArrayInfos[i].sizeLength)
+                ((uint64_t*)(branchArrayInfos[i].sizePointer))[branchArrayInfos[i].sizeIndex++] = sizeForEntry;
+              else
+                return "ROOT file size is bigger than size array";
+            }
+          }
+
+          if (branchArrayInfos[i].dataIndex + sizeForEntry > branchArrayInfos[i].dataLength)
+            return "ROOT file data is bigger than data array";
+
+          // the entry's items are contiguous in both buffers
+          int size = itemBytes(branchArrayInfos[i].dataType);
+          memcpy((char*)(branchArrayInfos[i].dataPointer) + branchArrayInfos[i].dataIndex * size, branchArrayInfos[i].bufferForEntry, sizeForEntry * size);
+          branchArrayInfos[i].dataIndex += sizeForEntry;
+        }
+      }
+    }
+  }
+
+  return NULL;
+}
+
 static PyObject* fillarrays(PyObject* self, PyObject* args) {
   char* fileName;
   char* treeName;
@@ -239,172 +504,19 @@ static PyObject* fillarrays(PyObject* self, PyObject* args) {
     branchArrayInfos.push_back(BranchArrayInfo(dataPointer, sizePointer, dataName, sizeName, dataLength, sizeLength, dataType, flat, whichSize));
   }
 
-  PyThreadState *_save;
-  _save = PyEval_SaveThread();
+  const char* error;
+  Long64_t numEntries = 0;
 
-  // FIXME: Are the ROOT references new? borrowed? stolen?
+  Py_BEGIN_ALLOW_THREADS
+  error = readarrays(fileName, treeName, branchArrayInfos, numArraysToLoad, numEntries);
+  Py_END_ALLOW_THREADS
 
-  Int_t oldLevel = gErrorIgnoreLevel;   // error message suppression is not thread safe
-  gErrorIgnoreLevel = kError;           // but oh well...
-  TFile* tfile = TFile::Open(fileName);
-  gErrorIgnoreLevel = oldLevel;         // FIXME: turn off more selectively?
-
-  if (tfile == NULL  ||  !tfile->IsOpen()) {
-    PyEval_RestoreThread(_save);
-    PyErr_SetString(PyExc_IOError, "could not open file");
+  if (error != NULL) {
+    PyErr_SetString(PyExc_IOError, error);
     return NULL;
   }
 
-  TTree* ttree;
-  tfile->GetObject(treeName, ttree);
-  if (ttree == NULL) {
-    PyEval_RestoreThread(_save);
-    PyErr_SetString(PyExc_IOError, "bad or missing TTree");
-    return NULL;
-  }
-
-  for (int i = 0;  i < numArrays;  i++) {
-    TBranch* dataBranch = ttree->GetBranch(branchArrayInfos[i].dataName);
-    if (dataBranch == NULL) {
-      PyEval_RestoreThread(_save);
-      PyErr_SetString(PyExc_IOError, "bad or missing TBranch");
-      return NULL;
-    }
-    branchArrayInfos[i].dataBranch = dataBranch;
-  }
-
-  // fragile: the placement of this function call matters
-  ttree->SetMakeClass(1);
-
-  for (int i = 0;  i < numArrays;  i++) {
-    int dataItemBytes = ((TLeaf*)(branchArrayInfos[i].dataBranch->GetListOfLeaves()->First()))->GetLenType();
-
-    if (branchArrayInfos[i].flat) {
-      branchArrayInfos[i].bufferForEntry = new char[2 * dataItemBytes];
-
-      ttree->SetBranchAddress(branchArrayInfos[i].dataName, branchArrayInfos[i].bufferForEntry);
-    }
-
-    else {
-      if (!branchArrayInfos[i].dataBranch->IsA()->InheritsFrom("TBranchElement")) {
-        PyEval_RestoreThread(_save);
-        PyErr_SetString(PyExc_IOError, "non-flat data should be a TBranchElement");
-        return NULL;
-      }
-      TBranchElement *branchElement = (TBranchElement*)branchArrayInfos[i].dataBranch;
-
-      int bufferSize = ((TLeaf*)(branchElement->GetListOfLeaves()->First()))->GetLeafCount()->GetMaximum();
-      branchArrayInfos[i].bufferForEntry = new char[bufferSize * 2 * dataItemBytes];
-
-      ttree->SetBranchAddress(branchArrayInfos[i].dataName, branchArrayInfos[i].bufferForEntry);
-      if (branchArrayInfos[i].whichSize == i)
-        ttree->SetBranchAddress(branchArrayInfos[i].sizeName, &(branchArrayInfos[i].sizeForEntry));
-    }
-  }
-
-  Long64_t numEntries = ttree->GetEntries();
-  Long64_t entry;
   int i;
-  uint64_t item;
-  uint64_t sizeForEntry = 0;
-
-  if (numArraysToLoad > 0) {
-    for (entry = 0;  entry < numEntries;  entry++) {
-      for (i = 0;  i < numArrays;  i++) {
-        branchArrayInfos[i].dataBranch->GetEntry(entry);
-
-        if (branchArrayInfos[i].dataPointer == NULL) {
-          branchArrayInfos[i].dataLength += branchArrayInfos[branchArrayInfos[i].whichSize].sizeForEntry;
-        }
-        else {
-          if (branchArrayInfos[i].flat) {
-            if (branchArrayInfos[i].dataIndex < branchArrayInfos[i].dataLength) {
-              switch (branchArrayInfos[i].dataType) {
-              case 'B':  // numpy.uint8
-                ((uint8_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((uint8_t*)branchArrayInfos[i].bufferForEntry)[0];
-                break;
-              case 'd':  // numpy.float64
-                ((double*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((double*)branchArrayInfos[i].bufferForEntry)[0];
-                break;
-              case 'l':  // numpy.int64
-                ((int64_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((int64_t*)branchArrayInfos[i].bufferForEntry)[0];
-                break;
-              case 'L':  // numpy.uint64
-                ((uint64_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((uint64_t*)branchArrayInfos[i].bufferForEntry)[0];
-                break;
-              case 'f':  // numpy.float32
-                ((float*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((float*)branchArrayInfos[i].bufferForEntry)[0];
-                break;
-              case 'i':  // numpy.int32
-                ((int32_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((int32_t*)branchArrayInfos[i].bufferForEntry)[0];
-                break;
-              case 'I':  // numpy.uint32
-                ((uint32_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((uint32_t*)branchArrayInfos[i].bufferForEntry)[0];
-                break;
-              }
-            }
-            else {
-              PyEval_RestoreThread(_save);
-              PyErr_SetString(PyExc_IOError, "ROOT file data is bigger than data array");
-              return NULL;
-            }
-          }
-
-          else {
-            sizeForEntry = branchArrayInfos[branchArrayInfos[i].whichSize].sizeForEntry;
-
-            if (branchArrayInfos[i].whichSize == i) {
-              if (branchArrayInfos[i].sizePointer != NULL) {
-                if (branchArrayInfos[i].sizeIndex < branchArrayInfos[i].sizeLength)
-                  ((uint64_t*)(branchArrayInfos[i].sizePointer))[branchArrayInfos[i].sizeIndex++] = sizeForEntry;
-                else {
-                  PyEval_RestoreThread(_save);
-                  PyErr_SetString(PyExc_IOError, "ROOT file size is bigger than size array");
-                  return NULL;
-                }
-              }
-            }
-
-            for (item = 0;  item < sizeForEntry;  item++) {
-              if (branchArrayInfos[i].dataIndex < branchArrayInfos[i].dataLength) {
-                switch (branchArrayInfos[i].dataType) {
-                case 'B':  // numpy.uint8
-                  ((uint8_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((uint8_t*)branchArrayInfos[i].bufferForEntry)[item];
-                  break;
-                case 'd':  // numpy.float64
-                  ((double*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((double*)branchArrayInfos[i].bufferForEntry)[item];
-                  break;
-                case 'l':  // numpy.int64
-                  ((int64_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((int64_t*)branchArrayInfos[i].bufferForEntry)[item];
-                  break;
-                case 'L':  // numpy.uint64
-                  ((uint64_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((uint64_t*)branchArrayInfos[i].bufferForEntry)[item];
-                  break;
-                case 'f':  // numpy.float32
-                  ((float*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((float*)branchArrayInfos[i].bufferForEntry)[item];
-                  break;
-                case 'i':  // numpy.int32
-                  ((int32_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((int32_t*)branchArrayInfos[i].bufferForEntry)[item];
-                  break;
-                case 'I':  // numpy.uint32
-                  ((uint32_t*)(branchArrayInfos[i].dataPointer))[branchArrayInfos[i].dataIndex++] = ((uint32_t*)branchArrayInfos[i].bufferForEntry)[item];
-                  break;
-                }
-              }
-              else {
-                PyEval_RestoreThread(_save);
-                PyErr_SetString(PyExc_IOError, "ROOT file data is bigger than data array");
-                return NULL;
-              }
-            }
-          }
-        }
-      }
-    }
-  }
-
-  PyEval_RestoreThread(_save);
-
   PyObject* out = PyTuple_New(numArrays + 1);
   if (PyTuple_SetItem(out, 0, PyLong_FromLong(numEntries)) != 0) {
     PyErr_SetString(PyExc_IOError, "could not fill output tuple");
@@ -434,18 +546,18 @@ static PyObject* getsize(PyObject* self, PyObject* args) {
   }
   int numBranches = PySequence_Length(branches);
 
-  Int_t oldLevel = gErrorIgnoreLevel;   // error message suppression is not thread safe
-  gErrorIgnoreLevel = kError;           // but oh well...
-  TFile* tfile = TFile::Open(fileName);
-  gErrorIgnoreLevel = oldLevel;         // FIXME: turn off more selectively?
+  OpenTree* opened;
+  Py_BEGIN_ALLOW_THREADS
+  opened = new OpenTree(fileName, treeName);
+  Py_END_ALLOW_THREADS
+  std::unique_ptr<OpenTree> closer(opened);   // closes the file on every return
 
-  if (tfile == NULL  ||  !tfile->IsOpen()) {
+  if (opened->tfile == NULL  ||  !opened->tfile->IsOpen()) {
     PyErr_SetString(PyExc_IOError, "could not open file");
     return NULL;
   }
 
-  TTree* ttree;
-  tfile->GetObject(treeName, ttree);
+  TTree* ttree = opened->ttree;
   if (ttree == NULL) {
     PyErr_SetString(PyExc_IOError, "bad or missing TTree");
     return NULL;
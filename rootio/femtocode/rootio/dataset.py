@@ -15,6 +15,9 @@
 # limitations under the License.
 
 import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
 
 from femtocode.py23 import *
 from femtocode.dataset import ColumnName
@@ -25,6 +28,7 @@ from femtocode.dataset import Dataset
 from femtocode.rootio.declare import DatasetDeclaration
 from femtocode.rootio._fastreader import fillarrays
 from femtocode.rootio._fastreader import getsize
+from femtocode.rootio.xrootd import fileStat
 from femtocode.rootio.xrootd import filesFromPath
 from femtocode.typesystem import Schema
 from femtocode.rootio.fetch import ROOTFetcher
@@ -107,12 +111,66 @@ class ROOTColumn(Column):
     def __hash__(self):
         return hash(("ROOTColumn", self.data, self.size, self.dataType, self.tree, self.dataBranch, self.sizeBranch))
 
+class ROOTFileIndex(object):
+    # sidecar JSON file of per-file scan results (number of entries, size branch and length of each branch),
+    # valid as long as the file's modification time and size are unchanged
+    version = 1
+
+    def __init__(self, fileName=None):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.files = {}    # file -> {"stamp": [mtime, size], "trees": {tree: {"numEntries": n, "branches": {branch: [size, length]}}}}
+        self.changed = False
+
+        if fileName is not None and os.path.exists(fileName):
+            try:
+                with open(fileName) as file:
+                    index = json.load(file)
+            except ValueError:
+                index = {}      # unreadable: rebuild it
+            if index.get("version") == self.version:
+                self.files = index["files"]
+
+    def __repr__(self):
+        return "<ROOTFileIndex {0} files at 0x{1:012x}>".format(len(self.files), id(self))
+
+    def get(self, file, stamp, tree):
+        # {branch: [size, length]} and numEntries, or None, {} if the file has changed or hasn't been scanned
+        with self.lock:
+            entry = self.files.get(file)
+            if stamp is None or entry is None or entry["stamp"] != stamp or tree not in entry["trees"]:
+                return None, {}
+            return entry["trees"][tree]["numEntries"], dict(entry["trees"][tree]["branches"])
+
+    def put(self, file, stamp, tree, numEntries, branches):
+        if stamp is None:
+            return
+        with self.lock:
+            entry = self.files.get(file)
+            if entry is None or entry["stamp"] != stamp:
+                entry = self.files[file] = {"stamp": stamp, "trees": {}}
+            if tree not in entry["trees"] or entry["trees"][tree]["numEntries"] != numEntries:
+                entry["trees"][tree] = {"numEntries": numEntries, "branches": {}}
+            entry["trees"][tree]["branches"].update(branches)
+            self.changed = True
+
+    def save(self):
+        if self.fileName is None or not self.changed:
+            return
+        with self.lock:
+            # write and rename, so that a concurrent reader never sees a partial index
+            with open(self.fileName + ".tmp", "w") as file:
+                json.dump({"version": self.version, "files": self.files}, file)
+            os.rename(self.fileName + ".tmp", self.fileName)
+            self.changed = False
+
 class ROOTDataset(Dataset):
     fetcher = ROOTFetcher
+    scanWorkers = 16         # files stat'ed and opened at once by fromDeclaration (both release the GIL)
 
     @staticmethod
-    def fromYamlString(declaration):
-        return ROOTDataset.fromDeclaration(DatasetDeclaration.fromYamlString(declaration))
+    def fromYamlString(declaration, index=None):
+        return ROOTDataset.fromDeclaration(DatasetDeclaration.fromYamlString(declaration), index=index)
 
     @staticmethod
     def _getPaths(quantity):
@@ -288,7 +346,44 @@ class ROOTDataset(Dataset):
             assert False, "expected either a DatasetDeclaration or a Quantity"
 
     @staticmethod
-    def fromDeclaration(declaration, fillarrays=fillarrays):
+    def _scanFile(file, tree, branches, index, fillarrays, getsize):
+        # number of entries and {branch: [size branch, length]}, opening the file only for branches not in the index
+        stamp = fileStat(file)
+        numEntries, known = index.get(file, stamp, tree)
+
+        missing = [branch for branch in branches if branch not in known]
+        if len(missing) > 0:
+            sizes = getsize(file, tree, missing)
+
+            sizeToBranch = {}
+            for branch, size in zip(missing, sizes):
+                if size is not None:
+                    sizeToBranch[size] = branch   # get rid of duplicate sizes
+            branchSizeNoDuplicates = [(branch, size) for size, branch in sizeToBranch.items()]
+
+            lengths = fillarrays(file, tree, [(branch, size, None, None) for branch, size in branchSizeNoDuplicates])
+            numEntries = int(lengths[0])
+
+            sizeToLength = {}
+            for (branch, size), length in zip(branchSizeNoDuplicates, lengths[1:]):
+                sizeToLength[size] = int(length)
+
+            # now allowing duplicate sizes (to get all the branches)
+            scanned = {}
+            for branch, size in zip(missing, sizes):
+                if size is None:
+                    scanned[branch] = [None, numEntries]
+                else:
+                    scanned[branch] = [size, sizeToLength[size]]
+
+            index.put(file, stamp, tree, numEntries, scanned)
+            known.update(scanned)
+
+        return numEntries, known
+
+    @staticmethod
+    def fromDeclaration(declaration, fillarrays=fillarrays, getsize=getsize, index=None):
+        # index: file name of a ROOTFileIndex, so that only new or changed files are opened
         pathsToFiles = {}
         for path, tree in set(ROOTDataset._getPaths(declaration)):
             pathsToFiles[(path, tree)] = []
@@ -298,34 +393,29 @@ class ROOTDataset(Dataset):
         pathsToBranches = dict((x, []) for x in pathsToFiles)
         ROOTDataset._getBranchesForPaths(declaration, pathsToBranches)
 
+        filesToBranches = {}
+        for (path, tree), files in pathsToFiles.items():
+            for file in files:
+                if (file, tree) not in filesToBranches:
+                    filesToBranches[(file, tree)] = set()
+                filesToBranches[(file, tree)].update(pathsToBranches[(path, tree)])
+        tasks = [(file, tree, sorted(branches)) for (file, tree), branches in filesToBranches.items()]
+
+        index = ROOTFileIndex(index)
+        pool = ThreadPool(max(1, min(ROOTDataset.scanWorkers, len(tasks))))
+        try:
+            results = pool.map(lambda task: ROOTDataset._scanFile(task[0], task[1], task[2], index, fillarrays, getsize), tasks)
+        finally:
+            pool.close()
+            index.save()      # even if some files failed, keep what was learned from the others
+
         filesToNumEntries = {}
         fileColumnsToLengths = {}
         fileColumnsToSize = {}
-        for (path, tree), files in pathsToFiles.items():
-            for file in files:
-                branches = [branch for branch in pathsToBranches[(path, tree)]]
-                sizes = getsize(file, tree, branches)
-
-                sizeToBranch = {}
-                for branch, size in zip(branches, sizes):
-                    if size is not None:
-                        sizeToBranch[size] = branch   # get rid of duplicate sizes
-                branchSizeNoDuplicates = [(branch, size) for size, branch in sizeToBranch.items()]
-
-                lengths = fillarrays(file, tree, [(branch, size, None, None) for branch, size in branchSizeNoDuplicates])
-                filesToNumEntries[(file, tree)] = int(lengths[0])
-
-                sizeToLength = {}
-                for (branch, size), length in zip(branchSizeNoDuplicates, lengths[1:]):
-                    sizeToLength[size] = int(length)
-
-                # now allowing duplicate sizes (to get all the branches)
-                for branch, size in zip(branches, sizes):
-                    fileColumnsToSize[(file, tree, branch)] = size
-                    if size is None:
-                        fileColumnsToLengths[(file, tree, branch)] = filesToNumEntries[(file, tree)]
-                    else:
-                        fileColumnsToLengths[(file, tree, branch)] = sizeToLength[size]
+        for (file, tree, branches), (numEntries, known) in zip(tasks, results):
+            filesToNumEntries[(file, tree)] = numEntries
+            for branch in branches:
+                fileColumnsToSize[(file, tree, branch)], fileColumnsToLengths[(file, tree, branch)] = known[branch]
 
         columns, groups = ROOTDataset._makeGroups(declaration, filesToNumEntries, fileColumnsToLengths, pathsToFiles, fileColumnsToSize)
 
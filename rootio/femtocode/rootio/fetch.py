@@ -14,21 +14,40 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import sys
 import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 from femtocode.dataset import ColumnName
 from femtocode.dataset import sizeType
 from femtocode.execution import ExecutionFailure
 from femtocode.run.compute import DataAddress
+from femtocode.rootio.xrootd import fileStat
 from femtocode.rootio._fastreader import fillarrays
 
 class ROOTFetcher(threading.Thread):
+    refetchCost = 5.0             # relative to other fetchers, for cost-aware eviction: has to decompress
+    concurrency = 4               # threads in a FetcherPool
+    fileConcurrency = 8           # files read at once within one fetch (fillarrays releases the GIL)
+    fetchLog = None               # NeedWantCache sets this to record each fetch (see run.cache.FetchLog)
+
+    lengthsLimit = 100000         # most (file, tree, branch) lengths to remember, least recently used forgotten first
+
+    _lengths = collections.OrderedDict()   # (file, stamp, tree, sizeBranch or None) -> dataLength or numEntries
+    _lengthsLock = threading.Lock()
+
     def __init__(self, occupants, workItem):
         super(ROOTFetcher, self).__init__()
         self.occupants = occupants
         self.workItem = workItem
         self.daemon = True
+        self.submitted = None
+        self.fileSeconds = []
 
     class _Pair(object):
         def __init__(self, dataBranch, sizeBranch, dataoccupant, sizeoccupant, dtype):
@@ -40,7 +59,7 @@ class ROOTFetcher(threading.Thread):
 
     class _FilesetTree(object):
         def __init__(self, fileset, tree):
-            self.fileset = tuple(sorted(fileset))
+            self.fileset = tuple(fileset)    # not sorted: the order of files is the order of entries
             self.tree = tree
 
         def __eq__(self, other):
@@ -49,7 +68,110 @@ class ROOTFetcher(threading.Thread):
         def __hash__(self):
             return hash(("ROOTFetcher._FilesetTree", self.fileset, self.tree))
 
+    @staticmethod
+    def _concurrently(tasks, concurrency):
+        # calls each task on one of at most concurrency threads; raises the first failure
+        if len(tasks) == 1:
+            return [tasks[0]()]
+
+        results = [None] * len(tasks)
+        failures = []
+        remaining = queue.Queue()
+        for index, task in enumerate(tasks):
+            remaining.put((index, task))
+
+        def work():
+            while len(failures) == 0:
+                try:
+                    index, task = remaining.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[index] = task()
+                except Exception as exception:
+                    failures.append(exception)
+
+        threads = [threading.Thread(target=work) for i in range(min(concurrency, len(tasks)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(failures) > 0:
+            raise failures[0]
+        return results
+
+    @staticmethod
+    def _getLength(key):
+        # call with _lengthsLock held
+        out = ROOTFetcher._lengths.pop(key, None)
+        if out is not None:
+            ROOTFetcher._lengths[key] = out
+        return out
+
+    @staticmethod
+    def _putLength(key, length):
+        # call with _lengthsLock held
+        ROOTFetcher._lengths.pop(key, None)
+        ROOTFetcher._lengths[key] = length
+        while len(ROOTFetcher._lengths) > ROOTFetcher.lengthsLimit:
+            ROOTFetcher._lengths.popitem(last=False)
+
+    @staticmethod
+    def _scan(file, tree, pairs):
+        # number of entries and data length per size branch of one file, without filling anything
+        sizeToData = {}
+        for pair in pairs:
+            if pair.sizeBranch is not None and pair.dataoccupant is not None:
+                sizeToData[pair.sizeBranch] = pair.dataBranch
+
+        # a rewritten file has a new modification time or size, so its old lengths are never used
+        stamp = fileStat(file)
+        if stamp is not None:
+            stamp = tuple(stamp)
+
+        with ROOTFetcher._lengthsLock:
+            numEntries = ROOTFetcher._getLength((file, stamp, tree, None))
+            dataLengths = dict((x, ROOTFetcher._getLength((file, stamp, tree, x))) for x in sizeToData)
+
+        missing = [x for x, length in dataLengths.items() if length is None]
+        if numEntries is None or len(missing) > 0:
+            lengths = fillarrays(file, tree, [(sizeToData[x], x, None, None) for x in missing])
+            numEntries = int(lengths[0])
+            for sizeBranch, length in zip(missing, lengths[1:]):
+                dataLengths[sizeBranch] = int(length)
+
+            if stamp is not None:      # can't tell whether it will change, so don't remember it
+                with ROOTFetcher._lengthsLock:
+                    ROOTFetcher._putLength((file, stamp, tree, None), numEntries)
+                    for sizeBranch in missing:
+                        ROOTFetcher._putLength((file, stamp, tree, sizeBranch), dataLengths[sizeBranch])
+
+        return numEntries, dataLengths
+
+    @staticmethod
+    def _slice(occupant, dtype, start, length):
+        if occupant is None:
+            return None
+        array = occupant.rawarray.view(dtype)
+        if length is None:
+            return array[start:]
+        else:
+            return array[start : start + length]
+
+    def _fill(self, file, tree, toget, progress):
+        startTime = time.time()
+        fillarrays(file, tree, toget)
+        self.fileSeconds.append(time.time() - startTime)
+
+        # each file's slices are complete, so the occupants are that much closer to ready
+        for occupant, numBytes in progress:
+            occupant.addtofilled(numBytes)
+
     def run(self):
+        startTime = time.time()
+        failure = None
         try:
             filesetsToPairs = {}
 
@@ -100,30 +222,64 @@ class ROOTFetcher(threading.Thread):
                                     None,
                                     sizeoccupant,
                                     self.workItem.executor.query.dataset.columns[c.data].dataType))
+                                found = True
                                 break
 
                         assert found
 
+            # each file fills its own slice of the arrays, so the slices must start after the lengths of all earlier files
+            toscan = [(filesetTree, file) for filesetTree in filesetsToPairs for file in filesetTree.fileset[:-1]]
+            scanned = self._concurrently([lambda filesetTree=filesetTree, file=file: self._scan(file, filesetTree.tree, filesetsToPairs[filesetTree]) for filesetTree, file in toscan], self.fileConcurrency)
+            lengths = dict(zip(toscan, scanned))
+
+            # then all files of all filesets are read at once, into disjoint slices
+            tofill = []
             for filesetTree, pairs in filesetsToPairs.items():
-                toget = []
-                for pair in pairs:
-                    if pair.sizeBranch is None:
-                        toget.append((pair.dataBranch, None if pair.dataoccupant is None else pair.dataoccupant.rawarray.view(pair.dtype)))
+                entryStart = 0
+                dataStarts = dict((pair.sizeBranch, 0) for pair in pairs)
+
+                for index, file in enumerate(filesetTree.fileset):
+                    if index == len(filesetTree.fileset) - 1:
+                        numEntries, dataLengths = None, {}    # the rest of each array
                     else:
-                        toget.append((pair.dataBranch, pair.sizeBranch,
-                                      None if pair.dataoccupant is None else pair.dataoccupant.rawarray.view(pair.dtype),
-                                      None if pair.sizeoccupant is None else pair.sizeoccupant.rawarray.view(sizeType)))
+                        numEntries, dataLengths = lengths[(filesetTree, file)]
 
-                for file in filesetTree.fileset:
-                    fillarrays(file, filesetTree.tree, toget)
+                    toget = []
+                    progress = {}
+                    for pair in pairs:
+                        if pair.sizeBranch is None:
+                            data = self._slice(pair.dataoccupant, pair.dtype, entryStart, numEntries)
+                            toget.append((pair.dataBranch, data))
+                        else:
+                            data = self._slice(pair.dataoccupant, pair.dtype, dataStarts[pair.sizeBranch], dataLengths.get(pair.sizeBranch))
+                            size = self._slice(pair.sizeoccupant, sizeType, entryStart, numEntries)
+                            toget.append((pair.dataBranch, pair.sizeBranch, data, size))
+                            if size is not None:
+                                progress[pair.sizeoccupant] = size.nbytes    # pairs may share a size occupant
+                        if data is not None:
+                            progress[pair.dataoccupant] = data.nbytes
 
-                for pair in pairs:
-                    if pair.dataoccupant is not None:
-                        pair.dataoccupant.filledBytes = pair.dataoccupant.totalBytes
-                    if pair.sizeoccupant is not None:
-                        pair.sizeoccupant.filledBytes = pair.sizeoccupant.totalBytes
+                    tofill.append(lambda file=file, tree=filesetTree.tree, toget=toget, progress=list(progress.items()): self._fill(file, tree, toget, progress))
+
+                    if numEntries is not None:
+                        entryStart += numEntries
+                        for sizeBranch, dataLength in dataLengths.items():
+                            dataStarts[sizeBranch] += dataLength
+
+            self._concurrently(tofill, self.fileConcurrency)
 
         except Exception as exception:
+            failure = repr(exception)
             for occupant in self.occupants:
-                with occupant.lock:
-                    occupant.fetchfailure = ExecutionFailure(exception, sys.exc_info()[2])
+                occupant.setfailure(ExecutionFailure(exception, sys.exc_info()[2]))
+
+        if self.fetchLog is not None:
+            self.fetchLog.record("ROOTFetcher",
+                                 sum(x.totalBytes for x in self.occupants),
+                                 0.0 if self.submitted is None else startTime - self.submitted,
+                                 time.time() - startTime,
+                                 failure,
+                                 dataset=self.workItem.executor.query.dataset.name,
+                                 group=self.workItem.group.id,
+                                 files=len(self.fileSeconds),
+                                 slowestFile=max(self.fileSeconds) if len(self.fileSeconds) > 0 else None)
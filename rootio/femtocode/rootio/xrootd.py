@@ -15,13 +15,108 @@
 # limitations under the License.
 
 import glob
+import os
 import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 try:
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlparse
 
-def filesFromPath(path):
+class ListingCache(object):
+    # XRootD stat and dirlist results, trusted for ttl seconds (new files appear after at most that long)
+    ttl = 300.0
+    maxEntries = 1000000
+
+    def __init__(self, ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}    # (server, request, path) -> (expiration time, result)
+
+    def __repr__(self):
+        return "<ListingCache {0} entries at 0x{1:012x}>".format(len(self.entries), id(self))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            elif entry[0] < time.time():
+                del self.entries[key]
+                return None
+            else:
+                return entry[1]
+
+    def put(self, key, result):
+        now = time.time()
+        with self.lock:
+            if len(self.entries) >= self.maxEntries:
+                self.entries = dict((k, v) for k, v in self.entries.items() if v[0] >= now)
+                if len(self.entries) >= self.maxEntries:
+                    self.entries = {}
+            self.entries[key] = (now + self.ttl, result)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+listingCache = ListingCache()
+maxInFlight = 16             # concurrent stat/dirlist requests to one server while globbing
+
+_filesystems = {}
+_filesystemsLock = threading.Lock()
+
+def _filesystem(server):
+    # XRootD FileSystems are thread-safe: one per server, reused
+    with _filesystemsLock:
+        if server not in _filesystems:
+            import XRootD.client
+            _filesystems[server] = XRootD.client.FileSystem(server)
+        return _filesystems[server]
+
+def _expand(fs, server, cache, path, patterns):
+    # one request: returns child (name, patterns) pairs and whether path is a file that matches
+    fullpath = "/" + "".join("/" + x for x in path)
+
+    def check(status):
+        if status.status == 3 and status.code == 204:
+            raise IOError("Could not connect to {0}: {1}".format(server, status.message))
+
+    if len(patterns) > 0 and re.search(r"[\*\?\[\]]", patterns[0]) is None:
+        key = (server, "stat", fullpath + "/" + patterns[0])
+        exists = cache.get(key)
+        if exists is None:
+            status, dummy = fs.stat(fullpath + "/" + patterns[0])
+            check(status)
+            exists = status.ok
+            cache.put(key, exists)
+
+        if exists:
+            return [(patterns[0], patterns[1:])], False
+        else:
+            return [], False
+
+    else:
+        key = (server, "dirlist", fullpath)
+        names = cache.get(key)
+        if names is None:
+            status, listing = fs.dirlist(fullpath)
+            check(status)
+            if status.ok:
+                names = [x.name for x in listing.dirlist]
+            else:
+                names = False    # not a directory
+            cache.put(key, names)
+
+        if names is False:
+            return [], len(patterns) == 0
+        else:
+            return [(x, patterns[1:]) for x in names if len(patterns) == 0 or glob.fnmatch.fnmatchcase(x, patterns[0])], False
+
+def filesFromPath(path, fs=None, cache=None, inFlight=None):
     url = urlparse(path)
     if url.scheme == "":
         for x in glob.glob(url.path):
@@ -33,41 +128,54 @@ def filesFromPath(path):
         if "{" in url.path or "}" in url.path:
             raise NotImplementedError("curly braces ({ and }) not supported in XRootD")
 
-        import XRootD.client
-        fs = XRootD.client.FileSystem("{0}://{1}".format(url.scheme, url.netloc))
+        server = "{0}://{1}".format(url.scheme, url.netloc)
+        if fs is None:
+            fs = _filesystem(server)
+        if cache is None:
+            cache = listingCache
+        if inFlight is None:
+            inFlight = maxInFlight
 
-        def exists(fullpath):
-            status, dummy = fs.stat(fullpath)
-            if status.status == 3 and status.code == 204:
-                raise IOError("Could not connect to {0}://{1}: {2}".format(url.scheme, url.netloc, status.message))
-            return status.ok
+        # breadth-first, each level's requests concurrently; sortkey (indexes along the path) restores depth-first order
+        found = []
+        level = [((), [], re.split(r"/+", url.path.strip("/")))]
+        pool = ThreadPool(inFlight)
+        try:
+            while len(level) > 0:
+                expanded = pool.map(lambda node: _expand(fs, server, cache, node[1], node[2]), level, 1)
 
-        def search(path, patterns):
-            fullpath = "/" + "".join("/" + x for x in path)
+                nextLevel = []
+                for (sortkey, path, patterns), (children, isfile) in zip(level, expanded):
+                    if isfile:
+                        found.append((sortkey, "/" + "".join("/" + x for x in path)))
+                    for i, (name, remaining) in enumerate(children):
+                        nextLevel.append((sortkey + (i,), path + [name], remaining))
+                level = nextLevel
 
-            if len(patterns) > 0 and re.search(r"[\*\?\[\]]", patterns[0]) is None:
-                if exists(fullpath + "/" + patterns[0]):
-                    for x in search(path + [patterns[0]], patterns[1:]):
-                        yield x
+        finally:
+            pool.close()
 
-            else:
-                status, listing = fs.dirlist(fullpath)
-                if status.status == 3 and status.code == 204:
-                    raise IOError("Could not connect to {0}://{1}: {2}".format(url.scheme, url.netloc, status.message))
-                if status.ok:
-                    for x in listing.dirlist:
-                        if len(patterns) == 0 or glob.fnmatch.fnmatchcase(x.name, patterns[0]):
-                            for y in search(path + [x.name], patterns[1:]):
-                                yield y
-
-                else:
-                    if len(patterns) == 0:
-                        yield fullpath
-
-        patterns = re.split(r"/+", url.path.strip("/"))
-
-        for x in search([], patterns):
+        for sortkey, x in sorted(found):
             yield "{0}://{1}/{2}".format(url.scheme, url.netloc, x)
 
     else:
         raise IOError("unknown protocol: {0}".format(url.scheme))
+
+def fileStat(file):
+    # modification time and size, to tell whether a file has changed since it was last scanned (None if unknown)
+    url = urlparse(file)
+    if url.scheme == "":
+        try:
+            stat = os.stat(url.path)
+        except OSError:
+            return None
+        return [stat.st_mtime, stat.st_size]
+
+    elif url.scheme == "root":
+        status, info = _filesystem("{0}://{1}".format(url.scheme, url.netloc)).stat(url.path)
+        if not status.ok:
+            return None
+        return [info.modtime, info.size]
+
+    else:
+        return None
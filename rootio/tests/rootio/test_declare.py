@@ -14,12 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
 import time
 import unittest
 
 import numpy
 
 from femtocode.rootio.dataset import ROOTDataset
+from femtocode.rootio.dataset import ROOTFileIndex
 
 class TestDeclare(unittest.TestCase):
     def runTest(self):
@@ -124,3 +128,42 @@ schema:
         self.assertEqual(asjson, {"name": "MuOnia", "numGroups": 1, "numEntries": 48131, "groups": [{"files": ["/home/pivarski/storage/data/00000000-0000-0000-0000-000000000000.root"], "segments": {"jets[]-mass": {"files": None, "sizeLength": 48131, "numEntries": 48131, "dataLength": 806177}, "jets[]-pt": {"files": None, "sizeLength": 48131, "numEntries": 48131, "dataLength": 806177}, "muons[]-pt": {"files": None, "sizeLength": 48131, "numEntries": 48131, "dataLength": 132274}, "muons[]-eta": {"files": None, "sizeLength": 48131, "numEntries": 48131, "dataLength": 132274}, "jets[]-eta": {"files": None, "sizeLength": 48131, "numEntries": 48131, "dataLength": 806177}, "jets[]-phi": {"files": None, "sizeLength": 48131, "numEntries": 48131, "dataLength": 806177}, "muons[]-phi": {"files": None, "sizeLength": 48131, "numEntries": 48131, "dataLength": 132274}}, "numEntries": 48131, "id": 0}], "class": "femtocode.rootio.dataset.ROOTDataset", "columns": {"jets[]-mass": {"dataBranch": "patJets_slimmedJets__PAT.obj.m_state.p4Polar_.fCoordinates.fM", "dataType": "float64", "tree": "Events", "sizeBranch": "patJets_slimmedJets__PAT.obj", "data": "jets[]-mass", "size": "jets[]@size"}, "jets[]-pt": {"dataBranch": "patJets_slimmedJets__PAT.obj.m_state.p4Polar_.fCoordinates.fPt", "dataType": "float64", "tree": "Events", "sizeBranch": "patJets_slimmedJets__PAT.obj", "data": "jets[]-pt", "size": "jets[]@size"}, "muons[]-pt": {"dataBranch": "patMuons_slimmedMuons__PAT.obj.m_state.p4Polar_.fCoordinates.fPt", "dataType": "float64", "tree": "Events", "sizeBranch": "patMuons_slimmedMuons__PAT.obj", "data": "muons[]-pt", "size": "muons[]@size"}, "muons[]-eta": {"dataBranch": "patMuons_slimmedMuons__PAT.obj.m_state.p4Polar_.fCoordinates.fEta", "dataType": "float64", "tree": "Events", "sizeBranch": "patMuons_slimmedMuons__PAT.obj", "data": "muons[]-eta", "size": "muons[]@size"}, "jets[]-eta": {"dataBranch": "patJets_slimmedJets__PAT.obj.m_state.p4Polar_.fCoordinates.fEta", "dataType": "float64", "tree": "Events", "sizeBranch": "patJets_slimmedJets__PAT.obj", "data": "jets[]-eta", "size": "jets[]@size"}, "jets[]-phi": {"dataBranch": "patJets_slimmedJets__PAT.obj.m_state.p4Polar_.fCoordinates.fPhi", "dataType": "float64", "tree": "Events", "sizeBranch": "patJets_slimmedJets__PAT.obj", "data": "jets[]-phi", "size": "jets[]@size"}, "muons[]-phi": {"dataBranch": "patMuons_slimmedMuons__PAT.obj.m_state.p4Polar_.fCoordinates.fPhi", "dataType": "float64", "tree": "Events", "sizeBranch": "patMuons_slimmedMuons__PAT.obj", "data": "muons[]-phi", "size": "muons[]@size"}}, "schema": {"jets": {"items": {"fields": {"phi": {"max": 3.141592653589793, "type": "real", "min": -3.141592653589793}, "eta": "real", "mass": {"max": {"almost": "inf"}, "type": "real", "min": 0}, "pt": {"max": {"almost": "inf"}, "type": "real", "min": 0}}, "type": "record"}, "type": "collection"}, "muons": {"items": {"fields": {"phi": {"max": 3.141592653589793, "type": "real", "min": -3.141592653589793}, "eta": "real", "pt": {"max": {"almost": "inf"}, "type": "real", "min": 0}}, "type": "record"}, "type": "collection"}}})
 
         self.assertEqual(ROOTDataset.fromJson(asjson), dataset)
+
+    def test_index(self):
+        directory = tempfile.mkdtemp()
+        try:
+            opened = []
+            def getsize(fileName, treeName, branches):
+                opened.append(os.path.basename(fileName))
+                return ["muons" if branch.startswith("muons.") else None for branch in branches]
+            def fillarrays(fileName, treeName, arrays):
+                return (100,) + tuple(20 for x in arrays)
+
+            fileNames = []
+            for i in range(3):
+                fileNames.append(os.path.join(directory, "{0}.root".format(i)))
+                with open(fileNames[-1], "w") as file:
+                    file.write("x" * i)
+
+            indexName = os.path.join(directory, "index.json")
+            index = ROOTFileIndex(indexName)
+            for fileName in fileNames[:2]:
+                self.assertEqual(ROOTDataset._scanFile(fileName, "Events", ["met", "muons.pt"], index, fillarrays, getsize), (100, {"met": [None, 100], "muons.pt": ["muons", 20]}))
+            index.save()
+            self.assertEqual(opened, ["0.root", "1.root"])
+
+            # a new process: only the new file and the changed file are opened, and only for the new branch of unchanged files
+            del opened[:]
+            with open(fileNames[1], "w") as file:
+                file.write("changed")
+            index = ROOTFileIndex(indexName)
+            for fileName in fileNames:
+                self.assertEqual(ROOTDataset._scanFile(fileName, "Events", ["met", "muons.pt"], index, fillarrays, getsize)[0], 100)
+            self.assertEqual(sorted(opened), ["1.root", "2.root"])
+
+            del opened[:]
+            self.assertEqual(ROOTDataset._scanFile(fileNames[0], "Events", ["met", "muons.eta"], index, fillarrays, getsize)[1]["muons.eta"], ["muons", 20])
+            self.assertEqual(opened, ["0.root"])
+
+        finally:
+            shutil.rmtree(directory)
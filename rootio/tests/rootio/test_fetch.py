@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# Copyright 2016 DIANA-HEP
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+import femtocode.rootio.fetch
+from femtocode.dataset import ColumnName
+from femtocode.rootio.dataset import ROOTColumn
+from femtocode.rootio.dataset import ROOTDataset
+from femtocode.rootio.dataset import ROOTGroup
+from femtocode.rootio.dataset import ROOTSegment
+from femtocode.rootio.fetch import ROOTFetcher
+from femtocode.run.cache import CacheOccupant
+from femtocode.run.cache import Prefetch
+from femtocode.run.compute import DataAddress
+from femtocode.run.compute import WorkItem
+
+x = ColumnName.parse("x")           # a flat column x and a jagged column j, sized by branch n
+j = ColumnName.parse("j[]-y")
+
+class TestFetch(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.contents = {}            # file -> {"n": sizes, "x": flat data, "j": jagged data}
+        self.calls = []               # (file, [(branch, length of the array it was given)])
+        self.lock = threading.Lock()
+
+        self.files = []
+        for i, numEntries in enumerate([7, 1, 12, 5]):
+            fileName = os.path.join(self.directory, "{0}.root".format(i))
+            self.write(fileName, numEntries, i)
+            self.files.append(fileName)
+
+        self.fillarrays = femtocode.rootio.fetch.fillarrays
+        femtocode.rootio.fetch.fillarrays = self.fakefillarrays
+        ROOTFetcher._lengths.clear()
+
+    def tearDown(self):
+        femtocode.rootio.fetch.fillarrays = self.fillarrays
+        ROOTFetcher._lengths.clear()
+        shutil.rmtree(self.directory)
+
+    def write(self, fileName, numEntries, seed):
+        random = numpy.random.RandomState(seed)
+        sizes = random.randint(0, 4, numEntries).astype(numpy.uint64)
+        self.contents[fileName] = {"n": sizes, "x": random.normal(size=numEntries), "j": random.normal(size=int(sizes.sum()))}
+        with open(fileName, "wb") as file:
+            file.write(b"\x00" * (100 + numEntries))     # the size is part of the stamp that _lengths is keyed on
+
+    def fakefillarrays(self, fileName, tree, toget):
+        # like _fastreader.fillarrays: fills the arrays it's given (raising if they're too small) and returns lengths
+        content = self.contents[fileName]
+        numEntries = len(content["n"])
+        out = [numEntries]
+        given = []
+        for request in toget:
+            if len(request) == 2:
+                dataBranch, data = request
+                sizeBranch, size = None, None
+            else:
+                dataBranch, sizeBranch, data, size = request
+
+            if data is not None:
+                if len(data) < len(content[dataBranch]):
+                    raise IOError("ROOT file data is bigger than data array")
+                data[:len(content[dataBranch])] = content[dataBranch]
+                given.append((dataBranch, len(data)))
+            if size is not None:
+                size[:numEntries] = content[sizeBranch]
+                given.append((sizeBranch, len(size)))
+            out.append(len(content[dataBranch]) if sizeBranch is not None else 0)
+
+        with self.lock:
+            self.calls.append((fileName, sorted(given)))
+        return tuple(out)
+
+    def expected(self, branch):
+        return numpy.concatenate([self.contents[fileName][branch] for fileName in self.files])
+
+    def fetch(self):
+        # one group of all the files, whose segments use the group's files
+        numEntries = len(self.expected("n"))
+        group = ROOTGroup(0, {x: ROOTSegment(numEntries, numEntries, 0, None), j: ROOTSegment(numEntries, len(self.expected("j")), numEntries, None)}, numEntries, self.files)
+        dataset = ROOTDataset("dataset", None, {x: ROOTColumn(x, None, numpy.float64, "Events", "x", None), j: ROOTColumn(j, j.size(), numpy.float64, "Events", "j", "n")}, [group], numEntries, 1)
+        workItem = WorkItem(Prefetch(dataset, [x, j]), group)
+
+        occupants = dict((column, CacheOccupant(DataAddress("dataset", column, 0), array.nbytes, array.dtype, CacheOccupant.allocate))
+                         for column, array in [(x, self.expected("x")),
+                                               (j, self.expected("j")),
+                                               (j.size(), self.expected("n"))])
+        del self.calls[:]
+        ROOTFetcher(list(occupants.values()), workItem).run()
+
+        for column, branch in (x, "x"), (j, "j"), (j.size(), "n"):
+            self.assertEqual(occupants[column].fetchfailure, None)
+            self.assertTrue(occupants[column].ready())
+            self.assertEqual(occupants[column].array().tolist(), self.expected(branch).tolist())
+
+    def fills(self):
+        return dict((fileName, given) for fileName, given in self.calls if len(given) > 0)
+
+    def test_boundaries(self):
+        self.fetch()
+
+        # every file but the last is scanned, then each file's fill gets exactly its own slice of each array
+        self.assertEqual(len(self.calls), 2 * len(self.files) - 1)
+        fills = self.fills()
+        for fileName in self.files:
+            content = self.contents[fileName]
+            self.assertEqual(fills[fileName], sorted([("x", len(content["x"])), ("j", len(content["j"])), ("n", len(content["n"]))]))
+
+        # lengths are remembered: a second fetch of the same files only fills
+        self.fetch()
+        self.assertEqual(len(self.calls), len(self.files))
+
+    def test_rewritten(self):
+        self.fetch()
+
+        # a file rewritten with a different number of entries is scanned again, not sliced by its old lengths
+        self.write(self.files[1], 9, 100)
+        self.fetch()
+        self.assertEqual(len(self.calls), len(self.files) + 1)
+        self.assertEqual(self.fills()[self.files[1]], sorted([("x", 9), ("j", len(self.contents[self.files[1]]["j"])), ("n", 9)]))
+
+    def test_lengthsLimit(self):
+        lengthsLimit = ROOTFetcher.lengthsLimit
+        ROOTFetcher.lengthsLimit = 2
+        try:
+            self.fetch()
+            self.assertEqual(len(ROOTFetcher._lengths), 2)
+            self.fetch()
+        finally:
+            ROOTFetcher.lengthsLimit = lengthsLimit
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Copyright 2016 DIANA-HEP
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from femtocode.rootio.xrootd import ListingCache
+from femtocode.rootio.xrootd import filesFromPath
+
+class LocalFileSystem(object):
+    # stands in for XRootD.client.FileSystem, serving a local directory and counting requests
+    class Status(object):
+        def __init__(self, ok, status=0, code=0, message=""):
+            self.ok = ok
+            self.status = status
+            self.code = code
+            self.message = message
+
+    class Entry(object):
+        def __init__(self, name):
+            self.name = name
+
+    class Listing(object):
+        def __init__(self, names):
+            self.dirlist = [LocalFileSystem.Entry(x) for x in names]
+
+    def __init__(self, directory, latency=0.0, connected=True):
+        self.directory = directory
+        self.latency = latency
+        self.connected = connected
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.inFlight = 0
+        self.maxInFlight = 0
+
+    def _request(self, path, fcn):
+        with self.lock:
+            self.requests += 1
+            self.inFlight += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        try:
+            time.sleep(self.latency)
+            if not self.connected:
+                return self.Status(False, 3, 204, "no route to host"), None
+            return fcn(os.path.join(self.directory, path.lstrip("/")))
+        finally:
+            with self.lock:
+                self.inFlight -= 1
+
+    def stat(self, path):
+        return self._request(path, lambda x: (self.Status(os.path.exists(x)), None))
+
+    def dirlist(self, path):
+        def out(x):
+            if os.path.isdir(x):
+                return self.Status(True), self.Listing(sorted(os.listdir(x)))
+            else:
+                return self.Status(False, 1, 400, "not a directory"), None
+        return self._request(path, out)
+
+class TestXRootD(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for run in "ABCD":
+            for i in range(3):
+                os.makedirs(os.path.join(self.directory, "store", "Run" + run, "v{0}".format(i)))
+                for j in range(2):
+                    open(os.path.join(self.directory, "store", "Run" + run, "v{0}".format(i), "{0}.root".format(j)), "w").close()
+            open(os.path.join(self.directory, "store", "Run" + run, "README"), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def paths(self, urls):
+        return [re.sub("/+", "/", urlparse(x).path) for x in urls]
+
+    def test_glob(self):
+        fs = LocalFileSystem(self.directory)
+        found = self.paths(filesFromPath("root://server//store/Run[AC]/*/*.root", fs=fs, cache=ListingCache()))
+        self.assertEqual(found, ["/store/Run{0}/v{1}/{2}.root".format(run, i, j) for run in "AC" for i in range(3) for j in range(2)])
+
+        found = self.paths(filesFromPath("root://server//store/RunB/v1/", fs=fs, cache=ListingCache()))
+        self.assertEqual(found, ["/store/RunB/v1/0.root", "/store/RunB/v1/1.root"])
+
+        found = self.paths(filesFromPath("root://server//store/RunB/", fs=fs, cache=ListingCache()))
+        self.assertEqual(found, ["/store/RunB/README"] + ["/store/RunB/v{0}/{1}.root".format(i, j) for i in range(3) for j in range(2)])
+
+        self.assertEqual(list(filesFromPath("root://server//store/RunZ/*.root", fs=fs, cache=ListingCache())), [])
+
+    def test_concurrent(self):
+        fs = LocalFileSystem(self.directory, latency=0.02)
+        startTime = time.time()
+        found = list(filesFromPath("root://server//store/*/*/*.root", fs=fs, cache=ListingCache(), inFlight=4))
+        self.assertEqual(len(found), 24)
+        self.assertEqual(fs.maxInFlight, 4)
+        self.assertLess(time.time() - startTime, fs.requests * fs.latency / 2)
+
+    def test_cache(self):
+        fs = LocalFileSystem(self.directory)
+        cache = ListingCache()
+        self.assertEqual(len(list(filesFromPath("root://server//store/*/*/*.root", fs=fs, cache=cache))), 24)
+        requests = fs.requests
+
+        # a new file isn't seen until the listing expires
+        open(os.path.join(self.directory, "store", "RunA", "v0", "2.root"), "w").close()
+        self.assertEqual(len(list(filesFromPath("root://server//store/*/*/*.root", fs=fs, cache=cache))), 24)
+        self.assertEqual(fs.requests, requests)
+
+        cache.ttl = 0.0
+        cache.clear()
+        self.assertEqual(len(list(filesFromPath("root://server//store/*/*/*.root", fs=fs, cache=cache))), 25)
+        self.assertGreater(fs.requests, requests)
+
+    def test_disconnected(self):
+        fs = LocalFileSystem(self.directory, connected=False)
+        self.assertRaises(IOError, lambda: list(filesFromPath("root://server//store/*/*.root", fs=fs, cache=ListingCache())))
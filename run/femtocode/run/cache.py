@@ -14,25 +14,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import collections
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import shutil
+import sys
 import threading
 import time
+import zlib
 try:
     import Queue as queue
 except ImportError:
     import queue
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
 
 import numpy
 
 from femtocode.py23 import *
 from femtocode.util import *
+from femtocode.dataset import ColumnName
 from femtocode.execution import ExecutionFailure
+from femtocode.run.compute import CompositeWorkItem
+from femtocode.run.compute import DataAddress
 from femtocode.run.compute import WorkItem
 
+def fileStamp(fileName):
+    # modification time and size, to tell whether a file has been rewritten (None if it can't be read)
+    try:
+        stat = os.stat(fileName)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
 class CacheOccupant(object):
     untyped = numpy.uint8
 
     @staticmethod
-    def allocate(numBytes):
+    def allocate(address, numBytes):
         return numpy.empty(numBytes, dtype=CacheOccupant.untyped)
 
     def __init__(self, address, totalBytes, dtype, allocate):
@@ -41,10 +66,18 @@ class CacheOccupant(object):
         self.dtype = dtype
 
         self.filledBytes = 0
-        self.rawarray = allocate(totalBytes)    # maybe use an alternative allocation method, maybe not
+        self.rawarray = allocate(address, totalBytes)    # see HeapAllocator, MmapFileAllocator
         self.needCount = 1
+        self.uses = 1                           # number of workItems that have attached it (for eviction policies)
+        self.refetchCost = 1.0                  # relative cost of fetching it again, from the Fetcher class
+        self.compressed = None                  # bytes instead of rawarray while it's a compressed 'want'
+        self.residentBytes = totalBytes         # memory it occupies: less than totalBytes if compressed
         self.lock = threading.Lock()            # CacheMaster and Minion both change needCount
         self.fetchfailure = None                # Fetcher sets filledBytes and CacheMaster checks it
+        self.listener = None                    # called when this becomes ready, fails, or is no longer needed
+        self.idleSince = None                   # when it last became a 'want' (see NeedWantCache.compressCold)
+        self.sourceFile = None                  # file that an adopted rawarray maps, if not the cache's own (see stale)
+        self.sourceStamp = None
 
     def __repr__(self):
         return "<CacheOccupant for {0} at 0x{1:012x}>".format(self.address, id(self))
@@ -64,6 +97,14 @@ class CacheOccupant(object):
         with self.lock:
             assert self.needCount > 0
             self.needCount -= 1
+            released = self.needCount == 0
+        if released:
+            self._changed()
+
+    def _changed(self):
+        # outside of self.lock: the listener may look at this occupant
+        if self.listener is not None:
+            self.listener()
 
     def fill(self, data):
         numBytes = len(data)
@@ -71,6 +112,9 @@ class CacheOccupant(object):
         self.rawarray[self.filledBytes : self.filledBytes + numBytes] = numpy.frombuffer(data, dtype=self.untyped)
         with self.lock:
             self.filledBytes += numBytes
+            done = self.filledBytes == self.totalBytes
+        if done:
+            self._changed()
         return numBytes
 
     def setfilled(self, value, absolute=True):
@@ -78,28 +122,500 @@ class CacheOccupant(object):
             if not absolute:
                 value = roundup(value * self.totalBytes)
             self.filledBytes = max(0, min(self.totalBytes, value))
+            done = self.filledBytes == self.totalBytes
+        if done:
+            self._changed()
 
     def addtofilled(self, value, absolute=True):
         with self.lock:
             if not absolute:
                 value = roundup(value * self.totalBytes)
             self.filledBytes = max(0, min(self.totalBytes, self.filledBytes + value))
+            done = self.filledBytes == self.totalBytes
+        if done:
+            self._changed()
+
+    def adopt(self, rawarray, sourceFile=None):
+        # use existing memory (e.g. a mapped file) instead of the allocated array, with no copy
+        assert len(rawarray) == self.totalBytes
+        self.rawarray = rawarray
+        if sourceFile is not None:
+            self.sourceFile = sourceFile
+            self.sourceStamp = fileStamp(sourceFile)
+        self.setfilled(self.totalBytes)
+
+    def stale(self):
+        # an adopted map of a file that has been rewritten or truncated since: reading it could raise SIGBUS
+        return self.sourceFile is not None and fileStamp(self.sourceFile) != self.sourceStamp
+
+    def setfailure(self, failure):
+        with self.lock:
+            self.fetchfailure = failure
+        self._changed()
 
     def ready(self):
         with self.lock:
             return self.filledBytes == self.totalBytes
 
-class CacheOrder(object):
+    def setcompressed(self, data):
+        # only for complete occupants that no Minion or Fetcher is using
+        self.compressed = data
+        self.rawarray = None
+        self.residentBytes = len(data)
+
+    def uncompress(self, allocate):
+        # back to a full-sized array, unfilled until a ColdCompressor.Fetcher decompresses the returned bytes into it
+        data = self.compressed
+        self.rawarray = allocate(self.address, self.totalBytes)
+        self.compressed = None
+        self.residentBytes = self.totalBytes
+        with self.lock:
+            self.filledBytes = 0
+        return data
+
+class ShuffleCompressor(object):
+    # byte-shuffle (first bytes of every item, then second bytes...) puts the similar high-order bytes of numbers
+    # together, then a fast codec: lz4 if available, else zlib at its fastest level
+    minRatio = 0.8              # keep the compressed form only if it's at most this fraction of the original
+    zlibLevel = 1
+
+    def __init__(self, codec=None):
+        if codec is None:
+            codec = "zlib" if lz4frame is None else "lz4"
+        assert codec in ("lz4", "zlib"), "unrecognized codec: {0}".format(codec)
+        assert codec != "lz4" or lz4frame is not None, "lz4 is not installed"
+        self.codec = codec
+
+    def __repr__(self):
+        return "<ShuffleCompressor {0} at 0x{1:012x}>".format(self.codec, id(self))
+
+    def compress(self, rawarray, itemsize):
+        if len(rawarray) == 0 or len(rawarray) % itemsize != 0:
+            return None
+        shuffled = numpy.ascontiguousarray(rawarray.reshape(-1, itemsize).T).tobytes()
+        if self.codec == "lz4":
+            data = lz4frame.compress(shuffled)
+        else:
+            data = zlib.compress(shuffled, self.zlibLevel)
+        if len(data) > self.minRatio * len(rawarray):
+            return None
+        return data
+
+    def decompress(self, data, itemsize, out):
+        if self.codec == "lz4":
+            shuffled = lz4frame.decompress(data)
+        else:
+            shuffled = zlib.decompress(data)
+        out.reshape(-1, itemsize)[:] = numpy.frombuffer(shuffled, dtype=CacheOccupant.untyped).reshape(itemsize, -1).T
+
+class ColdCompressor(object):
+    # compresses 'wants' that have gone cold on a background thread, so that CacheMaster never waits for a codec;
+    # NeedWantCache submits them and swaps the results in on its own thread (see NeedWantCache.compressCold)
+    maxPending = 16             # occupants waiting to be compressed; beyond this, submit does nothing
+
+    def __init__(self, compressor, onfinished=None):
+        self.compressor = compressor
+        self.onfinished = onfinished
+        self.lock = threading.Lock()
+        self.submitted = set()     # id of each occupant waiting or being compressed
+        self.results = []          # (occupant, rawarray it was compressed from, compressed bytes or None)
+        self.pending = queue.Queue(self.maxPending)
+
+        self.worker = threading.Thread(target=self._compress, name="ColdCompressor worker")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def __repr__(self):
+        return "<ColdCompressor {0} at 0x{1:012x}>".format(self.compressor.codec, id(self))
+
+    def submit(self, occupant):
+        with self.lock:
+            if id(occupant) in self.submitted:
+                return
+            self.submitted.add(id(occupant))
+        try:
+            self.pending.put_nowait((occupant, occupant.rawarray))   # keeps both alive until compressed
+        except queue.Full:
+            with self.lock:
+                self.submitted.discard(id(occupant))
+
+    def _compress(self):
+        while True:
+            occupant, rawarray = self.pending.get()
+            try:
+                data = self.compressor.compress(rawarray, occupant.dtype.itemsize)
+            except Exception:
+                data = None
+            with self.lock:
+                self.results.append((occupant, rawarray, data))
+                self.submitted.discard(id(occupant))
+            self.pending.task_done()   # so that self.pending.join() waits for everything submitted so far
+            if self.onfinished is not None:
+                self.onfinished()
+
+    def finished(self):
+        with self.lock:
+            out = self.results
+            self.results = []
+        return out
+
+    class Fetcher(threading.Thread):
+        # like a dataset's fetcher, but decompressing 'wants' that are needed again (off CacheMaster's thread)
+        concurrency = 2
+
+        def __init__(self, occupants, compressed, compressor):
+            super(ColdCompressor.Fetcher, self).__init__()
+            self.occupants = occupants
+            self.compressed = compressed
+            self.compressor = compressor
+            self.daemon = True
+
+        def run(self):
+            for occupant, data in zip(self.occupants, self.compressed):
+                try:
+                    self.compressor.decompress(data, occupant.dtype.itemsize, occupant.rawarray)
+                except Exception as exception:
+                    occupant.setfailure(ExecutionFailure(exception, sys.exc_info()[2]))
+                else:
+                    occupant.setfilled(occupant.totalBytes)
+
+class HeapAllocator(object):
+    # allocators decide where an occupant's bytes live: allocate, mark as complete, free, and recover after restart
+    def __repr__(self):
+        return "<HeapAllocator at 0x{0:012x}>".format(id(self))
+
+    def allocate(self, address, numBytes):
+        return CacheOccupant.allocate(address, numBytes)
+
+    def ready(self, occupant):
+        pass
+
+    def free(self, occupant):
+        pass   # garbage collected when the last reference goes away
+
+    def recover(self):
+        return []
+
+def addressFileName(directory, address):
+    key = json.dumps([address.dataset, str(address.column), address.group])
+    return os.path.join(directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+class MmapFileAllocator(object):
+    # occupants in memory-mapped files named by address: the OS can page them out rather than run out of memory,
+    # other processes can map them by name, and complete ones are recovered by a worker restarted on the same directory
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return "<{0} {1} at 0x{2:012x}>".format(self.__class__.__name__, repr(self.directory), id(self))
+
+    def _fileName(self, address):
+        return addressFileName(self.directory, address)
+
+    @staticmethod
+    def _remove(fileName):
+        try:
+            os.remove(fileName)
+        except OSError:
+            pass
+
+    def allocate(self, address, numBytes):
+        if numBytes == 0:
+            return CacheOccupant.allocate(address, numBytes)   # can't map an empty file
+
+        fileName = self._fileName(address)
+        self._remove(fileName + ".ready")
+        with open(fileName + ".data", "wb") as file:
+            file.truncate(numBytes)
+        return numpy.memmap(fileName + ".data", dtype=CacheOccupant.untyped, mode="r+", shape=(numBytes,))
+
+    def _owns(self, occupant, fileName):
+        # not if a Fetcher adopted some other file for it
+        return isinstance(occupant.rawarray, numpy.memmap) and occupant.rawarray.filename is not None and \
+               os.path.abspath(occupant.rawarray.filename) == os.path.abspath(fileName + ".data")
+
+    def ready(self, occupant):
+        # the marker is written only after the data are complete, so recover never sees a partial column
+        fileName = self._fileName(occupant.address)
+        if self._owns(occupant, fileName):
+            if not os.path.exists(fileName + ".ready"):
+                occupant.rawarray.flush()
+                with open(fileName + ".tmp", "w") as file:
+                    json.dump({"dataset": occupant.address.dataset,
+                               "column": str(occupant.address.column),
+                               "group": occupant.address.group,
+                               "numBytes": occupant.totalBytes,
+                               "dtype": occupant.dtype.str}, file)
+                os.rename(fileName + ".tmp", fileName + ".ready")
+
+    def free(self, occupant):
+        # existing mappings stay valid after the file is removed
+        if isinstance(occupant.rawarray, numpy.memmap):
+            fileName = self._fileName(occupant.address)
+            self._remove(fileName + ".ready")
+            self._remove(fileName + ".data")
+
+    def recover(self):
+        out = []
+        names = set(os.listdir(self.directory))
+        for name in names:
+            base, extension = os.path.splitext(name)
+            fileName = os.path.join(self.directory, base)
+
+            if extension == ".ready":
+                try:
+                    with open(fileName + ".ready") as file:
+                        marker = json.load(file)
+                    address = DataAddress(marker["dataset"], ColumnName.parse(marker["column"]), marker["group"])
+                    assert self._fileName(address) == fileName
+                    assert os.path.getsize(fileName + ".data") == marker["numBytes"]
+                    rawarray = numpy.memmap(fileName + ".data", dtype=CacheOccupant.untyped, mode="r+", shape=(marker["numBytes"],))
+                except Exception:
+                    self._remove(fileName + ".ready")
+                    self._remove(fileName + ".data")
+                else:
+                    occupant = CacheOccupant(address, marker["numBytes"], numpy.dtype(str(marker["dtype"])), lambda address, numBytes: rawarray)
+                    occupant.setfilled(occupant.totalBytes)
+                    occupant.needCount = 0
+                    out.append(occupant)
+
+            elif (extension == ".data" and base + ".ready" not in names) or extension == ".tmp":
+                self._remove(os.path.join(self.directory, name))    # incomplete when the last worker stopped
+
+        return out
+
+class SharedMemoryAllocator(MmapFileAllocator):
+    # the same in POSIX shared memory: never paged to disk, but still shared between processes by name
+    def __init__(self, directory=None):
+        if directory is None:
+            # named for this process, so no later worker would recover it: remove it when this one exits
+            directory = os.path.join("/dev/shm", "femtocode-{0}".format(os.getpid()))
+            atexit.register(self.cleanup)
+        super(SharedMemoryAllocator, self).__init__(directory)
+
+    def cleanup(self):
+        # shared memory outlives the process (until reboot) unless its files are removed
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+################################################################ fetching
+
+class FetcherPool(object):
+    # a fixed number of threads for each kind of fetcher (backend), taking fetchers from a priority queue,
+    # so that bursts of reservations don't start a thread each and overwhelm the storage behind them
+    defaultConcurrency = 4      # for fetcher classes without a 'concurrency' attribute
+
+    def __init__(self, concurrency=None):
+        self.concurrency = {} if concurrency is None else concurrency   # fetcher class or class name -> threads
+        self.lock = threading.Lock()
+        self.queues = {}        # fetcher class -> PriorityQueue of (priority, serial, fetcher)
+        self.threads = []
+        self.serial = 0
+
+    def __repr__(self):
+        return "<FetcherPool {0} threads at 0x{1:012x}>".format(len(self.threads), id(self))
+
+    def threadsFor(self, cls):
+        if cls in self.concurrency:
+            return self.concurrency[cls]
+        elif cls.__name__ in self.concurrency:
+            return self.concurrency[cls.__name__]
+        else:
+            return getattr(cls, "concurrency", self.defaultConcurrency)
+
+    def submit(self, fetcher, priority=0):
+        # lower priority numbers first, then first come, first served
+        cls = fetcher.__class__
+        with self.lock:
+            if cls not in self.queues:
+                self.queues[cls] = queue.PriorityQueue()
+                for i in range(self.threadsFor(cls)):
+                    thread = threading.Thread(target=self._work, args=(self.queues[cls],), name="{0} {1}".format(cls.__name__, i))
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+            self.serial += 1
+            self.queues[cls].put((priority, self.serial, fetcher))
+
+    def _work(self, fetchers):
+        while True:
+            priority, serial, fetcher = fetchers.get()
+            try:
+                fetcher.run()     # not start(): run it in this thread
+            except Exception as exception:
+                # fetchers should report failures on their occupants, but don't leave a query waiting if one doesn't
+                for occupant in getattr(fetcher, "occupants", []):
+                    occupant.setfailure(ExecutionFailure(exception, sys.exc_info()[2]))
+
+class FetchLog(object):
+    # one record per fetch from fetchers that declare a 'fetchLog' attribute, so that slow storage
+    # can be told apart from stuck storage and alerted on
+    length = 1000                          # most recent records kept
+    slowBytesPerSecond = 10*1024**2        # fetches slower than this are counted in the summary
+
     def __init__(self):
-        self.order = []     # from oldest to newest (add with .append, evict with [:occupantsToEvict])
-        self.lookup = {}
+        self.lock = threading.Lock()
+        self.log = collections.deque(maxlen=self.length)
 
     def __repr__(self):
-        return "<CacheOrder len {0} at 0x{1:012x}>".format(len(self.order), id(self))
+        return "<FetchLog {0} records at 0x{1:012x}>".format(len(self.log), id(self))
+
+    def record(self, fetcher, numBytes, queued, seconds, failure=None, **details):
+        out = {"fetcher": fetcher,
+               "time": time.time(),
+               "bytes": numBytes,
+               "queued": queued,                 # seconds between reservation and the start of the fetch
+               "seconds": seconds,               # of the fetch itself
+               "bytesPerSecond": numBytes / seconds if seconds > 0 else None,
+               "failure": failure}
+        out.update(details)
+        with self.lock:
+            self.log.append(out)
+        return out
+
+    def records(self):
+        with self.lock:
+            return list(self.log)
+
+    def summary(self):
+        out = {}
+        for record in self.records():
+            if record["fetcher"] not in out:
+                out[record["fetcher"]] = {"fetches": 0, "failures": 0, "slow": 0, "bytes": 0, "seconds": 0.0, "maxQueued": 0.0, "maxSeconds": 0.0}
+            x = out[record["fetcher"]]
+            x["fetches"] += 1
+            x["maxQueued"] = max(x["maxQueued"], record["queued"])
+            x["maxSeconds"] = max(x["maxSeconds"], record["seconds"])
+            if record["failure"] is not None:
+                x["failures"] += 1
+            else:
+                if record["bytesPerSecond"] is not None and record["bytesPerSecond"] < self.slowBytesPerSecond:
+                    x["slow"] += 1
+                x["bytes"] += record["bytes"]
+                x["seconds"] += record["seconds"]
+
+        for x in out.values():
+            x["bytesPerSecond"] = x["bytes"] / x["seconds"] if x["seconds"] > 0 else None
+        return out
+
+################################################################ spill tier
+
+class SpillTier(object):
+    # a second tier on local disk with its own budget: ready occupants evicted from memory are written here
+    # by a background thread, and reserve repopulates them from a mapping of the file instead of fetching them
+    maxPending = 16             # evicted occupants waiting to be written; beyond this they are simply dropped
+
+    def __init__(self, directory, limitBytes):
+        self.directory = directory
+        self.limitBytes = limitBytes
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for name in os.listdir(self.directory):
+            if name.endswith(".spill") or name.endswith(".tmp"):
+                MmapFileAllocator._remove(os.path.join(self.directory, name))
+
+        self.lock = threading.Lock()               # the writer adds files, CacheMaster opens them
+        self.order = collections.OrderedDict()     # address -> numBytes, least recently used first
+        self.usedBytes = 0
+        self.pending = queue.Queue(self.maxPending)
+
+        self.writer = threading.Thread(target=self._write, name="SpillTier writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def __repr__(self):
+        return "<SpillTier {0} at 0x{1:012x}>".format(repr(self.directory), id(self))
+
+    def __contains__(self, address):
+        with self.lock:
+            return address in self.order
+
+    def spill(self, occupant):
+        # (adopted maps of source files are as quick to fetch again, and might have changed)
+        if 0 < occupant.totalBytes <= self.limitBytes and occupant.ready() and occupant.compressed is None and occupant.sourceFile is None:
+            try:
+                self.pending.put_nowait(occupant)  # keeps the array alive until it's written
+            except queue.Full:
+                pass
+
+    def _write(self):
+        while True:
+            occupant = self.pending.get()
+            try:
+                self._writeOne(occupant)
+            finally:
+                self.pending.task_done()   # so that self.pending.join() waits for everything spilled so far
+
+    def _writeOne(self, occupant):
+        fileName = addressFileName(self.directory, occupant.address)
+        try:
+            with open(fileName + ".tmp", "wb") as file:
+                occupant.rawarray.tofile(file)
+            os.rename(fileName + ".tmp", fileName + ".spill")
+        except Exception:
+            MmapFileAllocator._remove(fileName + ".tmp")    # e.g. disk full: just don't keep it
+            return
+
+        with self.lock:
+            if occupant.address in self.order:
+                self.usedBytes -= self.order.pop(occupant.address)
+            self.order[occupant.address] = occupant.totalBytes
+            self.usedBytes += occupant.totalBytes
+
+            while self.usedBytes > self.limitBytes:
+                address, numBytes = self.order.popitem(last=False)
+                self.usedBytes -= numBytes
+                MmapFileAllocator._remove(addressFileName(self.directory, address) + ".spill")
+
+    def open(self, address, numBytes):
+        # a read-only mapping, which stays valid even if the file is removed to make room for others
+        with self.lock:
+            if self.order.get(address) != numBytes:
+                return None
+            self.order[address] = self.order.pop(address)      # most recently used
+            try:
+                return numpy.memmap(addressFileName(self.directory, address) + ".spill", dtype=CacheOccupant.untyped, mode="r", shape=(numBytes,))
+            except Exception:
+                self.usedBytes -= self.order.pop(address)
+                return None
+
+    class Fetcher(threading.Thread):
+        # like a dataset's fetcher, but copying from mapped spill files (read from disk by page faults, off CacheMaster's thread)
+        concurrency = 2
+
+        def __init__(self, occupants, mapped):
+            super(SpillTier.Fetcher, self).__init__()
+            self.occupants = occupants
+            self.mapped = mapped
+            self.daemon = True
+
+        def run(self):
+            for occupant, mapped in zip(self.occupants, self.mapped):
+                try:
+                    occupant.rawarray[:] = mapped
+                except Exception as exception:
+                    occupant.setfailure(ExecutionFailure(exception, sys.exc_info()[2]))
+                else:
+                    occupant.setfilled(occupant.totalBytes)
+
+################################################################ eviction policies
+
+# Every policy keeps the 'wants' of a NeedWantCache: occupants that are not in use and may be evicted.
+# Iteration is in eviction order (first is evicted first) and must not change the policy's state.
+# Sizes are residentBytes, which is what evicting an occupant gives back.
+
+class CacheOrder(object):
+    # least recently used
+    def __init__(self, limitBytes=None):
+        self.lookup = collections.OrderedDict()   # from oldest to newest: every operation is O(1)
+        self.totalBytes = 0
+
+    def __repr__(self):
+        return "<CacheOrder len {0} at 0x{1:012x}>".format(len(self.lookup), id(self))
 
     def __len__(self):
-        assert len(self.order) == len(self.lookup)
-        return len(self.order)
+        return len(self.lookup)
 
     def __contains__(self, address):
         return address in self.lookup
@@ -108,51 +624,301 @@ class CacheOrder(object):
         return self.lookup[address]
 
     def __iter__(self):
-        return iter(self.order)
+        return iter(self.lookup.values())
 
     def add(self, occupant):
         assert occupant.address not in self.lookup
-        self.order.append(occupant)
         self.lookup[occupant.address] = occupant
+        self.totalBytes += occupant.residentBytes
 
     def discard(self, occupant):
-        try:
-            self.order.remove(occupant)
-        except ValueError:
-            pass
-        try:
+        if self.lookup.get(occupant.address) is occupant:
             del self.lookup[occupant.address]
-        except KeyError:
-            pass
+            self.totalBytes -= occupant.residentBytes
+
+    def resized(self, occupant, oldBytes):
+        # its residentBytes changed (compressed) without changing its place in the order
+        self.totalBytes += occupant.residentBytes - oldBytes
 
     def extract(self, address):
         assert address in self.lookup
-        occupant = None
-        i = len(self.order)   # walk backwards from the most recent because NeedWantCache is more likely
-        while i > 0:          # to promote a recent item from 'want' to 'need' than an old item
-            i -= 1
-            if self.order[i].address == address:
-                occupant = self.order[i]
-                break
-        assert occupant is not None
-        del self.order[i]
-        del self.lookup[address]
+        occupant = self.lookup.pop(address)
+        self.totalBytes -= occupant.residentBytes
         return occupant
 
     def evict(self, numToEvict):
         # lose all Python references to the rawarrays in CacheOccupants so that they can be garbage collected
-        if numToEvict > 0:
-            for occupant in self.order[:numToEvict]:
-                del self.lookup[occupant.address]
-            self.order = self.order[numToEvict:]
+        evicted = []
+        for i in range(min(numToEvict, len(self.lookup))):
+            address, occupant = self.lookup.popitem(last=False)
+            self.totalBytes -= occupant.residentBytes
+            evicted.append(occupant)
+        return evicted
+
+class PriorityOrder(object):
+    # evicts lowest priority first; an occupant's priority is fixed when it becomes a 'want'
+    def __init__(self, limitBytes=None):
+        self.lookup = {}      # address -> occupant
+        self.entries = {}     # address -> its current heap entry; entries not in here are stale
+        self.heap = []        # (priority, serial, address), serial breaks ties by age
+        self.serial = 0
+        self.totalBytes = 0
 
-class NeedWantCache(object):
+    def __repr__(self):
+        return "<{0} len {1} at 0x{2:012x}>".format(self.__class__.__name__, len(self.lookup), id(self))
+
+    def priority(self, occupant):
+        raise NotImplementedError
+
+    def evicted(self, priority):
+        pass
+
+    def __len__(self):
+        return len(self.lookup)
+
+    def __contains__(self, address):
+        return address in self.lookup
+
+    def __getitem__(self, address):
+        return self.lookup[address]
+
+    def __iter__(self):
+        # walk the heap as a tree, always expanding the smallest node seen so far: k steps cost O(k log k)
+        heap = self.heap
+        if len(heap) == 0:
+            return
+        frontier = [(heap[0], 0)]
+        while len(frontier) > 0:
+            entry, index = heapq.heappop(frontier)
+            address = entry[2]
+            if self.entries.get(address) is entry:
+                yield self.lookup[address]
+            for child in (2*index + 1, 2*index + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+    def add(self, occupant):
+        assert occupant.address not in self.lookup
+        entry = (self.priority(occupant), self.serial, occupant.address)
+        self.serial += 1
+        self.lookup[occupant.address] = occupant
+        self.entries[occupant.address] = entry
+        heapq.heappush(self.heap, entry)
+        self.totalBytes += occupant.residentBytes
+
+    def _remove(self, address):
+        occupant = self.lookup.pop(address)
+        del self.entries[address]
+        self.totalBytes -= occupant.residentBytes
+        if len(self.heap) > 2*len(self.entries) + 64:
+            # too many stale entries: rebuild
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+        return occupant
+
+    def discard(self, occupant):
+        if self.lookup.get(occupant.address) is occupant:
+            self._remove(occupant.address)
+
+    def resized(self, occupant, oldBytes):
+        self.totalBytes += occupant.residentBytes - oldBytes
+
+    def extract(self, address):
+        assert address in self.lookup
+        return self._remove(address)
+
+    def evict(self, numToEvict):
+        evicted = []
+        while len(evicted) < numToEvict and len(self.entries) > 0:
+            entry = heapq.heappop(self.heap)
+            if self.entries.get(entry[2]) is entry:
+                self.evicted(entry[0])
+                evicted.append(self._remove(entry[2]))
+        return evicted
+
+class LFUOrder(PriorityOrder):
+    # least frequently used, least recently used among equals
+    def priority(self, occupant):
+        return occupant.uses
+
+class GreedyDualSizeOrder(PriorityOrder):
+    # GreedyDual-Size (Cao & Irani): priority is refetch cost per byte, plus an inflation that rises
+    # to the priority of each evicted occupant, so that occupants not used for a long time age out;
+    # with popularity, the cost is multiplied by the number of uses (GDSF)
+    popularity = True
+
+    def __init__(self, limitBytes=None):
+        super(GreedyDualSizeOrder, self).__init__(limitBytes)
+        self.inflation = 0.0
+
+    def priority(self, occupant):
+        cost = occupant.refetchCost
+        if self.popularity:
+            cost *= occupant.uses
+        return self.inflation + float(cost) / max(occupant.residentBytes, 1)
+
+    def evicted(self, priority):
+        self.inflation = priority
+
+class ARCOrder(object):
+    # Adaptive Replacement Cache (Megiddo & Modha), counting bytes rather than items: 'recent' holds
+    # occupants used once, 'frequent' those used again; addresses evicted from each are remembered
+    # as ghosts, and using one again moves the target size of 'recent' toward the list it came from
     def __init__(self, limitBytes):
         self.limitBytes = limitBytes
+        self.recent = collections.OrderedDict()          # address -> occupant, oldest first
+        self.frequent = collections.OrderedDict()
+        self.recentGhosts = collections.OrderedDict()    # address -> numBytes, oldest first
+        self.frequentGhosts = collections.OrderedDict()
+        self.recentBytes = 0
+        self.frequentBytes = 0
+        self.recentGhostBytes = 0
+        self.frequentGhostBytes = 0
+        self.target = 0                                  # desired bytes in 'recent'
 
-        self.usedBytes = 0
+    def __repr__(self):
+        return "<ARCOrder len {0} at 0x{1:012x}>".format(len(self), id(self))
+
+    @property
+    def totalBytes(self):
+        return self.recentBytes + self.frequentBytes
+
+    def __len__(self):
+        return len(self.recent) + len(self.frequent)
+
+    def __contains__(self, address):
+        return address in self.recent or address in self.frequent
+
+    def __getitem__(self, address):
+        if address in self.recent:
+            return self.recent[address]
+        else:
+            return self.frequent[address]
+
+    def __iter__(self):
+        # same choices as evict would make, without making them
+        recent = iter(self.recent.values())
+        frequent = iter(self.frequent.values())
+        recentLeft = self.recentBytes
+        recentNext = next(recent, None)
+        frequentNext = next(frequent, None)
+        while recentNext is not None or frequentNext is not None:
+            if frequentNext is None or (recentNext is not None and recentLeft > self.target):
+                yield recentNext
+                recentLeft -= recentNext.residentBytes
+                recentNext = next(recent, None)
+            else:
+                yield frequentNext
+                frequentNext = next(frequent, None)
+
+    def add(self, occupant):
+        address = occupant.address
+        assert address not in self
+        numBytes = occupant.residentBytes
+
+        if address in self.recentGhosts:
+            # evicted from 'recent' too soon: make 'recent' bigger
+            self.recentGhostBytes -= self.recentGhosts.pop(address)
+            self.target = min(self.limitBytes, self.target + max(float(self.frequentGhostBytes) / max(self.recentGhostBytes, 1), 1.0) * numBytes)
+            self._addFrequent(occupant)
+
+        elif address in self.frequentGhosts:
+            # evicted from 'frequent' too soon: make 'recent' smaller
+            self.frequentGhostBytes -= self.frequentGhosts.pop(address)
+            self.target = max(0, self.target - max(float(self.recentGhostBytes) / max(self.frequentGhostBytes, 1), 1.0) * numBytes)
+            self._addFrequent(occupant)
+
+        elif occupant.uses > 1:
+            self._addFrequent(occupant)
+
+        else:
+            self.recent[address] = occupant
+            self.recentBytes += numBytes
+
+    def _addFrequent(self, occupant):
+        self.frequent[occupant.address] = occupant
+        self.frequentBytes += occupant.residentBytes
+
+    def _remove(self, address):
+        if address in self.recent:
+            occupant = self.recent.pop(address)
+            self.recentBytes -= occupant.residentBytes
+        else:
+            occupant = self.frequent.pop(address)
+            self.frequentBytes -= occupant.residentBytes
+        return occupant
+
+    def discard(self, occupant):
+        if self.recent.get(occupant.address) is occupant or self.frequent.get(occupant.address) is occupant:
+            self._remove(occupant.address)
+
+    def resized(self, occupant, oldBytes):
+        if occupant.address in self.recent:
+            self.recentBytes += occupant.residentBytes - oldBytes
+        else:
+            self.frequentBytes += occupant.residentBytes - oldBytes
+
+    def extract(self, address):
+        assert address in self
+        return self._remove(address)
+
+    def evict(self, numToEvict):
+        evicted = list(itertools.islice(iter(self), numToEvict))
+        for occupant in evicted:
+            if occupant.address in self.recent:
+                self.recentGhosts[occupant.address] = occupant.residentBytes
+                self.recentGhostBytes += occupant.residentBytes
+            else:
+                self.frequentGhosts[occupant.address] = occupant.residentBytes
+                self.frequentGhostBytes += occupant.residentBytes
+            self._remove(occupant.address)
+
+        # ghosts remember at most a cache's worth of bytes, 'recent' and its ghosts no more than that
+        while len(self.recentGhosts) > 0 and self.recentBytes + self.recentGhostBytes > self.limitBytes:
+            self.recentGhostBytes -= self.recentGhosts.popitem(last=False)[1]
+        while len(self.frequentGhosts) > 0 and self.recentGhostBytes + self.frequentGhostBytes > self.limitBytes:
+            self.frequentGhostBytes -= self.frequentGhosts.popitem(last=False)[1]
+
+        return evicted
+
+evictionPolicies = {"lru": CacheOrder, "lfu": LFUOrder, "gds": GreedyDualSizeOrder, "arc": ARCOrder}
+
+################################################################ cache
+
+class NeedWantCache(object):
+    rememberEvicted = 1000000      # how many evicted addresses to remember, to count refetches
+    fairnessQuantum = 16           # a query may be dispatched this many workItems ahead of another waiting query
+    maxBatch = 16                  # most workItems reserved together by maybeReserveBatch
+    lookahead = 4                  # waiting workItems whose columns maybeSpeculate may fetch ahead of time
+    speculativeFraction = 0.25     # of limitBytes that speculative fetches may take while in flight
+    compressAfter = 1.0            # seconds a 'want' must go unused before it's compressed (with a compressor)
+    compressLookahead = 8          # 'wants' at the cold end of the eviction order considered on each pass
+
+    def __init__(self, limitBytes, allocator=None, policy="lru", spillTier=None, compressor=None, fetcherPool=None):
+        self.limitBytes = limitBytes
+        self.allocator = HeapAllocator() if allocator is None else allocator
+        self.spillTier = spillTier     # optional SpillTier: evicted occupants go to disk rather than away
+        self.compressor = compressor   # optional ShuffleCompressor: cold 'wants' are compressed until needed again
+        self.coldCompressor = None if compressor is None else ColdCompressor(compressor, self.notify)
+        self.fetcherPool = fetcherPool # optional FetcherPool; without it, each fetcher is a thread of its own
+        if isinstance(policy, string_types):
+            policy = evictionPolicies[policy](limitBytes)
+
+        self.usedBytes = 0             # residentBytes of all occupants
         self.need = {}             # unordered: we need them all, cannot proceed without them
-        self.want = CacheOrder()   # least recently used is most likely to be evicted
+        self.want = policy         # in the order that they would be evicted (see evictionPolicies)
+        self.onchange = None       # CacheMaster's wakeup: called when any occupant changes state
+
+        # statistics for comparing policies
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytesFetched = 0
+        self.bytesRefetched = 0
+        self.spillHits = 0
+        self.compressions = 0
+        self.recentlyEvicted = collections.OrderedDict()    # address -> refetchCost
+        self.fetchLog = FetchLog()
 
     def __repr__(self):
         return "<NeedWantCache at 0x{0:012x}>".format(id(self))
@@ -164,10 +930,40 @@ class NeedWantCache(object):
             if not occupant.stillNeeded():
                 todemote.append(occupant)
 
+        now = time.time()
         for occupant in todemote:
             del self.need[occupant.address]
+            if occupant.ready():
+                self.allocator.ready(occupant)
+            occupant.idleSince = now
             self.want.add(occupant)
 
+        if len(todemote) > 0:
+            # a dict doesn't shrink when items are deleted, and iterating over it costs its largest-ever size
+            self.need = dict(self.need)
+
+        self.compressCold()
+
+    def compressCold(self):
+        # 'wants' that will likely be used again soon stay as they are; ones that have gone cold are compressed
+        # on the ColdCompressor's thread, and the compressed bytes replace them here if they're still unused
+        if self.coldCompressor is None:
+            return
+
+        for occupant, rawarray, data in self.coldCompressor.finished():
+            if data is not None and occupant.address in self.want and self.want[occupant.address] is occupant and occupant.rawarray is rawarray:
+                oldBytes = occupant.residentBytes
+                self.allocator.free(occupant)       # before setcompressed, while it still has its rawarray
+                occupant.setcompressed(data)
+                self.usedBytes -= oldBytes - occupant.residentBytes
+                self.want.resized(occupant, oldBytes)
+                self.compressions += 1
+
+        now = time.time()
+        for occupant in itertools.islice(self.want, self.compressLookahead):
+            if occupant.compressed is None and occupant.sourceFile is None and occupant.idleSince is not None and now - occupant.idleSince >= self.compressAfter and occupant.ready():
+                self.coldCompressor.submit(occupant)
+
     def removeFailures(self):
         toremove = []
         for occupant in self.need.values():
@@ -176,6 +972,8 @@ class NeedWantCache(object):
                     toremove.append(occupant)
         for occupant in toremove:
             del self.need[occupant.address]
+            self.usedBytes -= occupant.totalBytes
+            self.allocator.free(occupant)
 
         toremove = []
         for occupant in self.want:
@@ -184,60 +982,174 @@ class NeedWantCache(object):
                     toremove.append(occupant)
         for occupant in toremove:
             self.want.discard(occupant)
+            self.usedBytes -= occupant.residentBytes
+            self.allocator.free(occupant)
+
+    def notify(self):
+        if self.onchange is not None:
+            self.onchange()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"policy": self.want.__class__.__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": float(self.hits) / requests if requests > 0 else None,
+                "evictions": self.evictions,
+                "bytesFetched": self.bytesFetched,
+                "bytesRefetched": self.bytesRefetched,
+                "spillHits": self.spillHits,
+                "compressions": self.compressions,
+                "usedBytes": self.usedBytes,
+                "limitBytes": self.limitBytes,
+                "fetchers": self.fetchLog.summary()}
+
+    def recover(self):
+        # complete occupants left by a previous worker become 'wants'
+        for occupant in self.allocator.recover():
+            if occupant.address not in self.need and occupant.address not in self.want:
+                occupant.listener = self.notify
+                self.want.add(occupant)
+                self.usedBytes += occupant.totalBytes
 
     def howManyToEvict(self, workItem):
-        required = workItem.required()
+        required = set(workItem.required())
 
         neededBytes = 0
+        requiredWantBytes = 0
         for address in required:
-            if address not in self.need and address not in self.want:
+            if address in self.want:
+                occupant = self.want[address]
+                requiredWantBytes += occupant.residentBytes
+                neededBytes += occupant.totalBytes - occupant.residentBytes    # decompressing it
+            elif address not in self.need:
                 neededBytes += workItem.columnBytes(address.column)
 
         additionalBytesRequired = max(neededBytes - (self.limitBytes - self.usedBytes), 0)
+        if neededBytes == 0 or additionalBytesRequired == 0:
+            return 0
+        if self.want.totalBytes - requiredWantBytes < additionalBytesRequired:
+            return None      # can't fit even if we evict everything: don't walk the whole list to find out
 
+        # reserve promotes this workItem's 'wants' before evicting, so count only the others
         numToEvict = 0
         reclaimableBytes = 0
         for occupant in self.want:
+            if reclaimableBytes >= additionalBytesRequired:
+                break
             if occupant.address not in required:
-                if reclaimableBytes >= additionalBytesRequired:
-                    break
-
                 numToEvict += 1
-                reclaimableBytes += occupant.totalBytes
+                reclaimableBytes += occupant.residentBytes
 
-        if reclaimableBytes >= additionalBytesRequired:
-            return numToEvict
-        else:
-            return None
+        return numToEvict
 
     def reserve(self, workItem, numToEvict):
-        # clear some space
-        self.want.evict(numToEvict)
+        required = workItem.required()
 
-        tofetch = []
-        for address in workItem.required():
+        neededBytes = 0
+        todecompress = []
+        compressed = []
+        for address in required:
             if address in self.need:                        # case 1: "I need it, too!"
-                self.need[address].incrementNeed()
+                occupant = self.need[address]
+                occupant.incrementNeed()
+                occupant.uses += 1
+                self.hits += 1
+
+            elif address in self.want and self.want[address].stale():
+                # case 2c: mapped from a source file that has changed: drop it and fetch again (case 3)
+                occupant = self.want.extract(address)
+                self.usedBytes -= occupant.residentBytes
+                self.allocator.free(occupant)
+                neededBytes += workItem.columnBytes(address.column)
 
             elif address in self.want:                      # case 2: a "want" becomes a "need"
                 occupant = self.want.extract(address)
+                if occupant.compressed is not None:         # (case 2b: decompressed by a fetcher, off this thread)
+                    self.usedBytes += occupant.totalBytes - occupant.residentBytes
+                    todecompress.append(occupant)
+                    compressed.append(occupant.uncompress(self.allocator.allocate))
                 occupant.incrementNeed()
+                occupant.uses += 1
                 self.need[address] = occupant
+                self.hits += 1
 
-            else:                                           # case 3: brand new, need to fetch it
+            else:
+                neededBytes += workItem.columnBytes(address.column)
+
+        # clear some space (after case 2, so that this workItem's own 'wants' are not evicted);
+        # continue past numToEvict if the policy's order changed when case 2 extracted its 'wants'
+        evicted = self.want.evict(numToEvict)
+        while True:
+            for occupant in evicted:
+                self.usedBytes -= occupant.residentBytes
+                if self.spillTier is not None:
+                    self.spillTier.spill(occupant)
+                self.allocator.free(occupant)
+                self.evictions += 1
+                self.recentlyEvicted[occupant.address] = occupant.refetchCost
+            if len(self.want) == 0 or self.usedBytes + neededBytes <= self.limitBytes:
+                break
+            evicted = self.want.evict(1)
+
+        while len(self.recentlyEvicted) > self.rememberEvicted:
+            self.recentlyEvicted.popitem(last=False)
+
+        tofetch = []
+        tounspill = []
+        mapped = []
+        for address in required:
+            if address not in self.need:                    # case 3: brand new, need to fetch it
                 occupant = CacheOccupant(address,
                                          workItem.columnBytes(address.column),
                                          workItem.columnDtype(address.column),
-                                         CacheOccupant.allocate)
+                                         self.allocator.allocate)
+                occupant.listener = self.notify
+                self.usedBytes += occupant.totalBytes
                 # (need starts at 1, don't have to incrementNeed)
                 self.need[address] = occupant
-                tofetch.append(occupant)
+
+                spilled = None
+                if self.spillTier is not None:
+                    spilled = self.spillTier.open(address, occupant.totalBytes)
+
+                if spilled is not None:                     # (case 3b: from the spill tier, not the source)
+                    tounspill.append(occupant)
+                    mapped.append(spilled)
+                    self.spillHits += 1
+                    occupant.refetchCost = self.recentlyEvicted.pop(address, occupant.refetchCost)
+                else:
+                    tofetch.append(occupant)
+                    self.misses += 1
+                    self.bytesFetched += occupant.totalBytes
+                    if address in self.recentlyEvicted:
+                        del self.recentlyEvicted[address]
+                        self.bytesRefetched += occupant.totalBytes
 
             workItem.attachOccupant(self.need[address])
 
+        if len(todecompress) > 0:
+            self.startFetcher(ColdCompressor.Fetcher(todecompress, compressed, self.compressor), workItem)
+
+        if len(tounspill) > 0:
+            self.startFetcher(SpillTier.Fetcher(tounspill, mapped), workItem)
+
         if len(tofetch) > 0:
             fetcher = workItem.executor.query.dataset.fetcher(tofetch, workItem)
+            refetchCost = getattr(fetcher, "refetchCost", 1.0)
+            for occupant in tofetch:
+                occupant.refetchCost = refetchCost
+            self.startFetcher(fetcher, workItem)
+
+    def startFetcher(self, fetcher, workItem):
+        if hasattr(fetcher, "fetchLog"):
+            fetcher.fetchLog = self.fetchLog
+            fetcher.submitted = time.time()
+
+        if self.fetcherPool is None:
             fetcher.start()
+        else:
+            self.fetcherPool.submit(fetcher, workItem.executor.priority)
 
     def maybeReserve(self, waiting):
         # make sure occupants no longer in use by Minion are in the "wants" list and can be evicted
@@ -273,8 +1185,154 @@ class NeedWantCache(object):
         else:
             return None
 
+    def maybePrefetch(self, prefetching):
+        # low priority: only what fits in free space without evicting anything, in the order requested
+        while len(prefetching) > 0:
+            workItem = prefetching[0]
+            if all(address in self.need or address in self.want for address in workItem.required()):
+                del prefetching[0]           # already cached: nothing to do
+            elif self.howManyToEvict(workItem) == 0:
+                del prefetching[0]
+                self.reserve(workItem, 0)
+                return workItem
+            else:
+                return None
+        return None
+
+    def maybeSpeculate(self, waiting, inflightBytes):
+        # the first few waiting workItems couldn't be reserved (whole) because the cache is full of 'needs';
+        # fetch as many of their missing columns as fit in free space, as 'wants', so that I/O overlaps
+        # the computation they're waiting for; inflightBytes of previous speculation count against the budget
+        budget = min(self.speculativeFraction * self.limitBytes - inflightBytes, self.limitBytes - self.usedBytes)
+
+        out = []
+        for workItem in waiting[:self.lookahead]:
+            columns = []
+            numBytes = 0
+            for address in workItem.required():
+                if address not in self.need and address not in self.want:
+                    columnBytes = workItem.columnBytes(address.column)
+                    if numBytes + columnBytes <= budget:
+                        columns.append(address.column)
+                        numBytes += columnBytes
+
+            if len(columns) > 0:
+                prefetch = Prefetch(workItem.executor.query.dataset, columns)
+                prefetch.priority = workItem.executor.priority    # it's for a real query
+                speculative = WorkItem(prefetch, workItem.group)
+                if self.howManyToEvict(speculative) == 0:
+                    self.reserve(speculative, 0)
+                    out.append(speculative)
+                    budget -= numBytes
+
+        return out
+
+    @staticmethod
+    def indexWaiting(waiting):
+        # DataAddress -> [(position, workItem)] of the waiting workItems that require it, so that finding
+        # companions doesn't rescan the whole waiting list; build once per pass and pass it to maybeReserveBatch
+        index = {}
+        for position, workItem in enumerate(waiting):
+            for address in workItem.required():
+                index.setdefault(address, []).append((position, workItem))
+        return index
+
+    def maybeReserveBatch(self, waiting, dispatched, index=None):
+        # like maybeReserve, but ranks work by how many workItems each query has already had dispatched
+        # (query id -> number in 'dispatched') before ranking by eviction, and then reserves 'companions':
+        # other waiting workItems that share a column (hence a group) with the first and whose columns
+        # are now all cached or being fetched, so that one fetch feeds many queries back-to-back
+        self.demoteNeedsToWants()
+
+        bestRank = None
+        bestIndex = None
+        for i, workItem in enumerate(waiting):
+            numToEvict = self.howManyToEvict(workItem)
+            if numToEvict is not None:
+                rank = (dispatched.get(workItem.executor.query.id, 0) // self.fairnessQuantum, numToEvict)
+                if bestRank is None or rank < bestRank:    # strict < for FIRST of equal rank
+                    bestRank = rank
+                    bestIndex = i
+                    if rank == (0, 0):
+                        break                              # can't do better than that
+
+        if bestIndex is None:
+            return []
+
+        if index is None:
+            index = self.indexWaiting(waiting)
+
+        primary = waiting[bestIndex]
+        self.reserve(primary, bestRank[1])
+        batch = [primary]
+
+        candidates = {}
+        for address in primary.required():
+            for position, workItem in index.get(address, ()):
+                if workItem is not primary:
+                    candidates[id(workItem)] = position, workItem
+
+        for position, workItem in sorted(candidates.values(), key=lambda x: x[0]):
+            if len(batch) >= self.maxBatch:
+                break
+            if all(address in self.need or address in self.want for address in workItem.required()):
+                self.reserve(workItem, 0)
+                batch.append(workItem)
+
+        taken = set(id(workItem) for workItem in batch)
+        for workItem in batch:
+            for address in workItem.required():
+                entries = index.get(address)
+                if entries is not None:
+                    entries[:] = [x for x in entries if id(x[1]) not in taken]
+        waiting[:] = [workItem for workItem in waiting if id(workItem) not in taken]
+        return batch
+
+class Prefetch(object):
+    # stands in for an executor in CacheMaster: its WorkItems bring columns of the dataset's groups
+    # into the cache and are then released as 'wants' without running anything
+    priority = 100             # after any query (see FetcherPool)
+
+    def __init__(self, dataset, columns=None):
+        if columns is None:
+            columns = dataset.columns.keys()
+
+        self.required = set()
+        for column in columns:
+            if isinstance(column, string_types):
+                column = ColumnName.parse(column)
+            self.required.add(column)
+            if column in dataset.columns and dataset.columns[column].size is not None:
+                self.required.add(dataset.columns[column].size)
+
+        self.query = self          # CacheMaster and WorkItem look for executor.query.{id, dataset, cancelled, lock}
+        self.id = "prefetch-{0:012x}".format(id(self))
+        self.dataset = dataset
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Prefetch {0} of {1} columns at 0x{2:012x}>".format(self.dataset.name, len(self.required), id(self))
+
+    def oneLoadDone(self, groupid):
+        pass
+
+    def oneFailure(self, failure):
+        pass                       # nobody is waiting for it
+
 class CacheMaster(threading.Thread):
-    loopdelay = 0.001           # 1 ms       pause time at the end of the loop
+    idledelay = 0.1             # 100 ms     wake at least this often, to notice cancelled queries
+    sharedScan = True           # send each batch of queries on one group to a Minion as a CompositeWorkItem
+    historyLength = 100         # recent queries' datasets and columns, for replay
+
+    class _WakingQueue(queue.Queue):
+        def __init__(self, wakeup):
+            queue.Queue.__init__(self)   # old-style class in Python 2
+            self.wakeup = wakeup
+
+        def put(self, item, block=True, timeout=None):
+            queue.Queue.put(self, item, block, timeout)
+            self.wakeup.set()
 
     def __init__(self, needWantCache, minions):
         super(CacheMaster, self).__init__()
@@ -283,10 +1341,19 @@ class CacheMaster(threading.Thread):
 
         assert len(self.minions) > 0
 
-        self.incoming = queue.Queue()
+        # new executors, finished fetches, and occupants released by minions all set this
+        self.wakeup = threading.Event()
+        self.needWantCache.onchange = self.wakeup.set
+
+        self.incoming = CacheMaster._WakingQueue(self.wakeup)
         self.outgoing = minions[0].incoming
         self.waiting = []
         self.loading = []
+        self.dispatched = {}     # query id -> number of workItems reserved, for fairness among queries
+        self.prefetching = []    # WorkItems of Prefetches, lowest priority
+        self.prefetchLoading = []
+        self.speculating = []    # WorkItems for columns of blocked work, fetched ahead of time
+        self.history = collections.deque(maxlen=self.historyLength)   # (dataset, required columns)
 
         self.daemon = True
 
@@ -296,11 +1363,50 @@ class CacheMaster(threading.Thread):
     def prepare(self, executor):   # overloaded in the server
         return executor
 
+    def release(self, loading):
+        # Prefetch WorkItems are done when they're loaded: they don't need their occupants anymore
+        stillLoading = []
+        for workItem in loading:
+            if workItem.ready():
+                workItem.decrementNeed()
+            elif workItem.fetchfailure() is not None:
+                workItem.decrementNeed()
+                self.needWantCache.removeFailures()   # don't leave a failed prefetch for a query to find
+            else:
+                stillLoading.append(workItem)
+        return stillLoading
+
+    def prefetch(self, dataset, columns=None):
+        # fill the cache with columns (all if None) of the dataset's groups in the background, at low priority
+        self.incoming.put(Prefetch(dataset, columns))
+
+    def replay(self, numQueries=None):
+        # prefetch what the last numQueries (all remembered if None) queries used, e.g. to warm up after a restart
+        history = list(self.history)
+        if numQueries is not None:
+            history = history[-numQueries:]
+        seen = set()
+        for dataset, required in reversed(history):
+            key = (dataset.name, tuple(sorted(str(x) for x in required)), tuple(group.id for group in dataset.groups))
+            if key not in seen:
+                seen.add(key)
+                self.prefetch(dataset, required)
+
     def run(self):
         while True:
-            # put new work in the waiting
+            # sleep until something changes; clear before looking so that no change is missed
+            self.wakeup.wait(self.idledelay)
+            self.wakeup.clear()
+
+            # put new work in the waiting (or prefetching)
             for executor in drainQueue(self.incoming):
+                if isinstance(executor, Prefetch):
+                    for group in executor.dataset.groups:
+                        self.prefetching.append(WorkItem(executor, group))
+                    continue
+
                 executor = self.prepare(executor)
+                self.history.append((executor.query.dataset, list(executor.required)))
                 for group in executor.query.dataset.groups:
                     self.waiting.append(WorkItem(executor, group))
 
@@ -318,17 +1424,47 @@ class CacheMaster(threading.Thread):
             while len(todrop) > 0:
                 del self.waiting[todrop.pop()]
 
+            # forget queries that have nothing left waiting
+            if len(self.dispatched) > 0:
+                live = set(workItem.executor.query.id for workItem in self.waiting)
+                self.dispatched = dict((queryid, n) for queryid, n in self.dispatched.items() if queryid in live)
+
             # move work from waiting to loading or minions
+            index = self.needWantCache.indexWaiting(self.waiting)
             while True:
-                # try to reserve space in the cache for the next surviving workItem
-                workItem = self.needWantCache.maybeReserve(self.waiting)
-                if workItem is None:
+                # try to reserve space in the cache for the next surviving workItems, grouped by shared columns
+                batch = self.needWantCache.maybeReserveBatch(self.waiting, self.dispatched, index)
+                if len(batch) == 0:
                     break
-                elif workItem.ready():
-                    self.outgoing.put(workItem)
-                    workItem.executor.oneLoadDone(workItem.group.id)
-                else:
-                    self.loading.append(workItem)
+                for workItem in batch:
+                    queryid = workItem.executor.query.id
+                    self.dispatched[queryid] = self.dispatched.get(queryid, 0) + 1
+
+                if self.sharedScan and len(batch) > 1:
+                    batch = [CompositeWorkItem(batch)]
+
+                for workItem in batch:
+                    if workItem.ready():
+                        self.outgoing.put(workItem)
+                        for member in workItem.members():
+                            member.executor.oneLoadDone(member.group.id)
+                    else:
+                        self.loading.append(workItem)
+
+            # prefetch only when no query is waiting; otherwise, fetch ahead for work that's blocked
+            if len(self.waiting) == 0:
+                while True:
+                    workItem = self.needWantCache.maybePrefetch(self.prefetching)
+                    if workItem is None:
+                        break
+                    self.prefetchLoading.append(workItem)
+            else:
+                inflightBytes = sum(occupant.totalBytes for workItem in self.speculating for occupant in workItem.occupants)
+                self.speculating.extend(self.needWantCache.maybeSpeculate(self.waiting, inflightBytes))
+
+            # prefetched columns that have arrived become 'wants'
+            self.prefetchLoading = self.release(self.prefetchLoading)
+            self.speculating = self.release(self.speculating)
 
             # move work from loading to minions
             toremove = []
@@ -336,14 +1472,13 @@ class CacheMaster(threading.Thread):
                 if workItem.ready():
                     toremove.append(index)
                     self.outgoing.put(workItem)
-                    workItem.executor.oneLoadDone(workItem.group.id)
+                    for member in workItem.members():
+                        member.executor.oneLoadDone(member.group.id)
                 else:
                     fetchfailure = workItem.fetchfailure()
                     if fetchfailure is not None:
-                        workItem.executor.oneFailure(fetchfailure)
+                        for member in workItem.members():
+                            member.executor.oneFailure(fetchfailure)
                         toremove.append(index)
             while len(toremove) > 0:
                 del self.loading[toremove.pop()]
-
-            # no busy wait
-            time.sleep(self.loopdelay)
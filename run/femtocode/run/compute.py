@@ -14,9 +14,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import copy
+import logging
+import multiprocessing
 import threading
 import time
 import sys
+import traceback
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import numpy
 
@@ -25,6 +34,9 @@ from femtocode.util import *
 from femtocode.dataset import ColumnName
 from femtocode.dataset import sizeType
 from femtocode.execution import ExecutionFailure
+from femtocode.execution import Loop
+
+logger = logging.getLogger(__name__)
 
 class DataAddress(object):
     def __init__(self, dataset, column, group):
@@ -39,19 +51,26 @@ class DataAddress(object):
         return other.__class__ == DataAddress and other.dataset == self.dataset and other.column == self.column and other.group == self.group
 
     def __hash__(self):
-        return hash(("DataAddress", self.dataset, self.column, self.group))
+        # memoized: these are dict keys throughout the cache, and hashing a ColumnName is not cheap
+        if not hasattr(self, "_hash"):
+            self._hash = hash(("DataAddress", self.dataset, self.column, self.group))
+        return self._hash
 
 class WorkItem(object):
     def __init__(self, executor, group):
         self.executor = executor
         self.group = group
         self.occupants = []
+        self._required = None
 
     def __repr__(self):
         return "<WorkItem for query {0}, group {1} at 0x{2:012x}>".format(self.executor.query.id, self.group.id, id(self))
 
     def required(self):
-        return [DataAddress(self.executor.query.dataset.name, column, self.group.id) for column in self.executor.required]
+        # memoized: the scheduler asks for it on every pass over the waiting list
+        if self._required is None:
+            self._required = [DataAddress(self.executor.query.dataset.name, column, self.group.id) for column in self.executor.required]
+        return self._required
 
     def columnBytes(self, column):
         if isinstance(column, string_types):
@@ -92,10 +111,33 @@ class WorkItem(object):
         inarrays = dict((x.address.column, x.array()) for x in self.occupants)
         return self.executor.run(inarrays, self.group, self.executor.query.dataset.columns)
 
-    def decrementNeed(self):
-        assert len(self.occupants) != 0
-        for occupant in self.occupants:
-            occupant.decrementNeed()
+    def members(self):
+        return [self]
+
+class CompositeWorkItem(object):
+    # WorkItems of several queries on the same group (sharing occupants), run back-to-back by one Minion
+    # so that each query's loops find the group's columns still hot in CPU cache
+    def __init__(self, workItems):
+        assert len(workItems) > 0
+        assert all(x.group.id == workItems[0].group.id for x in workItems)
+        self.workItems = workItems
+        self.group = workItems[0].group
+
+    def __repr__(self):
+        return "<CompositeWorkItem of {0} queries, group {1} at 0x{2:012x}>".format(len(self.workItems), self.group.id, id(self))
+
+    def members(self):
+        return self.workItems
+
+    def ready(self):
+        return all(x.ready() for x in self.workItems)
+
+    def fetchfailure(self):
+        for x in self.workItems:
+            fetchfailure = x.fetchfailure()
+            if fetchfailure is not None:
+                return fetchfailure
+        return None
 
 class Minion(threading.Thread):
     def __init__(self, incoming):
@@ -106,25 +148,199 @@ class Minion(threading.Thread):
     def __repr__(self):
         return "<Minion at 0x{0:012x}>".format(id(self))
 
+    def compute(self, workItem):
+        return workItem.run()
+
     def run(self):
         while True:
-            workItem = self.incoming.get()
+            # a WorkItem or a CompositeWorkItem, whose members are run consecutively
+            for workItem in self.incoming.get().members():
+                self.runWorkItem(workItem)
+
+    def runWorkItem(self, workItem):
+        # don't process cancelled queries
+        if workItem.executor.query.cancelled:
+            workItem.executor.oneFailure(ExecutionFailure("User cancelled query.", None))
+        with workItem.executor.query.lock:
+            cancelled = workItem.executor.query.cancelled
+        if cancelled: return
+
+        try:
+            # actually do the work; ideally 99.999% of the time spent in this whole project
+            # should be in that second line there
+            subtally, subtime = self.compute(workItem)
+        except Exception as exception:
+            workItem.executor.oneFailure(ExecutionFailure(exception, sys.exc_info()[2]))
+        else:
+            workItem.executor.oneComputeDone(workItem.group.id, subtime, subtally)
+
+        # for the cache
+        workItem.decrementNeed()
+
+def portableExecutor(executor):
+    # only the parts of an executor that a child process needs to run it: no future, tally, or locks
+    query = executor.query
+    out = executor.__class__.__new__(executor.__class__)
+    out.query = query.__class__(query.dataset, query.libs, query.inputs, query.statements, query.actions, False, query.crosscheck)
+    for name in "order", "required", "columnToSegmentKey", "debug", "numThreads":
+        if name in executor.__dict__:
+            out.__dict__[name] = executor.__dict__[name]
 
-            # don't process cancelled queries
-            if workItem.executor.query.cancelled:
-                workItem.executor.oneFailure(ExecutionFailure("User cancelled query.", None))
-            with workItem.executor.query.lock:
-                cancelled = workItem.executor.query.cancelled
-            if cancelled: continue
+    # compiled loops that can't be serialized (serializeNative depends on the Numba version) are compiled again in the child
+    if "order" in out.__dict__ and not all(serializableLoop(loop) for loop in out.order):
+        out.order = [uncompiledLoop(loop) for loop in out.order]
+        out.recompile = True
+    return out
 
+def serializableLoop(loop):
+    if not isinstance(loop, Loop):
+        return True
+    for loopFunction in loop.prerun, loop.run:
+        if loopFunction is not None:
             try:
-                # actually do the work; ideally 99.999% of the time spent in this whole project
-                # should be in that second line there
-                subtally, subtime = workItem.run()
+                loopFunction.__getstate__()
+            except Exception:
+                return False
+    return True
+
+def uncompiledLoop(loop):
+    if not isinstance(loop, Loop):
+        return loop
+    out = copy.copy(loop)
+    out.prerun = None
+    out.run = None
+    return out
+
+def unpickleExecutor(executorBytes):
+    executor = pickle.loads(executorBytes)
+    if executor.__dict__.pop("recompile", False):
+        executor.codeCache = None
+        executor.compileLoops(executor.debug)
+    return executor
+
+def shareArray(occupant):
+    # memory-mapped occupants are passed by file name (no copy); anything else is pickled
+    rawarray = occupant.rawarray
+    if isinstance(rawarray, numpy.memmap) and rawarray.filename is not None and len(rawarray) > 0:
+        return "mmap", rawarray.filename, rawarray.offset, len(rawarray), occupant.dtype
+    else:
+        return "copy", occupant.array()
+
+def openArray(shared):
+    if shared[0] == "mmap":
+        mode, fileName, offset, numBytes, dtype = shared
+        # copy-on-write: writable, as Numba signatures require, but never written back
+        return numpy.memmap(fileName, dtype=numpy.uint8, mode="c", offset=offset, shape=(numBytes,)).view(dtype)
+    else:
+        return shared[1]
+
+def processMinionMain(connection):
+    executors = {}
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return     # parent is gone
+
+        if message[0] == "forget":
+            executors.pop(message[1], None)
+
+        elif message[0] == "run":
+            command, key, executorBytes, group, arrays = message
+            try:
+                if executorBytes is not None:
+                    executors[key] = unpickleExecutor(executorBytes)
+                executor = executors[key]
+                inarrays = dict((column, openArray(shared)) for column, shared in arrays.items())
+                result = executor.run(inarrays, group, executor.query.dataset.columns)
+            except Exception as exception:
+                result = ExecutionFailure(exception, traceback.format_exc())
+
+            try:
+                connection.send(result)
             except Exception as exception:
-                workItem.executor.oneFailure(ExecutionFailure(exception, sys.exc_info()[2]))
+                connection.send(ExecutionFailure("could not return result from ProcessMinion: {0}".format(exception), traceback.format_exc()))
+
+class ProcessMinion(Minion):
+    # runs WorkItems in a child process so that work holding the GIL (Python executors, tolist, custom functions)
+    # doesn't serialize across minions; this thread only ships arrays to the child and subtallies back
+    executorLimit = 100
+
+    def __init__(self, incoming):
+        super(ProcessMinion, self).__init__(incoming)
+        # fork now, before this process starts any threads of its own
+        self.startChild()
+        self.inChild = 0        # WorkItems run in the child process
+        self.inParent = 0       # WorkItems whose executors couldn't be pickled, run in this process
+
+    def stats(self):
+        return {"inChild": self.inChild, "inParent": self.inParent}
+
+    def startChild(self):
+        self.connection, childConnection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=processMinionMain, args=(childConnection,))
+        self.process.daemon = True
+        self.process.start()
+        childConnection.close()                   # so that recv sees EOF if the child dies
+        self.sent = collections.OrderedDict()     # id(executor) -> (executor, in child?), mirrors the child's cache
+
+    def restartChild(self):
+        # the child died (e.g. a segfault in compiled code) or the pipe is broken: replace it with a fresh one
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.startChild()
+
+    def __repr__(self):
+        return "<ProcessMinion pid {0} at 0x{1:012x}>".format(self.process.pid, id(self))
+
+    def compute(self, workItem):
+        key = id(workItem.executor)   # holding the executor in self.sent keeps this id from being reused
+        forgotten = []
+
+        if key in self.sent:
+            executor, inChild = self.sent.pop(key)
+            self.sent[key] = executor, inChild
+            executorBytes = None
+        else:
+            try:
+                executorBytes = pickle.dumps(portableExecutor(workItem.executor), pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError, AttributeError) as err:
+                # e.g. custom functions that are lambdas: these stay in this process
+                logger.warning("%r runs %r in its own process, not the child: %s", self, workItem.executor, err)
+                executorBytes = None
+                inChild = False
             else:
-                workItem.executor.oneComputeDone(workItem.group.id, subtime, subtally)
+                inChild = True
+
+            self.sent[key] = workItem.executor, inChild
+            while len(self.sent) > self.executorLimit:
+                forgottenKey, (executor, forgottenInChild) = self.sent.popitem(last=False)
+                if forgottenInChild:
+                    forgotten.append(forgottenKey)
+
+        if not inChild:
+            self.inParent += 1
+            return workItem.run()
+        self.inChild += 1
+
+        arrays = dict((occupant.address.column, shareArray(occupant)) for occupant in workItem.occupants)
+        try:
+            for forgottenKey in forgotten:
+                self.connection.send(("forget", forgottenKey))
+            self.connection.send(("run", key, executorBytes, workItem.group, arrays))
+            result = self.connection.recv()
+
+        except (EOFError, IOError, OSError):
+            # only this WorkItem fails; the next one (and its executor) goes to a new child
+            exitcode = self.process.exitcode
+            self.restartChild()
+            result = ExecutionFailure("ProcessMinion child died (exit code {0}) while running this work item".format(exitcode), None)
 
-            # for the cache
-            workItem.decrementNeed()
+        if isinstance(result, ExecutionFailure):
+            result.reraise()
+        return result
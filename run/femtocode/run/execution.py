@@ -14,15 +14,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import collections
 import ctypes
+import hashlib
+import json
+import os
+import tempfile
 import threading
 import time
-import base64
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 import llvmlite.binding
 import numba
 import numpy
 
+import femtocode.version
 from femtocode.asts import statementlist
 from femtocode.dataset import ColumnName
 from femtocode.defs import *
@@ -30,6 +44,7 @@ from femtocode.execution import *
 from femtocode.lib.standard import StandardLibrary
 from femtocode.typesystem import *
 from femtocode.testdataset import TestSession
+from femtocode.run.vectorized import explodedLengths
 
 # initialize all the parts of LLVM that Numba needs
 numba.jit([(numba.float64[:],)], nopython=True)(lambda x: x[0])
@@ -42,7 +57,7 @@ class PyObject(ctypes.Structure):
 
 PyObjectPtr = ctypes.POINTER(PyObject)
 
-def compileToNative(loopFunction, inputs):
+def compileToNative(loopFunction, inputs, nogil=False):
     numbaSizeType = numba.from_dtype(numpy.dtype(sizeType))[:]
 
     sig = []
@@ -60,11 +75,11 @@ def compileToNative(loopFunction, inputs):
             assert False, "unexpected type: {0}".format(param)
 
     sig = tuple(sig)
-    return numba.jit([sig], nopython=True)(loopFunction.fcn)
+    return numba.jit([sig], nopython=True, nogil=nogil)(loopFunction.fcn)
 
 def serializeNative(nativefcn):
     assert len(nativefcn.overloads) == 1, "expected function to have exactly one signature"
-    cres = nativefcn.overloads.values()[0]
+    cres = list(nativefcn.overloads.values())[0]
     llvmnames = [x.name for x in cres.library._final_module.functions if x.name.startswith("cpython.")]
     assert len(llvmnames) == 1, "expected only one function from dynamically generated Python"
     return llvmnames[0], cres.library._compiled_object
@@ -89,8 +104,8 @@ def deserializeNative(llvmname, compiledobj):
     # find the function within the compiled code
     fcnptr = llvmengine.get_function_address(llvmname)
 
-    # interpret it as a Python function
-    cpythonfcn = ctypes.CFUNCTYPE(PyObjectPtr, PyObjectPtr, PyObjectPtr, PyObjectPtr)(fcnptr)
+    # interpret it as a Python function; PYFUNCTYPE keeps the GIL for unboxing (nogil kernels release it themselves)
+    cpythonfcn = ctypes.PYFUNCTYPE(PyObjectPtr, PyObjectPtr, PyObjectPtr, PyObjectPtr)(fcnptr)
 
     # make sure this engine gets persisted
     cpythonfcn.llvmengine = llvmengine
@@ -137,7 +152,7 @@ class DeserializedLoopFunction(CompiledLoopFunction):
         return self.fcn(ctypes.cast(id(closure), PyObjectPtr), ctypes.cast(id(args), PyObjectPtr), ctypes.cast(id(kwds), PyObjectPtr))
 
     def __getstate__(self):
-        return self.llvmname, self.compiledobj
+        return self.llvmname, self.compiledobj, self.parameters
 
     def toJson(self):
         return {"class": self.__class__.__module__ + "." + self.__class__.__name__,
@@ -145,8 +160,230 @@ class DeserializedLoopFunction(CompiledLoopFunction):
                 "code": base64.b64encode(self.compiledobj),
                 "parameters": [x.toJson() for x in self.parameters]}
 
+class NativeCodeCache(object):
+    # compiled loops on disk, one pickle per loop, least recently used files are deleted first
+    def __init__(self, directory, limitBytes=1024**3):
+        self.directory = directory
+        self.limitBytes = limitBytes
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0           # loops that couldn't be stored (serialization or disk errors)
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return "<NativeCodeCache {0} hits {1} misses {2} failures {3} at 0x{4:012x}>".format(repr(self.directory), self.hits, self.misses, self.failures, id(self))
+
+    @staticmethod
+    def signature(loop, inputs, nogil=False):
+        # must be called before compileToPython assigns loop.prerun and loop.run
+        return json.dumps({"loop": loop.toJson(),
+                           "inputs": dict((str(k), str(v)) for k, v in inputs.items()),
+                           "nogil": nogil,
+                           "femtocode": femtocode.version.version,    # the code generator
+                           "numba": numba.__version__,
+                           "cpu": llvmlite.binding.get_host_cpu_name()}, sort_keys=True)
+
+    def _fileName(self, signature):
+        # Query.id comes from hash(), which is not stable across processes, so key on content
+        return os.path.join(self.directory, hashlib.sha1(signature.encode("utf-8")).hexdigest() + ".pkl")
+
+    def restore(self, loop, signature):
+        def load(state):
+            if state is None:
+                return None
+            else:
+                llvmname, compiledobj, parameters = state
+                return DeserializedLoopFunction(deserializeNative(llvmname, compiledobj), parameters, llvmname, compiledobj)
+
+        fileName = self._fileName(signature)
+        if not os.path.exists(fileName):
+            entry = None
+        else:
+            try:
+                with open(fileName, "rb") as file:
+                    entry = pickle.load(file)
+                if entry["signature"] != signature:
+                    entry = None
+                else:
+                    prerun, run = load(entry["prerun"]), load(entry["run"])
+                    os.utime(fileName, None)    # mtime is the LRU clock
+            except Exception:
+                # truncated or incompatible: a miss, and don't try it again
+                entry = None
+                try:
+                    os.remove(fileName)
+                except OSError:
+                    pass
+
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            return False
+
+        loop.prerun = prerun
+        loop.run = run
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, loop, signature):
+        def dump(loopFunction):
+            if loopFunction is None:
+                return None
+            elif isinstance(loopFunction, DeserializedLoopFunction):
+                return loopFunction.llvmname, loopFunction.compiledobj, loopFunction.parameters
+            else:
+                return serializeNative(loopFunction.fcn) + (loopFunction.parameters,)
+
+        # best-effort: the loop is already compiled, so a cache that can't take it (read-only or full directory,
+        # a Numba whose serialization differs) must not fail the query
+        tmpName = None
+        try:
+            entry = {"signature": signature, "prerun": dump(loop.prerun), "run": dump(loop.run)}
+
+            # write-then-rename so that concurrent readers never see a partial file
+            fd, tmpName = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpName, self._fileName(signature))
+
+        except Exception:
+            with self.lock:
+                self.failures += 1
+            if tmpName is not None:
+                try:
+                    os.remove(tmpName)
+                except OSError:
+                    pass
+            return False
+
+        self.evict()
+        return True
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".pkl"):
+                    fileName = os.path.join(self.directory, name)
+                    try:
+                        stat = os.stat(fileName)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, fileName))
+
+            usedBytes = sum(size for mtime, size, fileName in entries)
+            for mtime, size, fileName in sorted(entries):
+                if usedBytes <= self.limitBytes:
+                    break
+                try:
+                    os.remove(fileName)
+                except OSError:
+                    pass
+                usedBytes -= size
+
+class NativeExecutorCache(object):
+    # compiled loops of recent queries, in memory; Query equality is semantic, so equivalent submissions share them
+    def __init__(self, limit=100):
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self.compiled = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<NativeExecutorCache {0} hits {1} misses {2} at 0x{3:012x}>".format(len(self.compiled), self.hits, self.misses, id(self))
+
+    @staticmethod
+    def _key(query):
+        # Query.__eq__ ignores inputs, but the compiled loops depend on their types
+        return query, tuple(sorted(query.inputs.items(), key=lambda x: str(x[0])))
+
+    def get(self, query):
+        key = self._key(query)
+        with self.lock:
+            compiled = self.compiled.pop(key, None)
+            if compiled is None:
+                self.misses += 1
+            else:
+                self.compiled[key] = compiled    # move to most recently used
+                self.hits += 1
+            return compiled
+
+    def put(self, query, executor):
+        # keep only what is shared: not the future or tally of the executor that compiled it
+        key = self._key(query)
+        with self.lock:
+            self.compiled.pop(key, None)
+            self.compiled[key] = (executor.order, executor.required)
+            while len(self.compiled) > self.limit:
+                self.compiled.popitem(last=False)
+
+class RangePool(object):
+    # long-lived daemon threads that run the ranges of split loops (see NativeExecutor.runLoop), shared by all executors
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def __repr__(self):
+        return "<RangePool {0} threads at 0x{1:012x}>".format(len(self.threads), id(self))
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.tasks = queue.Queue()
+        self.threads = []
+
+    def _work(self, tasks):
+        while True:
+            function, arguments, done = tasks.get()
+            try:
+                function(*arguments)
+            except Exception as exception:
+                done.put(exception)
+            else:
+                done.put(None)
+
+    def run(self, function, argumentsList):
+        # the first on this thread, the rest on the pool; an exception in any reaches the caller
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()    # forked (e.g. a ProcessMinion): the parent's threads aren't here
+            while len(self.threads) < len(argumentsList) - 1:
+                thread = threading.Thread(target=self._work, args=(self.tasks,), name="RangePool-{0}".format(len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            tasks = self.tasks
+
+        done = queue.Queue()
+        for arguments in argumentsList[1:]:
+            tasks.put((function, arguments, done))
+
+        failures = []
+        try:
+            function(*argumentsList[0])
+        except Exception as exception:
+            failures.append(exception)
+
+        for arguments in argumentsList[1:]:
+            failure = done.get()
+            if failure is not None:
+                failures.append(failure)
+
+        if len(failures) > 0:
+            raise failures[0]
+
 class NativeExecutor(Executor):
-    def __init__(self, query, debug):
+    numThreads = 1               # threads per group; more than one compiles kernels that release the GIL
+    minEntriesPerThread = 10000  # don't split a group into ranges smaller than this
+    rangePool = RangePool()      # runs the ranges of a split group, rather than new threads for every loop
+
+    def __init__(self, query, debug, codeCache=None, numThreads=1):
+        self.codeCache = codeCache
+        self.numThreads = numThreads
         super(NativeExecutor, self).__init__(query, debug)
 
     @staticmethod
@@ -163,18 +400,94 @@ class NativeExecutor(Executor):
         for lib in self.query.libs:
             fcntable = fcntable.fork(lib.table.asdict())
 
+        # custom functions are arbitrary Python, so they can't be fingerprinted for the disk cache
+        codeCache = self.codeCache
+        if debug or len(self.query.libs) > 0:
+            codeCache = None
+
+        nogil = self.numThreads > 1
+
         for i, loop in enumerate(self.order):
             if isinstance(loop, Loop):
+                if codeCache is not None:
+                    signature = codeCache.signature(loop, self.query.inputs, nogil)
+                    if codeCache.restore(loop, signature):
+                        continue
+
                 fcnname = "f{0}_{1}".format(self.query.id, i)
                 loop.compileToPython(fcnname, self.query.inputs, fcntable, True, debug)
 
                 if loop.prerun is not None:
-                    fcn = compileToNative(loop.prerun, self.query.inputs)
+                    fcn = compileToNative(loop.prerun, self.query.inputs, nogil)
                     loop.prerun = CompiledLoopFunction(fcn, loop.prerun.parameters)
 
-                fcn = compileToNative(loop.run, self.query.inputs)
+                fcn = compileToNative(loop.run, self.query.inputs, nogil)
                 loop.run = CompiledLoopFunction(fcn, loop.run.parameters)
 
+                if codeCache is not None:
+                    codeCache.store(loop, signature)
+
+    @staticmethod
+    def splittable(loop):
+        # entries are independent and each entry's data are contiguous: flat loops and single top-level collections
+        if loop.explodesize is not None:
+            return False
+        elif loop.plateauSize is None:
+            return True
+        else:
+            return len(loop.explosions) == 1 and loop.explosions[0].depth() == 1
+
+    def runLoop(self, loop, arguments):
+        for param, arg in zip(loop.run.parameters, arguments):
+            if isinstance(param, Countdown):
+                countdown = arg
+            elif isinstance(param, SizeArray):
+                sizearray = arg
+
+        numEntries = int(countdown[0])
+        numRanges = min(self.numThreads, numEntries // self.minEntriesPerThread)
+        if numRanges < 2 or not self.splittable(loop):
+            loop.run(*arguments)
+            return
+
+        # Explode arguments have one item per entry; all other data have one item per datum
+        perEntry = set(explode.data for explode in loop.explodes)
+        if loop.plateauSize is None:
+            offsets = numpy.arange(numEntries + 1, dtype=sizeType)
+        else:
+            offsets = numpy.zeros(numEntries + 1, dtype=sizeType)
+            numpy.cumsum(sizearray[:numEntries], out=offsets[1:])
+
+        # each range writes into its own view of the output arrays, so nothing needs to be concatenated
+        bounds = [numEntries * i // numRanges for i in range(numRanges + 1)]
+        ranges = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            dataStart, dataStop = int(offsets[start]), int(offsets[stop])
+            rangeCountdown = self.makeArray(len(countdown), sizeType, True)
+            rangeCountdown[0] = stop - start
+
+            rangeArguments = []
+            for param, arg in zip(loop.run.parameters, arguments):
+                if isinstance(param, Countdown):
+                    rangeArguments.append(rangeCountdown)
+                elif isinstance(param, SizeArray) or (isinstance(param, DataArray) and param.name in perEntry):
+                    rangeArguments.append(arg[start:stop])
+                elif isinstance(param, (DataArray, OutDataArray)):
+                    rangeArguments.append(arg[dataStart:dataStop])
+                else:
+                    assert False, "unexpected Parameter in splittable Loop.run: {0}".format(param)
+
+            ranges.append((rangeCountdown, rangeArguments))
+
+        # an exception in any range reaches the caller, as it would from a single thread
+        self.rangePool.run(loop.run, [rangeArguments for rangeCountdown, rangeArguments in ranges])
+
+        countdown[1] = sum(int(rangeCountdown[1]) for rangeCountdown, rangeArguments in ranges)
+        countdown[2] = sum(int(rangeCountdown[2]) for rangeCountdown, rangeArguments in ranges)
+
+    def explodedLengths(self, sizearrays, numEntries):
+        return explodedLengths(sizearrays, numEntries)
+
     def makeArray(self, length, dataType, init):
         if init:
             return numpy.zeros(length, dtype=dataType)
@@ -182,14 +495,31 @@ class NativeExecutor(Executor):
             return numpy.empty(length, dtype=dataType)
 
 class NativeAsyncExecutor(NativeExecutor):
-    def __init__(self, query, future, debug):
-        super(NativeAsyncExecutor, self).__init__(query, debug)
+    def __init__(self, query, future, debug, codeCache=None, numThreads=1):
+        super(NativeAsyncExecutor, self).__init__(query, debug, codeCache, numThreads)
+        self._setFuture(future)
+
+    @staticmethod
+    def fromCompiled(compiled, query, future, debug, numThreads=1):
+        # reuse the compiled loops of an equivalent query (see NativeExecutorCache) with a new future
+        order, required = compiled
+        out = NativeAsyncExecutor.__new__(NativeAsyncExecutor)
+        out.query = query
+        out.order = order
+        out.required = required
+        out.codeCache = None
+        out.numThreads = numThreads
+        out._setColumnToSegmentKey()
+        out.debug = debug
+        out._setFuture(future)
+        return out
 
+    def _setFuture(self, future):
         # all associated data are transient: they're lost if you serialize/deserialize
         self.future = future
         if self.future is not None:
-            self.loadsDone = dict((group.id, False) for group in query.dataset.groups)
-            self.computesDone = dict((group.id, False) for group in query.dataset.groups)
+            self.loadsDone = dict((group.id, False) for group in self.query.dataset.groups)
+            self.computesDone = dict((group.id, False) for group in self.query.dataset.groups)
             self.startTime = time.time()
             self.computeTime = 0.0
 
@@ -21,6 +21,7 @@ try:
 except ImportError:
     import queue
 
+from femtocode.dataset import ColumnName
 from femtocode.dataset import MetadataFromJson
 from femtocode.execution import ExecutionFailure
 from femtocode.numpyio.dataset import NumpyDataset
@@ -101,12 +102,48 @@ class StandaloneSession(object):
     def __init__(self,
                  numMinions=multiprocessing.cpu_count(),
                  cacheLimitBytes=1024**3,
-                 metadata=MetadataFromJson(".")):
+                 metadata=MetadataFromJson("."),
+                 codeCache=None,
+                 executorCacheLimit=100,
+                 threadsPerGroup=1,
+                 processMinions=False,
+                 allocator=None,
+                 evictionPolicy="lru",
+                 sharedScan=True,
+                 spillDirectory=None,
+                 spillLimitBytes=10*1024**3,
+                 compressWants=False,
+                 fetcherConcurrency=None):
 
         minionsIncoming = queue.Queue()
-        self.minions = [Minion(minionsIncoming) for i in range(numMinions)]
-        self.cacheMaster = CacheMaster(NeedWantCache(cacheLimitBytes), self.minions)
+        if processMinions:
+            # minions in separate processes, reading the cache through shared memory
+            self.minions = [ProcessMinion(minionsIncoming) for i in range(numMinions)]
+            if allocator is None:
+                allocator = SharedMemoryAllocator()
+        else:
+            self.minions = [Minion(minionsIncoming) for i in range(numMinions)]
+            if allocator is None:
+                allocator = HeapAllocator()
+
+        # with MmapFileAllocator on a fixed directory, columns cached by a previous session are picked up again
+        # with a spillDirectory (local SSD), columns evicted from memory are kept there up to spillLimitBytes
+        spillTier = None if spillDirectory is None else SpillTier(spillDirectory, spillLimitBytes)
+
+        # with compressWants, cached columns that no query is using are kept compressed (more fit in cacheLimitBytes)
+        compressor = ShuffleCompressor() if compressWants else None
+
+        # evictionPolicy is "lru", "lfu", "gds" (GreedyDual-Size, weighs refetch cost), "arc", or a policy object
+        # fetchers share a few threads per backend (fetcherConcurrency: fetcher class name -> number of threads)
+        fetcherPool = FetcherPool(fetcherConcurrency)
+
+        self.cacheMaster = CacheMaster(NeedWantCache(cacheLimitBytes, allocator, evictionPolicy, spillTier, compressor, fetcherPool), self.minions)
+        self.cacheMaster.needWantCache.recover()
+        self.cacheMaster.sharedScan = sharedScan    # queries on the same group run back-to-back in one Minion
         self.metadata = metadata
+        self.codeCache = codeCache    # optional NativeCodeCache: compiled loops persist across sessions
+        self.executorCache = NativeExecutorCache(executorCacheLimit)
+        self.threadsPerGroup = threadsPerGroup    # large groups are split into entry ranges run in parallel
 
         for minion in self.minions:
             minion.start()
@@ -115,13 +152,21 @@ class StandaloneSession(object):
     def source(self, name):
         return Source(self, self.metadata.dataset(name).strip())
 
-    def submit(self, query, ondone=None, onupdate=None, debug=False):
+    def submit(self, query, ondone=None, onupdate=None, debug=False, priority=0):
         # attach a more detailed Dataset to the query (same content, but with runtime details)
         query.dataset = self.metadata.dataset(query.dataset.name, list(xrange(query.dataset.numGroups)), query.inputs.keys(), False)
 
         # create an executor with a reference to the FutureQueryResult we will return to the user
         query.lock = threading.Lock()
-        executor = NativeAsyncExecutor(query, FutureQueryResult(query, ondone, onupdate), debug)
+        future = FutureQueryResult(query, ondone, onupdate)
+        compiled = None if debug else self.executorCache.get(query)
+        if compiled is None:
+            executor = NativeAsyncExecutor(query, future, debug, self.codeCache, self.threadsPerGroup)
+            if not debug:
+                self.executorCache.put(query, executor)
+        else:
+            executor = NativeAsyncExecutor.fromCompiled(compiled, query, future, debug, self.threadsPerGroup)
+        executor.priority = priority    # lower numbers are fetched sooner: e.g. 0 for interactive, 10 for batch
 
         # queue it up
         self.cacheMaster.incoming.put(executor)
@@ -129,6 +174,21 @@ class StandaloneSession(object):
         # user can watch it fill
         return executor.future
 
+    def prefetch(self, name, columns=None, groups=None):
+        # load columns (all if None) of groups (all if None) into the cache in the background, at low priority
+        if groups is None:
+            groups = list(xrange(self.metadata.dataset(name).numGroups))
+        if columns is not None:
+            columns = [ColumnName.parse(x) if isinstance(x, string_types) else x for x in columns]
+        self.cacheMaster.prefetch(self.metadata.dataset(name, groups, columns, False), columns)
+
+    def replay(self, numQueries=None):
+        # prefetch what recent queries used
+        self.cacheMaster.replay(numQueries)
+
+    def cacheStats(self):
+        return self.cacheMaster.needWantCache.stats()
+
 ########################################### TODO: temporary!
 
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+# Copyright 2016 DIANA-HEP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Whole-array execution with NumPy only (no Numba, no LLVM): loops without explosions
+# are elementwise, so each statement becomes one ufunc call over the whole column.
+
+import math
+import sys
+from functools import reduce
+
+import numpy
+
+from femtocode.asts import statementlist
+from femtocode.dataset import ColumnName
+from femtocode.defs import *
+from femtocode.execution import *
+from femtocode.lib.standard import StandardLibrary
+from femtocode.typesystem import *
+from femtocode.testdataset import TestSession
+
+def _elementwise(ufunc):
+    def out(args, schema, argschemas):
+        return ufunc(*args)
+    return out
+
+def _chained(ufunc):
+    def out(args, schema, argschemas):
+        return reduce(ufunc, args)
+    return out
+
+def _div(args, schema, argschemas):
+    # same as lib.standard.Div: dividing by zero gives +inf or -inf, never an exception or nan
+    numerator, denominator = args
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        out = numpy.true_divide(numerator, denominator)
+    return numpy.where(numpy.equal(denominator, 0), numpy.where(numpy.greater(numerator, 0), inf, -inf), out)
+
+def _pow(args, schema, argschemas):
+    base, exponent = args
+    if not schema.whole:
+        base = numpy.asarray(base, dtype=numpy.float64)
+    with numpy.errstate(all="ignore"):
+        return numpy.power(base, exponent)
+
+def _if(args, schema, argschemas):
+    predicates = args[:-1][0::3]
+    consequents = args[:-1][2::3]
+    alternate = args[-1]
+
+    # same as lib.standard.If: None becomes the NaN-equivalent of the output type
+    if isNullInt(schema):
+        nan = Number._intNaN
+    elif isNullFloat(schema):
+        nan = Number._floatNaN
+    else:
+        nan = None
+
+    def replaceNone(x):
+        if x is None:
+            return nan
+        else:
+            return x
+
+    out = replaceNone(alternate)
+    for predicate, consequent in reversed(list(zip(predicates, consequents))):
+        out = numpy.where(predicate, replaceNone(consequent), out)
+    return out
+
+def _roundlike(fcn):
+    def out(args, schema, argschemas):
+        if isInt(argschemas[0]):
+            return args[0]
+        else:
+            return fcn(args[0]).astype(numpy.int64)
+    return out
+
+if sys.version_info[0] > 2:
+    # same as the builtin round in generated code: Python 3 rounds halves to even
+    _round = numpy.round
+else:
+    def _round(x):
+        # Python 2's round: halves go away from zero
+        return numpy.copysign(numpy.floor(numpy.absolute(x) + 0.5), x)
+
+def _loglike(base):
+    def out(args, schema, argschemas):
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            if base == math.e:
+                return numpy.log(args[0])
+            else:
+                return numpy.log(args[0]) / math.log(base)
+    return out
+
+def _unsafe(ufunc):
+    # domain errors are excluded by the type system; don't let NumPy warn about them
+    def out(args, schema, argschemas):
+        with numpy.errstate(all="ignore"):
+            return ufunc(*args)
+    return out
+
+vectorizedFunctions = {
+    "+": _chained(numpy.add),
+    "-": _elementwise(numpy.subtract),
+    "u+": _elementwise(numpy.positive if hasattr(numpy, "positive") else (lambda x: x)),
+    "u-": _elementwise(numpy.negative),
+    "*": _chained(numpy.multiply),
+    "/": _div,
+    "//": _elementwise(numpy.floor_divide),
+    "**": _pow,
+    "%": _elementwise(numpy.mod),
+    "==": _elementwise(numpy.equal),
+    "!=": _elementwise(numpy.not_equal),
+    "<": _elementwise(numpy.less),
+    "<=": _elementwise(numpy.less_equal),
+    ">": _elementwise(numpy.greater),
+    ">=": _elementwise(numpy.greater_equal),
+    "and": _chained(numpy.logical_and),
+    "or": _chained(numpy.logical_or),
+    "not": _elementwise(numpy.logical_not),
+    "if": _if,
+    "round": _roundlike(_round),
+    "floor": _roundlike(numpy.floor),
+    "ceil": _roundlike(numpy.ceil),
+    "abs": _elementwise(numpy.absolute),
+    "sqrt": _unsafe(numpy.sqrt),
+    "exp": _unsafe(numpy.exp),
+    "log": _loglike(math.e),
+    "log2": _loglike(2),
+    "log10": _loglike(10),
+    "sin": _elementwise(numpy.sin),
+    "cos": _elementwise(numpy.cos),
+    "tan": _elementwise(numpy.tan),
+    "asin": _unsafe(numpy.arcsin),
+    "acos": _unsafe(numpy.arccos),
+    "atan": _elementwise(numpy.arctan),
+    "atan2": _elementwise(numpy.arctan2),
+    "sinh": _unsafe(numpy.sinh),
+    "cosh": _unsafe(numpy.cosh),
+    "tanh": _elementwise(numpy.tanh),
+    "asinh": _elementwise(numpy.arcsinh),
+    "acosh": _unsafe(numpy.arccosh),
+    "atanh": _unsafe(numpy.arctanh),
+    }
+
+def explodedLengths(sizearrays, numEntries):
+    # Executor.explodedLengths with whole-array operations
+    sizeLength = 0
+    product = numpy.ones(numEntries, dtype=numpy.uint64)
+    for sizearray in sizearrays:
+        sizeLength += int(product.sum())
+        product *= numpy.asarray(sizearray[:numEntries], dtype=numpy.uint64)
+    return int(product.sum()), sizeLength
+
+class VectorizedLoopFunction(LoopFunction):
+    # called with the same parameters as the code generated by Loop.codetext
+    def __init__(self, steps, parameters):
+        self.steps = steps
+        self.parameters = parameters
+
+    def __call__(self, *args):
+        arrays = {}
+        outputs = []
+        for param, arg in zip(self.parameters, args):
+            if isinstance(param, Countdown):
+                countdown = arg
+            elif isinstance(param, DataArray):
+                arrays[param.name] = arg
+            elif isinstance(param, OutDataArray):
+                outputs.append((param.name, arg))
+
+        if len(outputs) == 0:
+            return
+        dataLength = len(outputs[0][1])
+
+        values = {}
+        for column, fcnname, args, schema, argschemas in self.steps:
+            argvalues = []
+            for arg in args:
+                if isinstance(arg, ColumnName):
+                    if arg not in values:
+                        values[arg] = arrays[arg][:dataLength]
+                    argvalues.append(values[arg])
+                else:
+                    argvalues.append(arg.value)
+
+            values[column] = vectorizedFunctions[fcnname](argvalues, schema, argschemas)
+
+        for name, array in outputs:
+            array[:] = values[name]
+
+        countdown[1] = dataLength
+
+    def __getstate__(self):
+        return self.steps, self.parameters
+
+    def __setstate__(self, state):
+        self.steps, self.parameters = state
+
+class VectorizedExecutor(Executor):
+    fuseLoops = False    # fusion moves flat work into exploding loops, which can't be vectorized
+
+    @staticmethod
+    def vectorizable(loop, fcntable):
+        if loop.explodesize is not None or len(loop.explodes) > 0 or len(loop.explodedatas) > 0:
+            return False
+
+        for statement in loop.statements:
+            if statement.__class__ != statementlist.Call or statement.fcnname not in vectorizedFunctions:
+                return False
+            if fcntable[statement.fcnname] is not StandardLibrary.table[statement.fcnname]:
+                return False     # a custom library overrides the standard function
+
+            for arg in statement.args:
+                if not isinstance(arg, ColumnName) and not isinstance(arg.schema, (Null, Boolean, Number)):
+                    return False
+
+        return True
+
+    def compileLoops(self, debug):
+        fcntable = SymbolTable(StandardLibrary.table.asdict())
+        for lib in self.query.libs:
+            fcntable = fcntable.fork(lib.table.asdict())
+
+        for i, loop in enumerate(self.order):
+            if isinstance(loop, Loop):
+                if self.vectorizable(loop, fcntable):
+                    loop.prerun = None
+                    loop.run = self.vectorize(loop)
+                    if debug:
+                        print("\nVectorized loop {0}:".format(i))
+                        for statement in loop.statements:
+                            print("    " + str(statement))
+
+                else:
+                    fcnname = "f{0}_{1}".format(self.query.id, i)
+                    loop.compileToPython(fcnname, self.query.inputs, fcntable, False, debug)
+
+    def vectorize(self, loop):
+        # parameters in exactly the order that the generated function would have them
+        parameters, params = loop.parameters(str, self.query.inputs, False)[:2]
+        loop.targetcode(str, self.query.inputs, False, parameters, params)
+
+        schemalookup = dict(self.query.inputs)
+        steps = []
+        for statement in loop.statements:
+            argschemas = [schemalookup[x] if isinstance(x, ColumnName) else x.schema for x in statement.args]
+            steps.append((statement.column, statement.fcnname, statement.args, statement.schema, argschemas))
+            schemalookup[statement.column] = statement.schema
+
+        return VectorizedLoopFunction(steps, parameters)
+
+    def explodedLengths(self, sizearrays, numEntries):
+        return explodedLengths(sizearrays, numEntries)
+
+    def makeArray(self, length, dataType, init):
+        if init:
+            return numpy.zeros(length, dtype=dataType)
+        else:
+            return numpy.empty(length, dtype=dataType)
+
+class VectorizedTestSession(TestSession):
+    def _makeExecutor(self, query, debug):
+        return VectorizedExecutor(query, debug)
+
+    def _processArray(self, array, dataType):
+        return numpy.array(array, dtype=dataType)
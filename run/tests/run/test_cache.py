@@ -0,0 +1,717 @@
+#!/usr/bin/env python
+
+# Copyright 2016 DIANA-HEP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy
+
+from femtocode.dataset import Column
+from femtocode.dataset import ColumnName
+from femtocode.dataset import Dataset
+from femtocode.dataset import Group
+from femtocode.dataset import Segment
+from femtocode.run.cache import *
+from femtocode.run.compute import CompositeWorkItem
+from femtocode.run.compute import DataAddress
+from femtocode.run.compute import Minion
+from femtocode.run.compute import ProcessMinion
+from femtocode.run.compute import WorkItem
+from femtocode.run.execution import NativeExecutor
+from femtocode.testdataset import TestSession
+from femtocode.typesystem import *
+
+class ImmediateFetcher(object):
+    # fills occupants as soon as it starts, at the dataset's refetchCost
+    def __init__(self, occupants, workItem):
+        self.occupants = occupants
+        self.refetchCost = workItem.executor.query.dataset.refetchCost
+    def start(self):
+        for occupant in self.occupants:
+            occupant.setfilled(occupant.totalBytes)
+
+def bytesWorkItem(columns, numBytes, refetchCost=1.0, queryid=0, groupid=0, fetcher=ImmediateFetcher):
+    # a real WorkItem, on a one-group dataset whose columns are each numBytes of uint8
+    columns = [ColumnName.parse(column) for column in columns]
+    group = Group(groupid, dict((column, Segment(numBytes, numBytes, 0)) for column in columns), numBytes)
+    dataset = Dataset("dataset", None, dict((column, Column(column, None, "uint8")) for column in columns), [group], numBytes, 1)
+    dataset.fetcher = fetcher
+    dataset.refetchCost = refetchCost
+    executor = Prefetch(dataset, columns)
+    executor.id = queryid              # as if for a query (maybeReserveBatch is fair by query id)
+    return WorkItem(executor, group)
+
+def address(column, groupid=0):
+    return DataAddress("dataset", ColumnName.parse(column), groupid)
+
+def waitFor(condition, timeout=10.0):
+    # for background threads: poll, but give up (and let the test fail) if one of them has died
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+def drained(queue):
+    return lambda: queue.unfinished_tasks == 0
+
+class ProcessGroup(object):
+    def __init__(self, id):
+        self.id = id
+
+class ProcessQuery(object):
+    # the constructor signature that portableExecutor uses to strip a query down
+    def __init__(self, dataset, libs, inputs, statements, actions, cancelled, crosscheck):
+        self.dataset = dataset
+        self.libs = libs
+        self.inputs = inputs
+        self.statements = statements
+        self.actions = actions
+        self.cancelled = cancelled
+        self.crosscheck = crosscheck
+
+class ProcessExecutor(object):
+    # sums the column and says where it ran and whether it saw the parent's memory-mapped file
+    def __init__(self, libs=()):
+        self.query = ProcessQuery(ProcessQuery(None, (), {}, (), (), False, None), libs, {}, (), (), False, None)
+        self.query.dataset.columns = {}
+
+    def run(self, inarrays, group, columns):
+        if group.id == "crash":
+            os._exit(1)
+        array = inarrays[ColumnName.parse("x")]
+        return (float(array.sum()), os.getpid(), isinstance(array, numpy.memmap)), 0.0
+
+class PidNativeExecutor(NativeExecutor):
+    # a real, compiled executor that also says where it ran
+    def run(self, inarrays, group, columns):
+        subtally, subtime = super(PidNativeExecutor, self).run(inarrays, group, columns)
+        return (subtally, os.getpid()), subtime
+
+def processWorkItem(executor, allocator, groupid=0):
+    workItem = WorkItem(executor, ProcessGroup(groupid))
+    occupant = CacheOccupant(DataAddress("dataset", ColumnName.parse("x"), groupid), 80, numpy.dtype(numpy.float64), allocator)
+    occupant.fill(numpy.arange(10, dtype=numpy.float64).tobytes())
+    workItem.attachOccupant(occupant)
+    return workItem
+
+def testDataset():
+    # four groups of five entries, whose fetcher fills occupants as soon as it starts
+    session = TestSession()
+    source = session.source("Test", x=real, y=real)
+    for i in range(20):
+        source.dataset.fill({"x": i * 1.0, "y": i * 2.0}, groupLimit=5)
+
+    class Fetcher(object):
+        def __init__(self, occupants, workItem):
+            self.occupants = occupants
+            self.workItem = workItem
+        def start(self):
+            for occupant in self.occupants:
+                occupant.fill(numpy.array(self.workItem.group.segments[occupant.address.column].data, dtype=occupant.dtype).tobytes())
+
+    source.dataset.fetcher = Fetcher
+    return source.dataset
+
+class TestCache(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def test_cacheorder(self):
+        order = CacheOrder()
+        occupants = [CacheOccupant(DataAddress("dataset", ColumnName.parse("x{0}".format(i)), 0), i, numpy.dtype(numpy.uint8), CacheOccupant.allocate) for i in range(10)]
+        for occupant in occupants:
+            order.add(occupant)
+        self.assertEqual(len(order), 10)
+        self.assertEqual(order.totalBytes, 45)
+
+        self.assertTrue(order.extract(occupants[3].address) is occupants[3])
+        order.add(occupants[3])   # now the most recent
+        order.discard(occupants[5])
+        self.assertEqual(list(order), occupants[:3] + occupants[4:5] + occupants[6:] + occupants[3:4])
+
+        self.assertEqual(order.evict(2), occupants[:2])
+        self.assertEqual(order.totalBytes, 45 - 5 - 0 - 1)
+        self.assertEqual(len(order.evict(100)), 7)
+        self.assertEqual(order.totalBytes, 0)
+
+    def test_needwant(self):
+        cache = NeedWantCache(100)
+        for i in range(10):
+            workItem = bytesWorkItem(["x{0}".format(i)], 10)
+            self.assertEqual(cache.howManyToEvict(workItem), 0)
+            cache.reserve(workItem, 0)
+            workItem.decrementNeed()
+        self.assertEqual(cache.usedBytes, 100)
+
+        cache.demoteNeedsToWants()
+        self.assertEqual(len(cache.want), 10)
+
+        # full: one column in 'want' and one new column means evicting one, but never the one we're about to use
+        workItem = bytesWorkItem(["x0", "new"], 10)
+        self.assertEqual(cache.howManyToEvict(workItem), 1)
+        cache.reserve(workItem, 1)
+        self.assertTrue(all(occupant.ready() for occupant in workItem.occupants))
+        self.assertEqual(cache.usedBytes, 100)
+        self.assertTrue(address("x0") in cache.need)
+        self.assertTrue(address("x1") not in cache.want)
+
+        # too big to ever fit
+        self.assertEqual(cache.howManyToEvict(bytesWorkItem(["huge"], 1000)), None)
+
+    def test_stale(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fileName = os.path.join(tmpdir, "x.bin")
+            numpy.arange(10, dtype=numpy.uint8).tofile(fileName)
+
+            class MappingFetcher(ImmediateFetcher):
+                def start(self):
+                    for occupant in self.occupants:
+                        occupant.adopt(numpy.memmap(fileName, dtype=CacheOccupant.untyped, mode="c", shape=(occupant.totalBytes,)), fileName)
+
+            def mapping():
+                return bytesWorkItem(["x"], 10, fetcher=MappingFetcher)
+
+            cache = NeedWantCache(100)
+            first = mapping()
+            cache.reserve(first, 0)
+            first.decrementNeed()
+            cache.demoteNeedsToWants()
+            occupant = first.occupants[0]
+            self.assertFalse(occupant.stale())
+
+            again = mapping()
+            cache.reserve(again, 0)
+            self.assertTrue(again.occupants[0] is occupant)
+            again.decrementNeed()
+            cache.demoteNeedsToWants()
+
+            # rewritten under the map: fetch it again rather than read through the old map
+            numpy.arange(1, 21, dtype=numpy.uint8).tofile(fileName)
+            self.assertTrue(occupant.stale())
+            third = mapping()
+            cache.reserve(third, 0)
+            self.assertFalse(third.occupants[0] is occupant)
+            self.assertEqual(third.occupants[0].rawarray.tolist(), list(range(1, 11)))
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            self.assertEqual(cache.usedBytes, 10)
+            self.assertEqual(len(cache.want), 0)
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_policies(self):
+        def occupant(name, numBytes, uses=1, refetchCost=1.0):
+            out = CacheOccupant(DataAddress("dataset", ColumnName.parse(name), 0), numBytes, numpy.dtype(numpy.uint8), CacheOccupant.allocate)
+            out.uses = uses
+            out.refetchCost = refetchCost
+            return out
+
+        # every policy iterates in the order that it evicts, and keeps totalBytes
+        for name, policy in evictionPolicies.items():
+            order = policy(1000)
+            occupants = [occupant("x{0}".format(i), 10 + i, uses=1 + i % 3, refetchCost=1.0 + i % 5) for i in range(50)]
+            for x in occupants:
+                order.add(x)
+            order.discard(occupants[7])
+            self.assertTrue(order.extract(occupants[8].address) is occupants[8])
+            self.assertEqual(len(order), 48, name)
+            self.assertEqual(order.totalBytes, sum(x.totalBytes for x in occupants) - occupants[7].totalBytes - occupants[8].totalBytes, name)
+
+            expected = list(order)
+            self.assertEqual(set(x.address for x in expected), set(x.address for x in occupants[:7] + occupants[9:]), name)
+            evicted = order.evict(20) + order.evict(1) + order.evict(100)
+            if name != "arc":   # ARC's order depends on how much it evicted
+                self.assertEqual(evicted, expected, name)
+            self.assertEqual(set(x.address for x in evicted), set(x.address for x in expected), name)
+            self.assertEqual(len(order), 0, name)
+            self.assertEqual(order.totalBytes, 0, name)
+
+        # LFU keeps the popular one
+        order = LFUOrder()
+        popular = occupant("popular", 10, uses=5)
+        order.add(popular)
+        order.add(occupant("a", 10))
+        order.add(occupant("b", 10))
+        self.assertTrue(popular not in order.evict(2))
+
+        # GreedyDual-Size keeps the expensive one, then ages it out
+        order = GreedyDualSizeOrder()
+        remote = occupant("remote", 10, refetchCost=10.0)
+        order.add(remote)
+        order.add(occupant("local", 10, refetchCost=1.0))
+        self.assertEqual([x.address for x in order.evict(1)], [DataAddress("dataset", ColumnName.parse("local"), 0)])
+        for i in range(20):
+            order.add(occupant("new{0}".format(i), 10))
+            order.evict(1)
+        self.assertTrue(remote.address not in order)
+
+        # ARC: something used twice survives a scan of things used once
+        order = ARCOrder(50)
+        reused = occupant("reused", 10, uses=2)
+        order.add(reused)
+        for i in range(20):
+            order.add(occupant("scan{0}".format(i), 10))
+            if order.totalBytes > 50:
+                order.evict(1)
+        self.assertTrue(reused.address in order)
+
+    def test_stats(self):
+        for policy in sorted(evictionPolicies):
+            cache = NeedWantCache(30, policy=policy)
+            for name in "a", "b", "c", "d", "a", "d":
+                workItem = bytesWorkItem([name], 10, refetchCost=(10.0 if name == "a" else 1.0))
+                numToEvict = cache.howManyToEvict(workItem)
+                cache.reserve(workItem, numToEvict)
+                workItem.decrementNeed()
+                cache.demoteNeedsToWants()
+                self.assertTrue(cache.usedBytes <= 30, policy)
+
+            stats = cache.stats()
+            self.assertEqual(stats["hits"] + stats["misses"], 6, policy)
+            self.assertEqual(stats["bytesFetched"], 10 * stats["misses"], policy)
+            self.assertEqual(stats["bytesRefetched"], 10 * (stats["misses"] - 4), policy)
+            self.assertEqual(stats["evictions"], stats["misses"] - 3, policy)
+            if policy == "lru":
+                self.assertEqual(stats["hits"], 1)            # "a" was the oldest, evicted for "d"
+            if policy == "gds":
+                self.assertEqual(stats["hits"], 2)            # "a" is ten times as expensive to fetch
+
+    def test_batch(self):
+        cache = NeedWantCache(100)
+        heavy = [bytesWorkItem(["x", "y"], 10, queryid=1, groupid=i) for i in range(10)]
+        light = [bytesWorkItem(["x", "y"], 10, queryid=i, groupid=0) for i in (2, 3)]
+        other = bytesWorkItem(["x", "z"], 10, queryid=4, groupid=0)
+        waiting = heavy + light + [other]
+
+        # one fetch of group 0 feeds every query that only needs those columns
+        batch = cache.maybeReserveBatch(waiting, {})
+        self.assertEqual(batch, [heavy[0]] + light)
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(len(waiting), 10)
+        self.assertTrue(all(occupant in heavy[0].occupants for occupant in light[0].occupants))
+
+        # a query that has had many workItems dispatched waits behind one that hasn't
+        # (with one index of the waiting list for several picks, as CacheMaster does)
+        index = NeedWantCache.indexWaiting(waiting)
+        batch = cache.maybeReserveBatch(waiting, {1: NeedWantCache.fairnessQuantum}, index)
+        self.assertEqual(batch, [other])
+        self.assertEqual(index[address("z")], [])          # dispatched workItems leave the index, too
+        batch = cache.maybeReserveBatch(waiting, {1: NeedWantCache.fairnessQuantum}, index)
+        self.assertEqual(batch, [heavy[1]])
+        for workItem in [heavy[0], heavy[1], other] + light:
+            workItem.decrementNeed()
+
+        # nothing fits
+        self.assertEqual(cache.maybeReserveBatch([bytesWorkItem(["huge"], 1000)], {}), [])
+
+    def test_sharedscan(self):
+        cache = NeedWantCache(100)
+        workItems = [bytesWorkItem(["x", "y"], 10, queryid=i) for i in range(3)]
+        composite = CompositeWorkItem(cache.maybeReserveBatch(list(workItems), {}))
+        self.assertEqual(composite.members(), workItems)
+        self.assertTrue(composite.ready())
+        self.assertEqual(composite.fetchfailure(), None)
+
+        # one Minion runs every query on the shared occupants, then releases them
+        done = []
+        for workItem in workItems:
+            workItem.run = lambda workItem=workItem: (sum(x.array().sum() for x in workItem.occupants), 0.0)
+            workItem.executor.oneComputeDone = lambda groupid, subtime, subtally, workItem=workItem: done.append(workItem.executor.id)
+
+        minion = Minion(None)
+        for workItem in composite.members():
+            minion.runWorkItem(workItem)
+        self.assertEqual(done, [0, 1, 2])
+        cache.demoteNeedsToWants()
+        self.assertEqual(len(cache.need), 0)
+        self.assertEqual(len(cache.want), 2)
+
+    def test_spill(self):
+        directory = tempfile.mkdtemp()
+        try:
+            spillTier = SpillTier(directory, 15)
+            cache = NeedWantCache(20, spillTier=spillTier)
+
+            def use(name, value):
+                workItem = bytesWorkItem([name], 10)
+                cache.reserve(workItem, cache.howManyToEvict(workItem))
+                occupant = workItem.occupants[0]
+                self.assertTrue(waitFor(occupant.ready))
+                if value is not None:
+                    occupant.rawarray[:] = value
+                workItem.decrementNeed()
+                cache.demoteNeedsToWants()
+                self.assertTrue(waitFor(drained(spillTier.pending)))
+                return occupant
+
+            use("a", 1)
+            use("b", 2)
+            use("c", 3)                        # evicts "a" to disk
+            self.assertTrue(DataAddress("dataset", ColumnName.parse("a"), 0) in spillTier)
+            use("d", 4)                        # evicts "b"; "a" and "b" don't both fit in 15 bytes
+            self.assertTrue(DataAddress("dataset", ColumnName.parse("a"), 0) not in spillTier)
+            self.assertTrue(DataAddress("dataset", ColumnName.parse("b"), 0) in spillTier)
+            self.assertEqual(spillTier.usedBytes, 10)
+
+            # "b" comes back from disk, not from its source
+            occupant = use("b", None)
+            self.assertEqual(occupant.rawarray.tolist(), [2] * 10)
+            self.assertEqual(cache.spillHits, 1)
+            self.assertEqual(cache.misses, 4)
+            self.assertEqual(cache.usedBytes, 20)
+
+        finally:
+            shutil.rmtree(directory)
+
+    def test_compress(self):
+        compressor = ShuffleCompressor()
+        array = numpy.arange(1000, dtype=numpy.float64)
+        rawarray = array.view(CacheOccupant.untyped)
+        data = compressor.compress(rawarray, 8)
+        self.assertTrue(len(data) < len(rawarray) / 2)
+        out = numpy.empty(len(rawarray), dtype=CacheOccupant.untyped)
+        compressor.decompress(data, 8, out)
+        self.assertEqual(out.view(numpy.float64).tolist(), array.tolist())
+
+        # random bytes don't compress: leave them alone
+        self.assertEqual(compressor.compress(numpy.random.randint(0, 256, 1000).astype(CacheOccupant.untyped), 1), None)
+
+        # new 'wants' are left alone: they may be needed again right away
+        cache = NeedWantCache(16000, compressor=compressor)
+        workItem = bytesWorkItem(["x"], 8000)
+        cache.reserve(workItem, 0)
+        occupant = workItem.occupants[0]
+        occupant.rawarray[:] = rawarray
+        workItem.decrementNeed()
+        cache.demoteNeedsToWants()
+        self.assertTrue(waitFor(drained(cache.coldCompressor.pending)))
+        cache.demoteNeedsToWants()
+        self.assertTrue(occupant.compressed is None)
+        self.assertEqual(cache.usedBytes, 8000)
+
+        # cold 'wants' are compressed on another thread, which makes room, and decompressed by a fetcher when needed again
+        cache.compressAfter = 0.0
+        cache.demoteNeedsToWants()
+        self.assertTrue(waitFor(drained(cache.coldCompressor.pending)))
+        cache.demoteNeedsToWants()
+        self.assertTrue(occupant.compressed is not None and occupant.rawarray is None)
+        self.assertEqual(cache.compressions, 1)
+        self.assertEqual(cache.usedBytes, occupant.residentBytes)
+        self.assertEqual(cache.want.totalBytes, occupant.residentBytes)
+
+        another = bytesWorkItem(["y"], 8000)
+        self.assertEqual(cache.howManyToEvict(another), 0)
+        cache.reserve(another, 0)
+
+        again = bytesWorkItem(["x"], 8000)
+        cache.reserve(again, cache.howManyToEvict(again))
+        self.assertTrue(again.occupants[0] is occupant)
+        self.assertEqual(cache.usedBytes, 16000)
+        self.assertTrue(waitFor(occupant.ready))
+        self.assertEqual(occupant.rawarray.view(numpy.float64).tolist(), array.tolist())
+
+        # a 'want' that is needed again before its compression finishes keeps its array
+        cache = NeedWantCache(16000, compressor=compressor)
+        cache.compressAfter = 0.0
+        workItem = bytesWorkItem(["x"], 8000)
+        cache.reserve(workItem, 0)
+        workItem.occupants[0].rawarray[:] = rawarray
+        workItem.decrementNeed()
+        cache.demoteNeedsToWants()
+        self.assertTrue(waitFor(drained(cache.coldCompressor.pending)))
+        again = bytesWorkItem(["x"], 8000)
+        cache.reserve(again, 0)
+        cache.demoteNeedsToWants()
+        self.assertTrue(again.occupants[0].compressed is None)
+        self.assertEqual(cache.compressions, 0)
+
+    def test_prefetch(self):
+        dataset = testDataset()
+        cacheMaster = CacheMaster(NeedWantCache(1024), [Minion(queue.Queue())])
+        cacheMaster.start()
+        cacheMaster.prefetch(dataset, ["x"])
+
+        cache = cacheMaster.needWantCache
+        for i in range(100):
+            if len(cache.want) == 4:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(cache.want), 4)     # 4 groups of x, released as 'wants'
+        self.assertEqual(cache.misses, 4)
+        self.assertEqual(cacheMaster.minions[0].incoming.qsize(), 0)    # nothing to run
+
+        # already cached: nothing more is fetched
+        cacheMaster.prefetch(dataset, ["x"])
+        time.sleep(0.05)
+        self.assertEqual(cache.misses, 4)
+
+    def test_speculate(self):
+        dataset = testDataset()      # each column of each group is 40 bytes
+        cache = NeedWantCache(200)
+        computing = WorkItem(Prefetch(dataset, ["x", "y"]), dataset.groups[0])
+        cache.reserve(computing, 0)
+        waiting = [WorkItem(Prefetch(dataset, ["x", "y"]), group) for group in dataset.groups[1:]]
+
+        self.assertEqual(len(cache.maybeReserveBatch(waiting, {})), 1)
+        self.assertEqual(len(waiting), 2)                 # blocked: 40 bytes free, 80 bytes needed
+        self.assertEqual(cache.maybeReserveBatch(waiting, {}), [])
+
+        # fetches what fits of the next blocked workItem (also within 25% of 200 bytes)
+        speculative = cache.maybeSpeculate(waiting, 0)
+        self.assertEqual(len(speculative), 1)
+        self.assertEqual([x.address for x in speculative[0].occupants], [waiting[0].required()[0]])
+        self.assertEqual(cache.usedBytes, 200)
+        self.assertEqual(cache.maybeSpeculate(waiting, 40), [])
+
+        # when the computation finishes, the blocked workItem needs only one more column
+        speculative[0].decrementNeed()
+        computing.decrementNeed()
+        cache.demoteNeedsToWants()
+        misses = cache.misses
+        blocked = waiting[0]
+        self.assertEqual(cache.maybeReserveBatch(waiting, {}), [blocked])
+        self.assertEqual(cache.misses, misses + 1)
+        self.assertTrue(speculative[0].occupants[0] in blocked.occupants)
+
+    def test_fetcherpool(self):
+        order = []
+        started = threading.Event()
+        proceed = threading.Event()
+        finished = threading.Event()
+
+        class Fetcher(object):
+            def __init__(self, name, occupants=()):
+                self.name = name
+                self.occupants = occupants
+            def run(self):
+                if self.name == "first":
+                    started.set()
+                    proceed.wait()
+                elif self.name == "broken":
+                    raise IOError("can't reach storage")
+                order.append(self.name)
+                if self.name == "last":
+                    finished.set()
+
+        pool = FetcherPool({"Fetcher": 1})
+        pool.submit(Fetcher("first"))
+        started.wait()                 # the only thread is busy, so the rest queue up
+        occupant = CacheOccupant(DataAddress("dataset", ColumnName.parse("x"), 0), 8, numpy.dtype(numpy.float64), CacheOccupant.allocate)
+        pool.submit(Fetcher("batch"), 10)
+        pool.submit(Fetcher("broken", [occupant]), 0)
+        pool.submit(Fetcher("interactive"), 0)
+        pool.submit(Fetcher("last"), 100)
+        proceed.set()
+        finished.wait()
+
+        self.assertEqual(order, ["first", "interactive", "batch", "last"])
+        self.assertEqual(len(pool.threads), 1)
+        self.assertTrue(occupant.fetchfailure is not None)
+
+    def test_fetchlog(self):
+        class Fetcher(threading.Thread):
+            fetchLog = None
+            def run(self):
+                self.fetchLog.record("Fetcher", 100*1024**2, time.time() - self.submitted, 1.0, dataset="dataset", group=0)
+
+        cache = NeedWantCache(1000)
+        fetcher = Fetcher()
+        cache.startFetcher(fetcher, None)
+        fetcher.join(10.0)
+        self.assertFalse(fetcher.is_alive())
+        cache.fetchLog.record("Fetcher", 1024, 0.5, 1.0, dataset="dataset", group=1)
+        cache.fetchLog.record("Fetcher", 0, 0.0, 2.0, "IOError()", dataset="dataset", group=2)
+
+        self.assertEqual([x["group"] for x in cache.fetchLog.records()], [0, 1, 2])
+        summary = cache.stats()["fetchers"]["Fetcher"]
+        self.assertEqual(summary["fetches"], 3)
+        self.assertEqual(summary["failures"], 1)
+        self.assertEqual(summary["slow"], 1)
+        self.assertEqual(summary["bytes"], 100*1024**2 + 1024)
+        self.assertEqual(summary["maxSeconds"], 2.0)
+        self.assertEqual(summary["maxQueued"], 0.5)
+
+    def test_mmapallocator(self):
+        directory = tempfile.mkdtemp()
+        try:
+            allocator = MmapFileAllocator(directory)
+            address = DataAddress("dataset", ColumnName.parse("x"), 3)
+            incomplete = DataAddress("dataset", ColumnName.parse("y"), 3)
+
+            occupant = CacheOccupant(address, 80, numpy.dtype(numpy.float64), allocator.allocate)
+            occupant.fill(numpy.arange(10, dtype=numpy.float64).tobytes())
+            self.assertTrue(occupant.ready())
+            allocator.ready(occupant)
+
+            CacheOccupant(incomplete, 80, numpy.dtype(numpy.float64), allocator.allocate)
+
+            # a new worker on the same directory finds only the complete column
+            cache = NeedWantCache(1024, MmapFileAllocator(directory))
+            cache.recover()
+            self.assertEqual(len(cache.want), 1)
+            self.assertTrue(address in cache.want)
+            self.assertTrue(incomplete not in cache.want)
+
+            recovered = cache.want[address]
+            self.assertTrue(recovered.ready())
+            self.assertEqual(recovered.array().tolist(), list(range(10)))
+
+            allocator.free(recovered)
+            self.assertEqual(MmapFileAllocator(directory).recover(), [])
+
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sharedmemory(self):
+        if not os.path.isdir("/dev/shm"):
+            return
+        directory = tempfile.mkdtemp(dir="/dev/shm")
+        try:
+            allocator = SharedMemoryAllocator(directory)
+            minion = ProcessMinion(None)
+            (total, pid, mapped), subtime = minion.compute(processWorkItem(ProcessExecutor(), allocator.allocate))
+            self.assertEqual(total, 45.0)
+            self.assertEqual(pid, minion.process.pid)
+            self.assertTrue(mapped)               # passed by file name, not copied through the pipe
+
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sharedmemory_cleanup(self):
+        if not os.path.isdir("/dev/shm"):
+            return
+        allocator = SharedMemoryAllocator()
+        occupant = CacheOccupant(DataAddress("dataset", ColumnName.parse("x"), 0), 80, numpy.dtype(numpy.float64), allocator.allocate)
+        self.assertTrue(len(os.listdir(allocator.directory)) > 0)
+
+        allocator.cleanup()                       # also registered with atexit for the default directory
+        self.assertFalse(os.path.exists(allocator.directory))
+
+    def test_processminion(self):
+        minion = ProcessMinion(None)
+        executor = ProcessExecutor()
+
+        # heap arrays are copied through the pipe; the executor is sent once and then reused by key
+        for i in range(3):
+            (total, pid, mapped), subtime = minion.compute(processWorkItem(executor, CacheOccupant.allocate))
+            self.assertEqual(total, 45.0)
+            self.assertEqual(pid, minion.process.pid)
+            self.assertFalse(mapped)
+        self.assertEqual(list(minion.sent.values()), [(executor, True)])
+
+        # executors that can't be pickled (lambdas in libs) run in this process instead
+        (total, pid, mapped), subtime = minion.compute(processWorkItem(ProcessExecutor([lambda x: x]), CacheOccupant.allocate))
+        self.assertEqual(total, 45.0)
+        self.assertEqual(pid, os.getpid())
+        self.assertEqual(minion.stats(), {"inChild": 3, "inParent": 1})
+
+    def test_processminion_native(self):
+        source = TestSession().source("Test", x=real, y=real)
+        for i in range(20):
+            source.dataset.fill({"x": i * 1.0, "y": i * 2.0}, groupLimit=5)
+        query = source.toPython(a = "x + y").compile()
+        executor = PidNativeExecutor(query, False)
+        dataset = source.dataset
+
+        minion = ProcessMinion(None)
+        group = dataset.groups[1]
+        workItem = WorkItem(executor, group)
+        for address in workItem.required():
+            occupant = CacheOccupant(address, workItem.columnBytes(address.column), workItem.columnDtype(address.column), CacheOccupant.allocate)
+            occupant.fill(numpy.array(group.segments[address.column].data, dtype=occupant.dtype).tobytes())
+            workItem.attachOccupant(occupant)
+
+        (subtally, pid), subtime = minion.compute(workItem)
+        self.assertEqual(pid, minion.process.pid)
+        self.assertEqual(minion.stats(), {"inChild": 1, "inParent": 0})
+        action = query.actions[-1]
+        self.assertEqual([row.a for row in action.update(action.initialize(), subtally)], [x * 1.0 + x * 2.0 for x in range(5, 10)])
+
+    def test_processminion_crash(self):
+        minion = ProcessMinion(None)
+        executor = ProcessExecutor()
+        oldpid = minion.process.pid
+
+        # a child that dies fails only the WorkItem it was running...
+        self.assertRaises(RuntimeError, lambda: minion.compute(processWorkItem(executor, CacheOccupant.allocate, "crash")))
+        self.assertFalse(minion.process.pid == oldpid)
+
+        # ...and the next one (with the same executor) goes to a fresh child
+        (total, pid, mapped), subtime = minion.compute(processWorkItem(executor, CacheOccupant.allocate))
+        self.assertEqual(total, 45.0)
+        self.assertEqual(pid, minion.process.pid)
+
+    def test_notify(self):
+        events = []
+        occupant = CacheOccupant(DataAddress("dataset", ColumnName.parse("x"), 0), 16, numpy.dtype(numpy.float64), CacheOccupant.allocate)
+        occupant.listener = lambda: events.append("changed")
+
+        occupant.fill(numpy.zeros(1, dtype=numpy.float64).tobytes())
+        self.assertEqual(events, [])                  # half full: nothing to do yet
+        occupant.fill(numpy.zeros(1, dtype=numpy.float64).tobytes())
+        self.assertEqual(events, ["changed"])         # ready
+
+        occupant.incrementNeed()
+        occupant.decrementNeed()
+        self.assertEqual(events, ["changed"])         # still needed by someone
+        occupant.decrementNeed()
+        self.assertEqual(events, ["changed", "changed"])
+
+        occupant.setfailure("oops")
+        self.assertEqual(len(events), 3)
+
+        wakeup = threading.Event()
+        incoming = CacheMaster._WakingQueue(wakeup)
+        self.assertFalse(wakeup.is_set())
+        incoming.put("executor")
+        self.assertTrue(wakeup.is_set())
+        self.assertEqual(incoming.get(), "executor")
+
+def benchmark(numOccupants, numWorkItems=10000, numWaiting=10, policy="lru"):
+    # a full cache of numOccupants; each workItem reuses one cached column and evicts to make room for one new one
+    import time
+    cache = NeedWantCache(numOccupants * 10, policy=policy)
+    for i in range(numOccupants):
+        workItem = bytesWorkItem(["x{0}".format(i)], 10)
+        cache.reserve(workItem, 0)
+        workItem.decrementNeed()
+    cache.demoteNeedsToWants()
+
+    workItems = [bytesWorkItem(["x{0}".format(numOccupants - 1 - i * 7 % numOccupants), "new{0}".format(i)], 10) for i in range(numWorkItems)]
+    waiting = []
+    startTime = time.time()
+    for i in range(numWorkItems):
+        waiting.append(workItems[i])
+        if len(waiting) >= numWaiting or i == numWorkItems - 1:
+            while len(waiting) > 0:
+                cache.maybeReserve(waiting).decrementNeed()
+    return numWorkItems / (time.time() - startTime)
+
+if __name__ == "__main__":
+    for policy in sorted(evictionPolicies):
+        for numOccupants in 10**5, 10**6:
+            print("{0} with {1} occupants: {2:.0f} workItems scheduled per second".format(policy, numOccupants, benchmark(numOccupants, policy=policy)))
@@ -16,8 +16,12 @@
 
 import ast
 import json
+import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
 
 from femtocode.asts import lispytree
@@ -28,7 +32,7 @@ from femtocode.defs import SymbolTable
 from femtocode.execution import *
 from femtocode.lib.standard import StandardLibrary
 from femtocode.parser import parse
-from femtocode.run.execution import NativeTestSession
+from femtocode.run.execution import *
 from femtocode.typesystem import *
 from femtocode.workflow import *
 
@@ -444,3 +448,173 @@ class TestExecution(unittest.TestCase):
     def test_double_explode2(self):
         for old, new in zip(oldexample.dataset, oldexample.toPython(a = "ys.map(y1 => ys.map(y2 => y1*2 - y2*2))").submit()):
             self.assertEqual(mapp(old.ys, lambda y1: mapp(old.ys, lambda y2: y1*2 - y2*2)), new.a)
+
+    def test_codecache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            codeCache = NativeCodeCache(directory)
+
+            class CachedSession(NativeTestSession):
+                def _makeExecutor(self, query, debug):
+                    return NativeExecutor(query, debug, codeCache)
+
+            query = oldexample.toPython(a = "ys.map(y1 => ys.map(y2 => y1 + y2 + c))").compile()
+            first = CachedSession().submit(query)
+            self.assertEqual(codeCache.hits, 0)
+            self.assertTrue(codeCache.misses > 0)
+
+            second = CachedSession().submit(query)
+            if codeCache.failures == 0:
+                self.assertEqual(codeCache.hits, codeCache.misses)
+            else:
+                self.assertEqual(codeCache.hits, 0)    # this Numba can't serialize loops: nothing stored, still correct
+
+            for old, new1, new2 in zip(oldexample.dataset, first, second):
+                self.assertEqual(mapp(old.ys, lambda y1: mapp(old.ys, lambda y2: y1 + y2 + old.c)), new1.a)
+                self.assertEqual(new1.a, new2.a)
+
+        finally:
+            shutil.rmtree(directory)
+
+    def test_executorcache(self):
+        executorCache = NativeExecutorCache(2)
+        compilations = []
+
+        class CountingExecutor(NativeExecutor):
+            def compileLoops(self, debug):
+                compilations.append(self.query)
+                super(CountingExecutor, self).compileLoops(debug)
+
+        class CachingSession(NativeTestSession):
+            def _makeExecutor(self, query, debug):
+                compiled = executorCache.get(query)
+                if compiled is None:
+                    executor = CountingExecutor(query, debug)
+                    executorCache.put(query, executor)
+                    return executor
+                else:
+                    return NativeAsyncExecutor.fromCompiled(compiled, query, None, debug)
+
+        session = CachingSession()
+        first = oldexample.toPython(a = "c + d")
+        second = oldexample.toPython(a = "c - d")
+        third = oldexample.toPython(a = "c * d")
+
+        for result in session.submit(first.compile()), session.submit(first.compile()):
+            for old, new in zip(oldexample.dataset, result):
+                self.assertEqual(old.c + old.d, new.a)
+        self.assertEqual((executorCache.hits, executorCache.misses, len(compilations)), (1, 1, 1))
+
+        # least recently used is dropped beyond the limit
+        session.submit(second.compile())
+        session.submit(first.compile())
+        session.submit(third.compile())
+        self.assertEqual(len(executorCache.compiled), 2)
+        self.assertEqual(len(compilations), 3)
+        session.submit(second.compile())
+        self.assertEqual(len(compilations), 4)
+        session.submit(third.compile())
+        self.assertEqual((executorCache.hits, executorCache.misses, len(compilations)), (3, 4, 4))
+
+        # same query, different input types: not shared
+        query = first.compile()
+        query.inputs = dict((k, integer(0, 10)) for k in query.inputs)
+        self.assertEqual(executorCache.get(query), None)
+
+    def test_codecache_corrupt(self):
+        directory = tempfile.mkdtemp()
+        try:
+            codeCache = NativeCodeCache(directory)
+            signature = json.dumps({"femtocode": "test"})
+            with open(codeCache._fileName(signature), "wb") as file:
+                file.write(b"\x80\x04truncated")
+
+            self.assertFalse(codeCache.restore(None, signature))
+            self.assertEqual((codeCache.hits, codeCache.misses), (0, 1))
+            self.assertFalse(os.path.exists(codeCache._fileName(signature)))
+
+        finally:
+            shutil.rmtree(directory)
+
+    def test_codecache_unserializable(self):
+        import femtocode.run.execution
+        directory = tempfile.mkdtemp()
+        serializeNative = femtocode.run.execution.serializeNative
+        def failing(fcn):
+            raise AssertionError("expected only one function")
+        femtocode.run.execution.serializeNative = failing
+        try:
+            codeCache = NativeCodeCache(directory)
+
+            class CachedSession(NativeTestSession):
+                def _makeExecutor(self, query, debug):
+                    return NativeExecutor(query, debug, codeCache)
+
+            # the loops compiled fine, so the query runs even though they can't be stored
+            result = CachedSession().submit(oldexample.toPython(a = "c + d").compile())
+            for old, new in zip(oldexample.dataset, result):
+                self.assertEqual(old.c + old.d, new.a)
+            self.assertTrue(codeCache.failures > 0)
+            self.assertEqual(os.listdir(directory), [])      # no partial files left behind
+
+        finally:
+            femtocode.run.execution.serializeNative = serializeNative
+            shutil.rmtree(directory)
+
+    def test_threads(self):
+        class ThreadedExecutor(NativeExecutor):
+            minEntriesPerThread = 10
+
+        class ThreadedSession(NativeTestSession):
+            def _makeExecutor(self, query, debug):
+                return ThreadedExecutor(query, debug, None, 4)
+
+        threaded = ThreadedSession().source("Threaded", x=real, ys=collection(real))
+        for i in range(1000):
+            threaded.dataset.fill({"x": i * 0.5, "ys": [i * 0.1, -i * 0.2, 1.5][:i % 4]})
+
+        for old, new in zip(threaded.dataset, threaded.toPython(a = "x * 2 + 1", b = "ys.map(y => y + x)").submit()):
+            self.assertAlmostEqual(old.x * 2 + 1, new.a)
+            self.assertEqual(len(old.ys), len(new.b))
+            for o, n in zip(old.ys, new.b):
+                self.assertAlmostEqual(o + old.x, n)
+
+        # the same threads, again and again, not new ones for every loop of every group
+        pool = ThreadedExecutor.rangePool
+        threads = list(pool.threads)
+        self.assertTrue(len(threads) >= 3)
+        self.assertEqual(len(list(threaded.toPython(a = "x * 2 + 1").submit())), 1000)
+        self.assertEqual(pool.threads, threads)
+        self.assertTrue(all(thread.is_alive() for thread in threads))
+
+    def test_threads_failure(self):
+        class FailingRange(object):
+            # fails in every range but the first, which runs in the calling thread
+            def __init__(self, loopFunction, caller):
+                self.loopFunction = loopFunction
+                self.parameters = loopFunction.parameters
+                self.caller = caller
+            def __call__(self, *args):
+                if threading.current_thread() is not self.caller:
+                    raise ValueError("range failed")
+                return self.loopFunction(*args)
+
+        class FailingExecutor(NativeExecutor):
+            minEntriesPerThread = 10
+            def runLoop(self, loop, arguments):
+                original = loop.run
+                loop.run = FailingRange(original, threading.current_thread())
+                try:
+                    super(FailingExecutor, self).runLoop(loop, arguments)
+                finally:
+                    loop.run = original
+
+        class FailingSession(NativeTestSession):
+            def _makeExecutor(self, query, debug):
+                return FailingExecutor(query, debug, None, 4)
+
+        failing = FailingSession().source("Failing", x=real)
+        for i in range(1000):
+            failing.dataset.fill({"x": i * 0.5})
+
+        self.assertRaises(ValueError, lambda: failing.toPython(a = "x * 2 + 1").submit())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Copyright 2016 DIANA-HEP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import unittest
+
+import numpy
+
+from femtocode.execution import *
+from femtocode.run.vectorized import *
+from femtocode.typesystem import *
+from femtocode.workflow import *
+
+session = VectorizedTestSession()
+
+numbers = session.source("Numbers", x=real(-20, 30), y=real(-3, 3), i=integer(-50, 50), ys=collection(real))
+for j in range(100):
+    numbers.dataset.fill({"x": j * 0.37 - 15.0, "y": (j % 7) - 3.0, "i": j - 50, "ys": [j * 0.1, -j * 0.2, 1.5][:j % 4]})
+
+def mapp(obj, fcn):
+    return list(map(fcn, obj))
+
+class TestVectorized(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def test_arithmetic(self):
+        for old, new in zip(numbers.dataset, numbers.toPython(a = "x + y * 2 - i", b = "x % 3", c = "i // 7", d = "-x").submit()):
+            self.assertAlmostEqual(old.x + old.y * 2 - old.i, new.a)
+            self.assertAlmostEqual(old.x % 3, new.b)
+            self.assertEqual(old.i // 7, new.c)
+            self.assertEqual(-old.x, new.d)
+
+    def test_division(self):
+        # numerator can't be zero, or the type system would reject 0 / 0
+        for old, new in zip(numbers.dataset, numbers.toPython(a = "(abs(x) + 1) / y", b = "-(abs(x) + 1) / y").submit()):
+            if old.y == 0:
+                self.assertEqual(float("inf"), new.a)
+                self.assertEqual(float("-inf"), new.b)
+            else:
+                self.assertAlmostEqual((abs(old.x) + 1) / old.y, new.a)
+                self.assertAlmostEqual(-(abs(old.x) + 1) / old.y, new.b)
+
+    def test_math(self):
+        for old, new in zip(numbers.dataset, numbers.toPython(a = "sin(x) + cos(y)", b = "sqrt(abs(x) + y**2)", c = "round(x)", d = "atan2(y, x)").submit()):
+            self.assertAlmostEqual(math.sin(old.x) + math.cos(old.y), new.a)
+            self.assertAlmostEqual(math.sqrt(abs(old.x) + old.y**2), new.b)
+            self.assertEqual(int(round(old.x)), new.c)
+            self.assertAlmostEqual(math.atan2(old.y, old.x), new.d)
+
+    def test_round(self):
+        # halves round the same way as the builtin round in generated code
+        xs = [-2.5, -1.5, -0.5, 0.5, 1.5, 2.5, 3.7, -3.7]
+        self.assertEqual(vectorizedFunctions["round"]([numpy.array(xs)], integer, [real]).tolist(), [int(round(x)) for x in xs])
+
+    def test_predicates(self):
+        for old, new in zip(numbers.dataset, numbers.toPython(a = "x > 0 and y < 1", b = "if x > 0: x else: -x").submit()):
+            self.assertEqual(old.x > 0 and old.y < 1, new.a)
+            self.assertEqual(old.x if old.x > 0 else -old.x, new.b)
+
+    def test_collection(self):
+        for old, new in zip(numbers.dataset, numbers.toPython(a = "ys.map(y => y * 2 + 1)").submit()):
+            self.assertEqual(len(old.ys), len(new.a))
+            for o, n in zip(old.ys, new.a):
+                self.assertAlmostEqual(o * 2 + 1, n)
+
+    def test_fallback(self):
+        # explodes x into ys, so this loop is not elementwise and is compiled the ordinary way
+        for old, new in zip(numbers.dataset, numbers.toPython(a = "ys.map(y => y + x)").submit()):
+            self.assertEqual(mapp(old.ys, lambda y: y + old.x), new.a)
@@ -22,8 +22,9 @@ import threading
 from wsgiref.simple_server import make_server
 try:
     from urllib2 import urlparse, urlopen, HTTPError
+    from urlparse import parse_qs
 except ImportError:
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, parse_qs
     from urllib.request import urlopen
     from urllib.error import HTTPError
 try:
@@ -47,6 +48,20 @@ class CancelQuery(object):
     def __init__(self, query):
         self.query = query
 
+class GetCacheStats(object):
+    pass
+
+class PrefetchColumns(object):
+    # columns and groupids of None mean all of them
+    def __init__(self, dataset, columns=None, groupids=None):
+        self.dataset = dataset
+        self.columns = columns
+        self.groupids = groupids
+
+class ReplayHistory(object):
+    def __init__(self, numQueries=None):
+        self.numQueries = numQueries
+
 def sendpickle(address, obj, timeout):
     serialized = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
     return pickle.loads(urlopen(address, serialized, timeout).read())
@@ -61,6 +76,10 @@ class HTTPServer(object):
     def getpath(self, environ):
         return environ.get("PATH_INFO", "").lstrip("/")
 
+    def getparams(self, environ):
+        # URL query parameters, each name to its last value
+        return dict((k, v[-1]) for k, v in parse_qs(environ.get("QUERY_STRING", "")).items())
+
     def getstring(self, environ):
         length = int(environ.get("CONTENT_LENGTH", "0"))
         return environ["wsgi.input"].read(length)
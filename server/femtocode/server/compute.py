@@ -19,8 +19,11 @@ try:
 except ImportError:
     import queue
 
+from femtocode.dataset import ColumnName
 from femtocode.run.compute import Minion
 from femtocode.run.cache import CacheMaster
+from femtocode.run.cache import FetcherPool
+from femtocode.run.cache import MmapFileAllocator
 from femtocode.run.cache import NeedWantCache
 from femtocode.execution import ExecutionFailure
 from femtocode.py23 import *
@@ -104,6 +107,7 @@ class NativeDistribExecutor(NativeExecutor):
 
 class Compute(HTTPServer):
     def __init__(self, metadb, cacheMaster, store):
+        self.metadb = metadb
         self.cacheMaster = cacheMaster
         self.store = store
         self.inprogress = InProgress(metadb)
@@ -132,6 +136,23 @@ class Compute(HTTPServer):
                 # ensure that all instances of this query have .cancelled = True
                 self.inprogress.cancel(message.query)
 
+            elif isinstance(message, PrefetchColumns):
+                # warm up the cache in the background, at low priority
+                groupids = message.groupids
+                if groupids is None:
+                    groupids = list(range(self.metadb.dataset(message.dataset, (), None, False).numGroups))
+                columns = message.columns
+                if columns is not None:
+                    columns = [ColumnName.parse(x) if isinstance(x, string_types) else x for x in columns]
+                self.cacheMaster.prefetch(self.metadb.dataset(message.dataset, groupids, columns, False), columns)
+
+            elif isinstance(message, ReplayHistory):
+                self.cacheMaster.replay(message.numQueries)
+
+            elif isinstance(message, GetCacheStats):
+                # hit rate and refetched bytes, for comparing eviction policies
+                return self.sendpickle(self.cacheMaster.needWantCache.stats(), start_response)
+
             else:
                 assert False, "unrecognized message: {0}".format(message)
 
@@ -141,7 +162,15 @@ class Compute(HTTPServer):
             return self.senderror("500 Internal Server Error", start_response)
 
 if __name__ == "__main__":
+    import argparse
     from femtocode.dataset import MetadataFromJson
+    from femtocode.run.cache import evictionPolicies
+
+    parser = argparse.ArgumentParser(description="Femtocode compute server.")
+    parser.add_argument("--cache-limit", type=int, default=1024**3, help="bytes of column data to keep in the cache")
+    parser.add_argument("--cache-directory", default="/tmp/femtocode-cache", help="file-backed so that a restarted worker keeps what it had cached")
+    parser.add_argument("--eviction-policy", choices=sorted(evictionPolicies), default="lru", help="lru, lfu, gds (GreedyDual-Size, weighs refetch cost), or arc")
+    args = parser.parse_args()
 
     metadb = MetadataFromJson("../tests/")
     # metadb = MetadataFromMongoDB("mongodb://localhost:27017", "metadb", "datasets", ROOTDataset, 1.0)
@@ -149,7 +178,10 @@ if __name__ == "__main__":
     minion = Minion(queue.Queue())
     minion.start()
 
-    cacheMaster = CacheMaster(NeedWantCache(1024**3), [minion])
+    needWantCache = NeedWantCache(args.cache_limit, MmapFileAllocator(args.cache_directory), args.eviction_policy, fetcherPool=FetcherPool())
+    needWantCache.recover()
+
+    cacheMaster = CacheMaster(needWantCache, [minion])
     cacheMaster.start()
 
     store = ResultStore("mongodb://localhost:27017", "store", "queries", "groups", 1.0)
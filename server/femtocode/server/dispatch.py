@@ -173,6 +173,7 @@ class Dispatch(HTTPServer):
                 # user is submitting a query
                 try:
                     query = Query.fromJson(self.getjson(environ))
+                    priority = int(self.getparams(environ).get("priority", 0))
                 except:
                     return self.senderror("400 Bad Request", start_response)
                 else:
@@ -191,6 +192,7 @@ class Dispatch(HTTPServer):
                         if len(missing) > 0:
                             # compile the query into machine code (ONLY IF submitting)
                             executor = NativeExecutor(query, False)
+                            executor.priority = priority    # for the computes' FetcherPools: lower numbers are fetched sooner
                             # submit; failure is only non-None if there are no survivors, so no need to cancel anything
                             failure = self.watchman.assign(executor, status.groupidToUniqueid(), missing)
 